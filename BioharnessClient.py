@@ -1,16 +1,118 @@
 # © 2017, 2018 published Massachusetts Institute of Technology.
 import json
+import math
 import logging 
+import numpy as np
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import task
-from zephyr.collector import SignalPacketIterator
 from zephyr.bioharness import BioHarnessPacketHandler
 from zephyr.message import MessagePayloadParser, SummaryMessage, SignalSample, AccelerationSignalSample
-from zephyr.protocol import MessageFrameParser, create_message_frame
+from zephyr.protocol import MessageFrame, create_message_frame
 from collections import deque
+from itertools import repeat, islice
 from twisted.internet.serialport import SerialPort
 import sys
 
+###
+# Message Frame Buffer
+# splits the received serial data into zephyr message frames (STX, message id, DLC, payload, CRC-8, ETX/ETB)
+# a whole received chunk is scanned at once: frames are found by STX and their length, and the CRCs of all
+# frames of the chunk are checked with a lookup table, with NumPy once the chunk holds more than a few frames
+# (e.g. a backlog after a stall). An incomplete frame at the end of a chunk is kept until the next one,
+# bytes that start no valid frame are skipped
+STX, ETX, ETB = 0x02, 0x03, 0x17
+MAX_PAYLOAD_LENGTH = 128
+BULK_CRC_MIN_FRAMES = 8
+
+def crc_8_contributions():
+    # the CRC-8 (polynomial 0x8C) is linear, the CRC of a payload is the XOR of one table entry per byte:
+    # contributions[k][byte] is the CRC of byte followed by k more bytes
+    contributions = np.zeros((MAX_PAYLOAD_LENGTH, 256), dtype=np.uint8)
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8C if crc & 1 else crc >> 1
+        contributions[0, value] = crc
+    for following_bytes in range(1, MAX_PAYLOAD_LENGTH):
+        contributions[following_bytes] = contributions[0][contributions[following_bytes - 1]]
+    return contributions
+
+CRC_8_CONTRIBUTIONS = crc_8_contributions()
+CRC_8_TABLE = CRC_8_CONTRIBUTIONS[0].tolist()
+
+class MessageFrameBuffer(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = bytearray()
+        self.skipped_bytes = 0
+        self.crc_errors = 0
+
+    def parse_data(self, data):
+        self.buffer += data
+        position = 0
+        while True:
+            frames, end_of_frames = self.find_frames(position)
+            for (start, end), crc_is_valid in zip(frames, self.check_crcs(frames)):
+                if not crc_is_valid:
+                    # a corrupted frame or an STX inside other data, the search continues after its STX
+                    self.crc_errors += 1
+                    self.skipped_bytes += 1
+                    position = start + 1
+                    break
+                self.callback(MessageFrame(self.buffer[start + 1], list(self.buffer[start + 3:end - 2]), self.buffer[end - 1] == ETX))
+            else:
+                position = end_of_frames
+                break
+        del self.buffer[:position]
+
+    def find_frames(self, position):
+        # Returns the (start, end) of the complete frames from position on and where the unparsed data begins
+        buffer = self.buffer
+        length = len(buffer)
+        frames = []
+        while True:
+            start = buffer.find(STX, position)
+            if start < 0:
+                self.skipped_bytes += length - position
+                return frames, length
+            self.skipped_bytes += start - position
+            if start + 3 > length:
+                return frames, start
+            end = start + buffer[start + 2] + 5
+            if end > length:
+                return frames, start
+            if buffer[start + 2] > MAX_PAYLOAD_LENGTH or buffer[end - 1] not in (ETX, ETB):
+                self.skipped_bytes += 1
+                position = start + 1
+                continue
+            frames.append((start, end))
+            position = end
+
+    def check_crcs(self, frames):
+        if len(frames) < BULK_CRC_MIN_FRAMES:
+            return [self.crc_of_payload(start, end) == self.buffer[end - 2] for start, end in frames]
+        # a view of the buffer, it is released before the buffer is trimmed
+        data = np.frombuffer(self.buffer, dtype=np.uint8, count=frames[-1][1] - frames[0][0], offset=frames[0][0])
+        frames = np.array(frames) - frames[0][0]
+        payload_lengths = frames[:, 1] - frames[:, 0] - 5
+        # buffer index and number of following payload bytes of every payload byte of all frames
+        payload_offsets = np.cumsum(payload_lengths) - payload_lengths
+        payload_indices = np.repeat(frames[:, 0] + 3 - payload_offsets, payload_lengths) + np.arange(payload_lengths.sum())
+        following_bytes = np.repeat(frames[:, 1] - 3, payload_lengths) - payload_indices
+        contributions = CRC_8_CONTRIBUTIONS[following_bytes, data[payload_indices]]
+        crcs = np.zeros(len(frames), dtype=np.uint8)
+        non_empty = payload_lengths > 0
+        if non_empty.any():
+            crcs[non_empty] = np.bitwise_xor.reduceat(contributions, payload_offsets[non_empty])
+        return (crcs == data[frames[:, 1] - 2]).tolist()
+
+    def crc_of_payload(self, start, end):
+        crc = 0
+        for byte in self.buffer[start + 3:end - 2]:
+            crc = CRC_8_TABLE[crc ^ byte]
+        return crc
+
+
 class BioharnessProtocol(LineReceiver):    
     message_ids = {
                    "ecg": 0x16,
@@ -31,24 +133,53 @@ class BioharnessProtocol(LineReceiver):
                       "acceleration": AccelerationSignalSample._fields,                      
                       }
 
-    def __init__(self, port, reactor):
-        self.buffers = {}
-        self.buffers["rr"] = deque(maxlen=18)
-        self.buffers["ecg"] = deque(maxlen=250)
-        self.buffers["breathing"] = deque(maxlen=25)
-        self.buffers["acceleration_x"] = deque(maxlen=100)
-        self.buffers["acceleration_y"] = deque(maxlen=100)
-        self.buffers["acceleration_z"] = deque(maxlen=100)
+    # samples per second of the device kept for the processing package
+    buffered_rates = {
+                      "rr": 18,
+                      "ecg": 250,
+                      "breathing": 18,
+                      "acceleration_x": 50,
+                      "acceleration_y": 50,
+                      "acceleration_z": 50,
+                      }
+
+    # samples in one packet of the device, they arrive in one burst
+    packet_samples = {
+                      "rr": 18,
+                      "ecg": 63,
+                      "breathing": 18,
+                      "acceleration_x": 20,
+                      "acceleration_y": 20,
+                      "acceleration_z": 20,
+                      }
+
+    def __init__(self, port, reactor, device_id=None):
+        # the streams of a device with an ID are named BIO_<device_id>_<stream>, otherwise BIO_<stream>
+        self.device_id = device_id
+        self.stream_prefix = "BIO" if device_id is None else "BIO_%s" % device_id
+        self.create_buffers(1.0)
+        self.last_timestamp = None
         self.hr_last_val = 0
         self.br_last_val = 0
         self.ecg_conf_last_val = 0
         self.loop = task.LoopingCall(self.send_data_for_processing_multiple)
 
         self.processing_proxy = None
+        self.alignment = None
+        self.features = None
         self.port = port
         self.reactor = reactor
         self.serial = None
 
+    def create_buffers(self, interval):
+        # the buffers hold two intervals and one packet, so a late package or a burst of packets
+        # does not push out samples that were not packaged yet
+        self.buffers = dict((name, deque(maxlen=int(math.ceil(2 * rate * interval)) + self.packet_samples[name]))
+                            for name, rate in self.buffered_rates.items())
+        # samples received per stream in total and up to the last package, the difference is new
+        self.received_samples = dict((stream_type, 0) for stream_type in self.columns_of_streams)
+        self.packaged_samples = dict(self.received_samples)
+
     def send_device_command(self, message_id, payload):
         message_frame = create_message_frame(message_id, payload)
         logging.info("Bioharness - sending a command to the device: msg_id : %s, Payload : %s" % (message_id, payload))
@@ -72,18 +203,64 @@ class BioharnessProtocol(LineReceiver):
         self.set_summary_packet_transmit_interval_to_one_second()
         
     def default_signal_waveform_handler(self, signal_packet, start_new_stream):
-        samples_iterator = SignalPacketIterator(signal_packet).iterate_timed_samples()
-        for signal_sample in samples_iterator:
-            self.logger_of_stream[signal_sample.type].write_tuple_to_log_file(signal_sample)
-            
-            # buffer samples
-            if signal_sample.type is not "acceleration":
-                self.buffers[signal_sample.type].append(signal_sample.sample)
-            else:
-                self.buffers["acceleration_x"].append(signal_sample.sample_x)   
-                self.buffers["acceleration_y"].append(signal_sample.sample_y)   
-                self.buffers["acceleration_z"].append(signal_sample.sample_z)   
+        # the samples of a packet are handled as one batch, timed like SignalPacketIterator does
+        if not len(signal_packet.samples): return
+        timestamps = signal_packet.timestamp + np.arange(len(signal_packet.samples)) * (1.0 / signal_packet.samplerate)
+        self.handle_signal_samples(signal_packet.type, timestamps, signal_packet.samples)
+
+    def handle_signal_samples(self, signal_type, timestamps, samples):
+        # acceleration samples are (x, y, z), the other streams have one value per sample
+        columns = [list(column) for column in zip(*samples)] if signal_type == "acceleration" else [list(samples)]
+        self.logger_of_stream[signal_type].write_rows(list(zip(repeat(signal_type), timestamps.tolist(), *columns)))
+        if self.alignment is not None:
+            self.alignment.add_rows(self.stream_prefix, "%s_%s" % (self.stream_prefix, signal_type), np.column_stack([timestamps] + columns))
+        if self.features is not None:
+            self.features.add_bioharness_samples(self.stream_prefix, signal_type, timestamps, columns)
+        if self.processing_proxy is not None and self.processing_proxy.visualization is not None:
+            # e.g. BIO_ecg, BIO_acceleration_x
+            names = ["acceleration_x", "acceleration_y", "acceleration_z"] if signal_type == "acceleration" else [signal_type]
+            for name, column in zip(names, columns):
+                self.processing_proxy.visualization.add_samples("%s_%s" % (self.stream_prefix, name), timestamps, column)
+
+        # buffer samples
+        self.received_samples[signal_type] += len(timestamps)
+        self.last_timestamp = float(timestamps[-1])
+        if signal_type != "acceleration":
+            self.buffers[signal_type].extend(columns[0])
+        else:
+            self.buffers["acceleration_x"].extend(columns[0])
+            self.buffers["acceleration_y"].extend(columns[1])
+            self.buffers["acceleration_z"].extend(columns[2])
+
+    def handle_signal_sample(self, signal_sample):
+        # a single sample, e.g. from the session replay
+        self.logger_of_stream[signal_sample.type].write_tuple_to_log_file(signal_sample)
+        if self.alignment is not None:
+            # (timestamp, values...) on the Bioharness clock
+            self.alignment.add_row(self.stream_prefix, "%s_%s" % (self.stream_prefix, signal_sample.type), signal_sample[1:])
+        if self.features is not None:
+            self.features.add_bioharness_samples(self.stream_prefix, signal_sample.type, [signal_sample.timestamp], [[value] for value in signal_sample[2:]])
+        if self.processing_proxy is not None and self.processing_proxy.visualization is not None:
+            self.handle_visualization_sample(signal_sample)
+        
+        # buffer samples
+        self.received_samples[signal_sample.type] += 1
+        self.last_timestamp = signal_sample.timestamp
+        if signal_sample.type != "acceleration":
+            self.buffers[signal_sample.type].append(signal_sample.sample)
+        else:
+            self.buffers["acceleration_x"].append(signal_sample.sample_x)   
+            self.buffers["acceleration_y"].append(signal_sample.sample_y)   
+            self.buffers["acceleration_z"].append(signal_sample.sample_z)   
                 
+    def handle_visualization_sample(self, signal_sample):
+        if signal_sample.type != "acceleration":
+            samples = [(signal_sample.type, signal_sample.sample)]
+        else:
+            samples = [("acceleration_x", signal_sample.sample_x), ("acceleration_y", signal_sample.sample_y), ("acceleration_z", signal_sample.sample_z)]
+        for name, sample in samples:
+            self.processing_proxy.visualization.add_samples("%s_%s" % (self.stream_prefix, name), [signal_sample.timestamp], [sample])
+
     def display_status_flags(self, summary_packet):
         if (summary_packet.heart_rate_unreliable or summary_packet.respiration_rate_unreliable) or (summary_packet.hrv_unreliable or summary_packet.button_pressed):
             #logging.warn("Bioharness - Heart Rate:%s ; Breathing Rate:%s ; HRV:%s" % ((not summary_packet.heart_rate_unreliable), (not summary_packet.respiration_rate_unreliable), (not summary_packet.hrv_unreliable)))
@@ -99,15 +276,44 @@ class BioharnessProtocol(LineReceiver):
         self.ecg_conf_last_val = summary_packet.ecg_wave_confidence
 
     
-    def set_proxy(self, proxy):
+    def set_proxy(self, proxy, interval=1.0):
+        # every interval a package with the samples received since the last one is sent to the proxy
         self.processing_proxy = proxy
-        self.loop.start(1.0)
+        self.create_buffers(interval)
+        self.loop.start(interval)
+
+    def set_alignment(self, alignment):
+        self.alignment = alignment
+
+    def set_features(self, features):
+        self.features = features
             
   
     def send_data_for_processing(self, type, value, timestamp):
-        if self.processing_proxy is not None:
+        if self.processing_proxy is not None and self.processing_proxy.subscribed(type, device=self.device_id):
             data = {"type":type, "timestamp":timestamp, "value": value}
             self.processing_proxy.notifyAll(data)
+
+    def send_data_for_processing_multiple(self):
+        received_samples = dict(self.received_samples)
+        new_samples = dict((stream_type, received_samples[stream_type] - self.packaged_samples[stream_type]) for stream_type in received_samples)
+        self.packaged_samples = received_samples
+        if self.processing_proxy is None or not self.processing_proxy.subscribed("bioharness", device=self.device_id): return
+
+        wanted_fields = self.processing_proxy.wanted_fields("bioharness", device=self.device_id)
+        data = {"type": "bioharness", "device": self.device_id, "timestamp": self.last_timestamp}
+        for name, buffer in self.buffers.items():
+            if wanted_fields is not None and name not in wanted_fields: continue
+            # a snapshot of the new samples at the end of the buffer, copied from the end so older samples are not touched
+            count = new_samples[name.split("_")[0]]
+            if count > len(buffer):
+                logging.warning("Bioharness - %i %s samples were overwritten before they were sent for processing" % (count - len(buffer), name))
+                count = len(buffer)
+            data[name] = np.fromiter(islice(reversed(buffer), count), dtype=np.float64, count=count)[::-1].copy()
+        data["heart_rate"] = self.hr_last_val
+        data["respiration_rate"] = self.br_last_val
+        data["ecg_conf"] = self.ecg_conf_last_val
+        self.processing_proxy.notifyAll(data)
            
     def set_event_callbacks(self, callbacks= None):
         if callbacks is None: callbacks=[self.default_event_callback]
@@ -130,18 +336,17 @@ class BioharnessProtocol(LineReceiver):
         
         self.signal_packet_handler_bh = BioHarnessPacketHandler(self.waveform_callbacks, self.event_callbacks)
         self.payload_parser = MessagePayloadParser([self.signal_packet_handler_bh.handle_packet])
-        self.message_parser = MessageFrameParser(self.payload_parser.handle_message)
+        self.message_parser = MessageFrameBuffer(self.payload_parser.handle_message)
 
     def rawDataReceived(self, data):
         if not data: return  
-        for byte in data:
-            self.message_parser.parse_data(byte)
+        self.message_parser.parse_data(data)
     
     def set_serial(self, serial):
         self.serial = serial
         
     def connectionLost(self, reason):
-        logging.error("Bioharness - Lost connection (%s)" % reason)
+        logging.error("Bioharness - Lost connection to %s (%s)" % (self.port, reason))
         logging.info("Bioharness - Reconnecting in 5 seconds...")
         self.serial._serial.close()
         self.retry = self.reactor.callLater(5, self.reconnect)
@@ -152,7 +357,7 @@ class BioharnessProtocol(LineReceiver):
                 self.serial = SerialPort(self, self.port, self.reactor, baudrate=115200)
             else:
                 self.serial.__init__(self, self.port, self.reactor, baudrate=115200)
-            logging.info("Bioharness - Reconnected")
+            logging.info("Bioharness - Reconnected to %s" % self.port)
            
         except:
             logging.error("Bioharness - Error opening serial port %s (%s)" % (self.port, sys.exc_info()[1]))
@@ -1,46 +1,76 @@
 # © 2017, 2018 published Massachusetts Institute of Technology.
 from twisted.protocols.basic import LineReceiver
 from twisted.internet.protocol import ReconnectingClientFactory
-from E4Commands import COMMAND_server_status, COMMAND_device_list, COMMAND_device_connect, COMMAND_device_subscribe, COMMAND_pause, StreamMessagesDecoder
+from twisted.internet import task
+from E4Commands import COMMAND_server_status, COMMAND_device_list, COMMAND_device_connect, COMMAND_device_subscribe, COMMAND_pause, StreamMessagesDecoder, E4CommandExeption
 from functools import partial
+from collections import deque
 from Logger import DataLogger
+import numpy as np
 import logging
+import time
 
+###
+# Start Up Command Sequence
+# brings a new connection to streaming in stages, all commands of a stage are sent at once (pipelined)
+# and the next stage starts when every response of the stage has arrived
+#   first connection:            server status | device list | connect, pause, subscribes, resume
+#   reconnect to a known device: connect, pause, subscribes, resume
+# responses are matched to the sent commands by their command name and, for subscriptions, the stream
 class StartUpCommandSequence(object):
-    def __init__(self, protocol):
+    def __init__(self, protocol, device=None):
         self.protocol = protocol
-        self.commands_list = [
-                              (self.get_server_status, self.handle_server_status),
-                              (self.get_device_list, self.handle_device_list),
-                              (self.connect_to_device, self.handle_connect_to_device),
-                              
-                              # Set here the list of streams you would like to register for
-                              (partial(self.pause, state="ON"), self.handle_pause),
-                              #(partial(self.subscibe_to_stream, stream="acc"), self.handle_subscribe_to_stream),
-                              (partial(self.subscibe_to_stream, stream="bvp"), self.handle_subscribe_to_stream),
-                              (partial(self.subscibe_to_stream, stream="gsr"), self.handle_subscribe_to_stream),
-                              (partial(self.subscibe_to_stream, stream="tmp"), self.handle_subscribe_to_stream),
-                              (partial(self.subscibe_to_stream, stream="ibi"), self.handle_subscribe_to_stream),
-                              #(partial(self.subscibe_to_stream, stream="bat"), self.handle_subscribe_to_stream),
-                              #(partial(self.subscibe_to_stream, stream="tag"), self.handle_subscribe_to_stream),
-                              (partial(self.pause, state="OFF"), self.handle_pause),
-                              ]
-        
-        self.current_command = self.commands_list.pop(0)
+        self.device = device
+
+        # Set here the list of streams you would like to register for
+        streams = [
+                   #"acc",
+                   "bvp",
+                   "gsr",
+                   "tmp",
+                   "ibi",
+                   #"bat",
+                   #"tag",
+                   ]
+        subscription = [(self.connect_to_device, COMMAND_device_connect, None, self.handle_connect_to_device),
+                        (partial(self.pause, state="ON"), COMMAND_pause, None, self.handle_pause)]
+        subscription += [(partial(self.subscibe_to_stream, stream=stream), COMMAND_device_subscribe, stream, self.handle_subscribe_to_stream)
+                         for stream in streams]
+        subscription += [(partial(self.pause, state="OFF"), COMMAND_pause, None, self.handle_pause)]
+
+        if device is None:
+            self.stages = [[(self.get_server_status, COMMAND_server_status, None, self.handle_server_status)],
+                           [(self.get_device_list, COMMAND_device_list, None, self.handle_device_list)],
+                           subscription]
+        else:
+            self.stages = [subscription]
+        self.pending_commands = []
         
     def startup_finished(self):
-        return len(self.commands_list) == 0
+        return not self.stages and not self.pending_commands
     
     def execute_next_command(self):
-        self.current_command[0]()
+        # sends the next stage once all responses of the current one have arrived
+        if self.pending_commands or not self.stages: return
+        stage = self.stages.pop(0)
+        self.pending_commands = [(command, argument, handler) for send, command, argument, handler in stage]
+        for send, command, argument, handler in stage:
+            send()
     
     def handle_command_response(self, line):
-        self.current_command[1](line)
-        self.current_command = self.commands_list.pop(0)
+        response_items = line.split(" ")
+        if response_items[0] != "R": return
+        for index, (command, argument, handler) in enumerate(self.pending_commands):
+            if response_items[1:2] != [command.response_command]: continue
+            if argument is not None and response_items[2:3] != [argument]: continue
+            del self.pending_commands[index]
+            handler(line)
+            return
+        raise E4CommandExeption("Received a command response that matches none of the sent commands: %s" % line)
 
     # SERVER STATUS
     def get_server_status(self):
-        self.protocol.transport.write(COMMAND_server_status.encode_arguments())
+        self.protocol.send_command(COMMAND_server_status.encode_arguments())
         
     def handle_server_status(self, line):
         response = COMMAND_server_status.decode_response(line)
@@ -48,26 +78,37 @@ class StartUpCommandSequence(object):
 
     # DEVICE LIST
     def get_device_list(self):
-        self.protocol.transport.write(COMMAND_device_list.encode_arguments())
+        self.protocol.send_command(COMMAND_device_list.encode_arguments())
     
     def handle_device_list(self, line):
         devices = COMMAND_device_list.decode_response(line)
-        self.device = devices[self.protocol.client_index]
+        if self.protocol.device_id is None:
+            self.device = devices[self.protocol.client_index]
+        else:
+            matching_devices = [device for device in devices if device["DEVICE_ID"] == self.protocol.device_id]
+            assert matching_devices, "Device %s is not in the device list: %s" % (self.protocol.device_id, line)
+            self.device = matching_devices[0]
             
         assert self.device["AVAILABILITY"] == "available", "Device is not available to connect to: %s" % line
         logging.debug("E4BLEClient - Device list received. Connecting to device %s with name %s" % (self.device["DEVICE_ID"],self.device["DEVICE_NAME"]))
         
     # CONNECTING TO DEVICE
     def connect_to_device(self):
-        self.protocol.transport.write(COMMAND_device_connect.encode_arguments(DEVICE_ID=self.device["DEVICE_ID"]))
+        self.protocol.send_command(COMMAND_device_connect.encode_arguments(DEVICE_ID=self.device["DEVICE_ID"]))
     
     def handle_connect_to_device(self, line):
-        response = COMMAND_device_connect.decode_response(line)
+        try:
+            response = COMMAND_device_connect.decode_response(line)
+        except E4CommandExeption:
+            # the next connection starts with the discovery again
+            self.protocol.remember_device(None)
+            raise
+        self.protocol.remember_device(self.device)
         logging.debug("E4BLEClient - Connected to device successfully")
     
     # PAUSING AND RESUMING    
     def pause(self, state):
-        self.protocol.transport.write(COMMAND_pause.encode_arguments(STATE=state))
+        self.protocol.send_command(COMMAND_pause.encode_arguments(STATE=state))
         
     def handle_pause(self, line):
         response = COMMAND_pause.decode_response(line)
@@ -76,7 +117,7 @@ class StartUpCommandSequence(object):
     # SUBSCRIBE TO STREAMS
     
     def subscibe_to_stream(self, stream):
-        self.protocol.transport.write(COMMAND_device_subscribe.encode_arguments(STREAM=stream,STATE="ON"))
+        self.protocol.send_command(COMMAND_device_subscribe.encode_arguments(STREAM=stream,STATE="ON"))
         self.protocol.stream_decoder.subscribe_to_stream(stream)
         
     def handle_subscribe_to_stream(self, line):
@@ -86,24 +127,176 @@ class StartUpCommandSequence(object):
     def dummy_handler(self, line):
         return
 
+
+###
+# E4 Stream Chunk
+# a preallocated array of the rows (timestamp and values) of one E4 stream,
+# filled sample by sample and handed over as one block when it is full
+class E4StreamChunk(object):
+    def __init__(self, number_of_columns, chunk_size):
+        self.number_of_columns = number_of_columns
+        self.chunk_size = chunk_size
+        self.allocate()
+
+    def allocate(self):
+        self.rows = np.empty((self.chunk_size, self.number_of_columns))
+        self.length = 0
+
+    def take_rows(self):
+        # the filled rows are handed over without a copy, the chunk continues in a new array
+        rows = self.rows[:self.length]
+        self.allocate()
+        return rows
+
         
 class E4Protocol(LineReceiver):
-    delimiter = "\n"    
+    delimiter = b"\n"    
+    
+    def __init__(self):
+        self.logger_of_stream = {}
+        self.device_id = None
+        self.known_device = None
+        self.waiting_for_first_sample = True
+        self.chunk_size = None
+        self.chunk_of_stream = {}
+        self.chunk_subscribers = []
+        self.unparsed_data = b""
+        self.flush_loop = None
+        self.processing_proxy = None
+        self.window_of_stream = {}
+        self.proxy_loop = None
+    
+    def send_command(self, command):
+        self.transport.write(command.encode("utf-8"))
     
     def set_data_loggers(self, logger_of_stream):
+        # samples still in the chunks belong to the previous loggers
+        self.flush_chunks()
         self.logger_of_stream = logger_of_stream
+
+    def set_chunked_ingestion(self, chunk_size, flush_interval, chunk_subscribers):
+        # chunk_subscribers are called with the stream type and the rows of every chunk
+        self.chunk_size = chunk_size
+        self.chunk_flush_interval = flush_interval
+        self.chunk_subscribers = chunk_subscribers
+        
+    def set_proxy(self, proxy, client_name, interval=1.0):
+        # every interval a packet with the samples of all streams since the last one is sent to the proxy,
+        # the samples are kept in a bounded ring buffer per stream (4 intervals at the highest E4 rate, 64 Hz)
+        self.processing_proxy = proxy
+        self.client_name = client_name
+        self.proxy_interval = interval
+        max_window_rows = int(4 * interval * 64) + 1
+        self.window_of_stream = {stream_type: deque(maxlen=max_window_rows)
+                                 for stream_type, data_stream in self.stream_decoder.possible_streams.items() if len(data_stream.values) > 1}
         
     def set_instance_index(self, index):
         self.client_index = index
+
+    def set_device_id(self, device_id):
+        # the device is picked from the device list by its ID, or by the instance index if it has none
+        self.device_id = device_id
+
+    def set_known_device(self, device):
+        # the device of a previous connection, the startup sequence skips the discovery
+        self.known_device = device
+
+    def remember_device(self, device):
+        if self.factory is not None:
+            self.factory.known_device = device
+
+    def first_sample_received(self):
+        self.waiting_for_first_sample = False
+        if self.factory is not None:
+            self.factory.first_sample_received()
         
     def set_stream_decoder(self, stream_decoder):
         self.stream_decoder = stream_decoder
             
     def connectionMade(self):
-        self.startup_sequence = StartUpCommandSequence(self)
+        self.startup_sequence = StartUpCommandSequence(self, self.known_device)
         self.startup_sequence.execute_next_command()
+        self.start_chunk_flushing()
+        self.start_sending_windows()
+
+    def connectionLost(self, reason):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        if self.proxy_loop is not None and self.proxy_loop.running:
+            self.proxy_loop.stop()
+        self.flush_chunks()
+
+    def start_chunk_flushing(self):
+        # partially filled chunks are handed over periodically, so slow streams (gsr, tmp, ibi) are not held back
+        if self.chunk_size is None: return
+        self.flush_loop = task.LoopingCall(self.flush_chunks)
+        self.flush_loop.start(self.chunk_flush_interval, now=False)
+
+    def start_without_device(self, streams):
+        # Used by the session replay: lines are decoded as if the startup sequence had subscribed to the streams
+        self.startup_sequence = StartUpCommandSequence(self)
+        self.startup_sequence.stages = []
+        for stream in streams:
+            self.stream_decoder.subscribe_to_stream(stream)
+        self.start_chunk_flushing()
+        self.start_sending_windows()
+
+    def dataReceived(self, data):
+        if not self.startup_sequence.startup_finished():
+            return LineReceiver.dataReceived(self, data)
+        # after the startup sequence the lines of every received chunk are split and decoded at once,
+        # a partial last line waits for the next data
+        data = self.unparsed_data + self.clearLineBuffer() + data
+        complete = data.rfind(self.delimiter) + 1
+        self.unparsed_data = data[complete:]
+        if complete:
+            self.ingest_lines(data[:complete].decode("utf-8").split("\n"))
+
+    def ingest_lines(self, lines):
+        # the lines are decoded by the stream decoder, which leaves out malformed lines,
+        # then each stream's rows go to its logger or, with chunked ingestion, into the stream's chunk
+        values_of_stream = self.stream_decoder.decode_lines(lines)
+        if values_of_stream and self.waiting_for_first_sample:
+            self.first_sample_received()
+        for message_type, rows in values_of_stream.items():
+            if self.chunk_size is None:
+                self.logger_of_stream[message_type].write_rows(rows)
+                window = self.window_of_stream.get(message_type)
+                if window is not None:
+                    window.extend(rows)
+            else:
+                self.store_rows(message_type, rows)
+
+    def store_rows(self, message_type, rows):
+        chunk = self.chunk_of_stream.get(message_type)
+        if chunk is None:
+            # the same columns as the stream's logger
+            number_of_columns = len(self.stream_decoder.possible_streams[message_type].values)
+            chunk = self.chunk_of_stream[message_type] = E4StreamChunk(number_of_columns, self.chunk_size)
+        position = 0
+        while position < len(rows):
+            count = min(chunk.chunk_size - chunk.length, len(rows) - position)
+            chunk.rows[chunk.length:chunk.length + count] = rows[position:position + count]
+            chunk.length += count
+            position += count
+            if chunk.length == chunk.chunk_size:
+                self.hand_over_chunk(message_type, chunk.take_rows())
+
+    def hand_over_chunk(self, message_type, rows):
+        self.logger_of_stream[message_type].write_rows(rows)
+        window = self.window_of_stream.get(message_type)
+        if window is not None:
+            window.extend(rows)
+        for subscriber in self.chunk_subscribers:
+            subscriber(message_type, rows)
+
+    def flush_chunks(self):
+        for message_type, chunk in self.chunk_of_stream.items():
+            if chunk.length > 0:
+                self.hand_over_chunk(message_type, chunk.take_rows())
         
     def lineReceived(self, line):
+        line = line.decode("utf-8").rstrip("\r")
         if not line: return
         
         if not self.startup_sequence.startup_finished():
@@ -111,16 +304,82 @@ class E4Protocol(LineReceiver):
             self.startup_sequence.execute_next_command()
             return
         
-        message_type, message_values = self.stream_decoder.decode_message_by_stream_prefix(line)
-        if message_type is None: return
-        
-        self.logger_of_stream[message_type].write_tuple_to_log_file(message_values)
+        self.ingest_lines([line])
+
+    def start_sending_windows(self):
+        if self.processing_proxy is None: return
+        self.proxy_loop = task.LoopingCall(self.send_windows_for_processing)
+        self.proxy_loop.start(self.proxy_interval, now=False)
+
+    def send_windows_for_processing(self):
+        # e.g. {"type": "e4", "client": "R", "timestamp": <last sample>, "bvp": [...], "gsr": [...], "acc_x": [...], ...}
+        if self.chunk_size is not None:
+            self.flush_chunks()
+        # the windows are emptied every interval, the package is only built if a subscriber wants it
+        subscribed = self.processing_proxy.subscribed("e4", client=self.client_name)
+        wanted_fields = self.processing_proxy.wanted_fields("e4", client=self.client_name) if subscribed else None
+        visualization = self.processing_proxy.visualization
+        data = {"type": "e4", "client": self.client_name, "timestamp": None}
+        for stream_type, window in self.window_of_stream.items():
+            if stream_type not in self.stream_decoder.open_streams or not (subscribed or visualization is not None):
+                window.clear()
+                continue
+            columns = self.stream_decoder.possible_streams[stream_type].values
+            field_names = [stream_type] if len(columns) == 2 else ["%s_%s" % (stream_type, column.lower()) for column in columns[1:]]
+            selected_columns = [(column_index, field_name) for column_index, field_name in enumerate(field_names, 1)
+                                if subscribed and (wanted_fields is None or field_name in wanted_fields)]
+            if window:
+                data["timestamp"] = max(data["timestamp"] or 0.0, float(window[-1][0]))
+            if selected_columns or (visualization is not None and window):
+                # the columns go to the proxy as arrays, it encodes them for every client
+                rows = np.array(window, dtype=np.float64).reshape(-1, len(columns))
+                for column_index, field_name in selected_columns:
+                    data[field_name] = rows[:, column_index]
+                if visualization is not None:
+                    # e.g. E4_R_bvp, E4_R_acc_x
+                    for column_index, field_name in enumerate(field_names, 1):
+                        visualization.add_samples("E4_%s_%s" % (self.client_name, field_name), rows[:, 0], rows[:, column_index])
+            window.clear()
+        if subscribed:
+            self.processing_proxy.notifyAll(data)
             
 class E4ClientFactory(ReconnectingClientFactory):
     id_of_client = {"L":0, "R":1}
 
-    def set_client_id(self, client):
-        self.client_id = self.id_of_client[client]
+    def __init__(self):
+        self.client_name = None
+        self.device_id = None
+        self.known_device = None
+        # seconds from connecting and from losing the previous connection to the first sample
+        self.connected_at = None
+        self.disconnected_at = None
+        self.time_to_first_sample = None
+        self.reconnect_to_first_sample = None
+        self.chunk_size = None
+        self.chunk_flush_interval = 0.25
+        self.chunk_subscribers = []
+        self.processing_proxy = None
+
+    def set_client_id(self, client, device_id=None):
+        # client is the name used in the log files, e.g. "R" or "S01", L and R without a device ID
+        # connect to the first and second device of the device list
+        if device_id is None and client not in self.id_of_client:
+            raise ValueError("E4 client %s needs a device ID" % client)
+        self.client_name = client
+        self.device_id = device_id
+        self.client_id = client if device_id is not None else self.id_of_client[client]
+
+    def set_chunked_ingestion(self, chunk_size, flush_interval=0.25):
+        # without a chunk size every line is written on its own
+        self.chunk_size = chunk_size
+        self.chunk_flush_interval = flush_interval
+
+    def add_chunk_subscriber(self, subscriber):
+        self.chunk_subscribers.append(subscriber)
+
+    def set_proxy(self, proxy, interval=1.0):
+        self.processing_proxy = proxy
+        self.proxy_interval = interval
         
     def set_stream_decoder(self, stream_decoder):
         self.stream_decoder = stream_decoder
@@ -137,15 +396,35 @@ class E4ClientFactory(ReconnectingClientFactory):
         self.resetDelay()
         
         protocol = E4Protocol()
+        protocol.factory = self
         protocol.set_instance_index(self.client_id)
+        protocol.set_device_id(self.device_id)
+        protocol.set_known_device(self.known_device)
         protocol.set_stream_decoder(self.stream_decoder)
         protocol.set_data_loggers(self.logger_of_stream)
+        if self.chunk_size:
+            protocol.set_chunked_ingestion(self.chunk_size, self.chunk_flush_interval, self.chunk_subscribers)
+        if self.processing_proxy is not None:
+            protocol.set_proxy(self.processing_proxy, self.client_name, self.proxy_interval)
         self.current_instance = protocol
         logging.debug("E4BLEClient - Protocol built for client %s" % self.client_id)        
+        self.connected_at = time.time()
 
         return protocol
     
+    def first_sample_received(self):
+        if self.connected_at is None: return
+        now = time.time()
+        self.time_to_first_sample = now - self.connected_at
+        if self.disconnected_at is None:
+            logging.info("E4BLEClient - E4Client %s streaming %.3f s after connecting" % (self.client_id, self.time_to_first_sample))
+            return
+        self.reconnect_to_first_sample = now - self.disconnected_at
+        logging.info("E4BLEClient - E4Client %s streaming again %.3f s after the connection was lost, %.3f s after reconnecting" % 
+                     (self.client_id, self.reconnect_to_first_sample, self.time_to_first_sample))
+
     def clientConnectionLost(self, connector, reason):
+        self.disconnected_at = time.time()
         logging.debug('E4BLEClient - E4Client %s Lost connection.  Reason: %s' % (self.client_id, reason))
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
@@ -1,5 +1,6 @@
 # © 2017, 2018 published Massachusetts Institute of Technology.
 # TODO: handle a problem with the fact that REASON has spaces in it 
+import logging
 
 class E4CommandExeption(Exception):pass
 
@@ -100,14 +101,22 @@ class DataStream(object):
                 
         return (formatted_message_type, message_values)
     
+    def decode_values(self, message_items):
+        # message_items is the already split message without its prefix, values are returned as floats
+        try:
+            return tuple([float(item) for item in message_items[:len(self.values)]])
+        except ValueError:
+            raise DataStreamException("Received stream message with non numeric values: %s %s" % (self.stream_type, " ".join(message_items)))
     
+    
+###
+# Stream Messages Decoder
+# decodes the E4_* stream lines of the E4 streaming server
+# decode_message splits a line once, finds its stream in a table of prefixes built at construction and returns floats,
+# decode_lines decodes all lines of a received chunk in one call, E4Protocol decodes every stream line with it
+# decode_message_by_stream_prefix is the original decoder returning the values as strings
 class StreamMessagesDecoder(object):
     def __init__(self):
-        self.open_streams = {
-                             "hr":  DataStream("E4_Hr <TIMESTAMP> <HR>"),
-                             "tag": DataStream("E4_Tag <TIMESTAMP> <X> <Y> <Z>"),
-                             }
-        
         self.possible_streams = {
                                  "acc": DataStream("E4_Acc <TIMESTAMP> <X> <Y> <Z>"), 
                                  "bvp": DataStream("E4_Bvp <TIMESTAMP> <BVP>"),
@@ -118,6 +127,16 @@ class StreamMessagesDecoder(object):
                                  "bat": DataStream("E4_Battery <TIMESTAMP> <LEVEL>"),
                                  "tag": DataStream("E4_Tag <TIMESTAMP>"),                            
                                  }
+
+        # the loggers and chunks of the open streams have the columns of possible_streams
+        self.open_streams = {
+                             "hr":  self.possible_streams["hr"],
+                             "tag": self.possible_streams["tag"],
+                             }
+        self.skipped_lines = 0
+
+        # e.g. "E4_Temperature" -> "tmp"
+        self.stream_of_prefix = {data_stream.stream_type: stream_type for stream_type, data_stream in self.possible_streams.items()}
         
     def subscribe_to_stream(self, stream_type):
         self.open_streams[stream_type] = self.possible_streams[stream_type]
@@ -143,6 +162,51 @@ class StreamMessagesDecoder(object):
             raise DataStreamException("Received a data stream message that though server is not subscribed to such stream: %s, string : %s" % (message_type, message_string))
         
         return self.open_streams[message_type].decode_stream_message(message_string)
+
+    def decode_message(self, message_string):
+        message_items = message_string.split(" ")
+        prefix = message_items[0]
+        if prefix == "R":
+            return None, None
+
+        message_type = self.stream_of_prefix.get(prefix)
+        if message_type is None:
+            raise DataStreamException("Received message with unknown stream type: %s" % message_string)
+        
+        data_stream = self.open_streams.get(message_type)
+        if data_stream is None:
+            raise DataStreamException("Received a data stream message that though server is not subscribed to such stream: %s, string : %s" % (message_type, message_string))
+        
+        return message_type, data_stream.decode_values(message_items[1:])
+
+    def decode_lines(self, lines):
+        # Returns the values of all stream lines grouped by stream type, in the order they were received
+        # decode_message inlined, this runs for every sample of every wristband
+        # lines of unknown or unsubscribed streams and lines with missing or non numeric values are left out
+        values_of_stream = {}
+        for line in lines:
+            message_items = line.rstrip("\r").split(" ")
+            message_type = self.stream_of_prefix.get(message_items[0])
+            if message_type is None and message_items[0] in ("R", ""): continue
+            data_stream = self.open_streams.get(message_type)
+            if data_stream is None or len(message_items) <= len(data_stream.values):
+                self.skip_line(line)
+                continue
+            try:
+                values = tuple(map(float, message_items[1:len(data_stream.values) + 1]))
+            except ValueError:
+                self.skip_line(line)
+                continue
+            stream_values = values_of_stream.get(message_type)
+            if stream_values is None:
+                stream_values = values_of_stream[message_type] = []
+            stream_values.append(values)
+        return values_of_stream
+
+    def skip_line(self, line):
+        self.skipped_lines += 1
+        if self.skipped_lines == 1 or self.skipped_lines % 1000 == 0:
+            logging.warning("E4Commands - Skipped a malformed or unsubscribed stream line, %i so far: %s" % (self.skipped_lines, line))
     
           
 # These are all possible commands
@@ -0,0 +1,305 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import math
+import numpy as np
+from collections import deque, OrderedDict
+from twisted.internet import task
+from Visualization import SampleRing
+
+###
+# Heart Rate Variability
+# RMSSD, SDNN and mean of the beat intervals (ms) of the last window seconds
+# running sums of the intervals, their squares and the squared successive differences are updated per beat,
+# beats leaving the window are subtracted again, so every beat costs O(1)
+# intervals outside 300 - 2000 ms are artifacts and skipped
+# the Bioharness RR stream repeats the last interval (ms) and toggles its sign with every detected beat,
+# with signed_intervals a beat is a sample whose sign differs from the one before
+class HeartRateVariability(object):
+    feature_names = ["rmssd", "sdnn", "mean_rr", "beats"]
+
+    def __init__(self, window_seconds=60.0, unit=1.0, signed_intervals=False):
+        self.window_seconds = window_seconds
+        self.unit = unit
+        self.signed_intervals = signed_intervals
+        self.last_sample = 0.0
+        self.beats = deque()
+        self.last_interval = None
+        self.interval_sum = 0.0
+        self.square_sum = 0.0
+        self.difference_sum = 0.0
+
+    def add(self, times, values):
+        samples = values[:, 0]
+        if self.signed_intervals:
+            previous = np.concatenate(([self.last_sample], samples[:-1]))
+            self.last_sample = samples[-1]
+            beats = (np.sign(samples) != np.sign(previous)) & (samples != 0)
+            times, samples = times[beats], np.abs(samples[beats])
+        intervals = samples * self.unit
+        valid = (intervals >= 300) & (intervals <= 2000)
+        for time, interval in zip(times[valid].tolist(), intervals[valid].tolist()):
+            # the successive difference of the first beat in the window is not part of the sum
+            difference = (interval - self.last_interval) ** 2 if self.beats else 0.0
+            self.beats.append((time, interval, difference))
+            self.last_interval = interval
+            self.interval_sum += interval
+            self.square_sum += interval * interval
+            self.difference_sum += difference
+        if len(times):
+            self.forget_before(times[-1] - self.window_seconds)
+
+    def forget_before(self, start_time):
+        while self.beats and self.beats[0][0] < start_time:
+            time, interval, difference = self.beats.popleft()
+            self.interval_sum -= interval
+            self.square_sum -= interval * interval
+            self.difference_sum -= difference
+            if self.beats:
+                self.difference_sum -= self.beats[0][2]
+                self.beats[0] = self.beats[0][:2] + (0.0,)
+        if not self.beats:
+            self.interval_sum = self.square_sum = self.difference_sum = 0.0
+
+    def features(self):
+        beats = len(self.beats)
+        mean = self.interval_sum / beats if beats else float("nan")
+        variance = (self.square_sum - beats * mean * mean) / (beats - 1) if beats > 1 else float("nan")
+        return {"rmssd": math.sqrt(max(self.difference_sum, 0.0) / (beats - 1)) if beats > 1 else float("nan"),
+                "sdnn": math.sqrt(max(variance, 0.0)) if beats > 1 else float("nan"),
+                "mean_rr": mean,
+                "beats": beats}
+
+
+###
+# Breathing Rate
+# breaths per minute from the breathing waveform: the strongest frequency between 0.05 and 1 Hz (3 to 60 breaths
+# per minute) in the spectrum of the Hann windowed samples of the last window seconds, computed only when new
+# samples arrived and at least half a window is there
+class BreathingRate(object):
+    feature_names = ["breathing_rate"]
+
+    def __init__(self, window_seconds=30.0, capacity=4096):
+        self.window_seconds = window_seconds
+        self.ring = SampleRing(capacity)
+        self.rate = float("nan")
+        self.changed = False
+
+    def add(self, times, values):
+        self.ring.extend(times, values[:, 0])
+        self.changed = True
+
+    def features(self):
+        if self.changed:
+            self.changed = False
+            self.rate = self.estimate_rate()
+        return {"breathing_rate": self.rate}
+
+    def estimate_rate(self):
+        last_time = self.ring.last_time()
+        times, samples = self.ring.samples_since(last_time - self.window_seconds)
+        duration = times[-1] - times[0] if len(times) > 1 else 0.0
+        if duration < self.window_seconds / 2: return float("nan")
+        sample_rate = (len(times) - 1) / duration
+        # zero padded to a power of two of at least twice the length, the peak is refined by a parabola through
+        # the log magnitudes around it
+        length = 1 << int(2 * len(samples) - 1).bit_length()
+        spectrum = np.log(np.abs(np.fft.rfft((samples - samples.mean()) * np.hanning(len(samples)), length)) + 1e-12)
+        frequencies = np.arange(len(spectrum)) * (sample_rate / length)
+        band = np.nonzero((frequencies >= 0.05) & (frequencies <= 1.0))[0]
+        if not len(band): return float("nan")
+        peak = band[np.argmax(spectrum[band])]
+        shift = 0.0
+        if 0 < peak < len(spectrum) - 1:
+            left, center, right = spectrum[peak - 1:peak + 2]
+            curvature = left - 2 * center + right
+            shift = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+        return 60.0 * float((peak + shift) * (sample_rate / length))
+
+
+###
+# Movement
+# movement intensity from acceleration: the square root of the summed variances of the axes over the last
+# window seconds, in the units of the sensor. Gravity and the orientation of the sensor fall out, a sensor
+# at rest is close to 0. Sums and sums of squares are kept per block of samples, a block leaves the window
+# as a whole once its last sample is older than the window
+class Movement(object):
+    feature_names = ["movement"]
+
+    def __init__(self, window_seconds=10.0):
+        self.window_seconds = window_seconds
+        self.blocks = deque()
+        self.offset = None
+        self.count = 0
+        self.sums = 0.0
+        self.squares = 0.0
+
+    def add(self, times, values):
+        # sums of the differences to the first sample, so squares of large raw values do not cancel out
+        if self.offset is None:
+            self.offset = values[0].copy()
+        values = values - self.offset
+        block = (times[-1], len(values), values.sum(axis=0), np.square(values).sum(axis=0))
+        self.blocks.append(block)
+        self.count += block[1]
+        self.sums = self.sums + block[2]
+        self.squares = self.squares + block[3]
+        while self.blocks[0][0] < times[-1] - self.window_seconds:
+            last_time, count, sums, squares = self.blocks.popleft()
+            self.count -= count
+            self.sums = self.sums - sums
+            self.squares = self.squares - squares
+
+    def features(self):
+        if self.count < 2: return {"movement": float("nan")}
+        variances = self.squares / self.count - np.square(self.sums / self.count)
+        return {"movement": math.sqrt(max(float(variances.sum()), 0.0))}
+
+
+###
+# Electrodermal Activity
+# splits skin conductance (µS) into a tonic level, the mean of the last window seconds up to every sample,
+# and the phasic response, the difference of the sample to the tonic level
+# the means of a block of new samples are computed at once from the cumulative sum of the new samples and the
+# ones of the last window before them
+#   eda_tonic  - tonic level at the newest sample
+#   eda_phasic - largest phasic response since the last features
+class ElectrodermalActivity(object):
+    feature_names = ["eda_tonic", "eda_phasic"]
+
+    def __init__(self, window_seconds=10.0):
+        self.window_seconds = window_seconds
+        self.times = np.empty(0)
+        self.samples = np.empty(0)
+        self.tonic = float("nan")
+        self.phasic = float("nan")
+
+    def add(self, times, values):
+        kept = len(self.times)
+        self.times = np.concatenate((self.times, times))
+        self.samples = np.concatenate((self.samples, values[:, 0]))
+        sums = np.concatenate(([0.0], np.cumsum(self.samples)))
+        ends = np.arange(kept, len(self.times)) + 1
+        starts = np.searchsorted(self.times, self.times[kept:] - self.window_seconds, side="right")
+        tonic = (sums[ends] - sums[starts]) / (ends - starts)
+        self.tonic = float(tonic[-1])
+        self.phasic = np.nanmax(np.concatenate(([self.phasic], self.samples[kept:] - tonic)))
+        keep_from = np.searchsorted(self.times, self.times[-1] - self.window_seconds, side="right")
+        self.times, self.samples = self.times[keep_from:], self.samples[keep_from:]
+
+    def features(self):
+        features = {"eda_tonic": self.tonic, "eda_phasic": float(self.phasic)}
+        self.phasic = float("nan")
+        return features
+
+
+###
+# Source Features
+# the feature extractors of one sensor device, keyed by the stream they take their samples from,
+# and the samples added since the last features, processed in one block per stream
+class SourceFeatures(object):
+    def __init__(self, source, packet_fields, extractor_of_stream):
+        self.source = source
+        self.packet_fields = packet_fields
+        self.extractor_of_stream = extractor_of_stream
+        self.pending = dict((stream_type, []) for stream_type in extractor_of_stream)
+        self.feature_names = sum([extractor.feature_names for extractor in extractor_of_stream.values()], [])
+        self.last_time = None
+
+    def add(self, stream_type, times, values):
+        pending = self.pending.get(stream_type)
+        if pending is None or not len(times): return
+        pending.append((times, values))
+
+    def process_pending(self):
+        for stream_type, pending in self.pending.items():
+            if not pending: continue
+            times = np.concatenate([times for times, values in pending])
+            values = np.concatenate([values for times, values in pending])
+            self.pending[stream_type] = []
+            self.extractor_of_stream[stream_type].add(times, values)
+            self.last_time = max(self.last_time or float(times[-1]), float(times[-1]))
+
+    def features(self):
+        features = {}
+        for extractor in self.extractor_of_stream.values():
+            features.update(extractor.features())
+        return features
+
+
+###
+# Feature Extraction
+# physiological features of every Bioharness and E4 device, updated from the samples as they arrive
+#   Bioharness (rr, breathing, acceleration): rmssd, sdnn, mean_rr, beats, breathing_rate, movement
+#   E4 (ibi, gsr, acc):                       rmssd, sdnn, mean_rr, beats, eda_tonic, eda_phasic, movement
+# every interval the features of every device with samples are written to its FEATURES_<source> log file and
+# sent to the real-time processing proxy, timestamped with the newest sample on the clock of the sensor:
+#   {"type": "features", "timestamp": <newest sample>, "device": <Bioharness device_id>, "rmssd": 42.1, "breathing_rate": 14.2, ...}
+#   {"type": "features", "timestamp": <newest sample>, "client": "R", "eda_tonic": 2.31, "eda_phasic": 0.12, ...}
+# features without enough samples yet are NaN (null in packets)
+class FeatureExtraction(object):
+    def __init__(self, hrv_window=60.0, breathing_window=30.0, movement_window=10.0, eda_window=10.0):
+        self.hrv_window = hrv_window
+        self.breathing_window = breathing_window
+        self.movement_window = movement_window
+        self.eda_window = eda_window
+        self.features_of_source = OrderedDict()
+        self.logger_of_source = {}
+        self.processing_proxy = None
+        self.loop = None
+
+    def register_bioharness(self, stream_prefix, device_id=None):
+        # stream_prefix names the source, e.g. "BIO" or "BIO_<device_id>"
+        self.features_of_source[stream_prefix] = SourceFeatures(stream_prefix, {"device": device_id}, OrderedDict([
+            ("rr", HeartRateVariability(self.hrv_window, signed_intervals=True)),
+            ("breathing", BreathingRate(self.breathing_window)),
+            ("acceleration", Movement(self.movement_window)),
+            ]))
+
+    def register_E4(self, client_name):
+        self.features_of_source["E4_%s" % client_name] = SourceFeatures("E4_%s" % client_name, {"client": client_name}, OrderedDict([
+            ("ibi", HeartRateVariability(self.hrv_window, unit=1000.0)),
+            ("gsr", ElectrodermalActivity(self.eda_window)),
+            ("acc", Movement(self.movement_window)),
+            ]))
+
+    def columns_of_source(self):
+        return OrderedDict((source, ["timestamp"] + source_features.feature_names)
+                           for source, source_features in self.features_of_source.items())
+
+    def set_data_loggers(self, logger_of_source):
+        self.logger_of_source = logger_of_source
+
+    def set_proxy(self, proxy):
+        self.processing_proxy = proxy
+
+    def add_bioharness_samples(self, stream_prefix, signal_type, timestamps, columns):
+        # the columns of a batch of samples of one Bioharness stream, see BioharnessProtocol.handle_signal_samples
+        source_features = self.features_of_source.get(stream_prefix)
+        if source_features is None or signal_type not in source_features.pending: return
+        source_features.add(signal_type, np.asarray(timestamps, dtype=np.float64), np.column_stack(columns).astype(np.float64))
+
+    def add_E4_chunk(self, client_name, stream_type, rows):
+        # E4 chunk subscriber, see E4ClientFactory.add_chunk_subscriber
+        source_features = self.features_of_source.get("E4_%s" % client_name)
+        if source_features is None or stream_type not in source_features.pending: return
+        source_features.add(stream_type, rows[:, 0], rows[:, 1:])
+
+    def start(self, interval=1.0):
+        self.loop = task.LoopingCall(self.send_features)
+        self.loop.start(interval, now=False)
+
+    def send_features(self):
+        for source, source_features in self.features_of_source.items():
+            source_features.process_pending()
+            if source_features.last_time is None: continue
+            data_logger = self.logger_of_source.get(source)
+            subscribed = self.processing_proxy is not None and self.processing_proxy.subscribed("features", **source_features.packet_fields)
+            if data_logger is None and not subscribed: continue
+            features = source_features.features()
+            if data_logger is not None:
+                data_logger.write_rows([[source_features.last_time] + [features[name] for name in source_features.feature_names]])
+            if subscribed:
+                data = {"type": "features", "timestamp": source_features.last_time}
+                data.update(source_features.packet_fields)
+                # NaN is sent as null
+                data.update((name, None if value != value else value) for name, value in features.items())
+                self.processing_proxy.notifyAll(data)
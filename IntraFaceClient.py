@@ -48,17 +48,23 @@ class IntraFaceServerProtocol(LineReceiver):
         
         head_pitch_rotated = -intraface_sample.head_rotation_pitch+intraface_sample.head_rotation_pitch/np.absolute(intraface_sample.head_rotation_pitch)*180
         self.factory.send_data_for_processing("facial_features",[intraface_sample.neutral, head_pitch_rotated], intraface_sample.timestamp/1000.0)
+        if self.factory.alignment is not None:
+            self.factory.alignment.add_row("INTRA", "INTRA", (intraface_sample.timestamp/1000.0, intraface_sample.neutral, head_pitch_rotated))
 
 class IntraFaceClientFactory(ReconnectingClientFactory):
     
     def __init__(self):
         self.processing_proxy = None
+        self.alignment = None
     
     def set_proxy(self, proxy):
         self.processing_proxy = proxy
 
+    def set_alignment(self, alignment):
+        self.alignment = alignment
+
     def send_data_for_processing(self, type, value, timestamp):
-        if self.processing_proxy is not None:
+        if self.processing_proxy is not None and self.processing_proxy.subscribed(type):
             data = {"type":type, "value": value, "timestamp": timestamp}
             self.processing_proxy.notifyAll(data)
             
@@ -0,0 +1,365 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import json
+import bisect
+import zlib
+import struct
+import threading
+import numpy as np
+
+###
+# Binary Log Files
+# a binary log file starts with a small self-describing header followed by fixed-width records
+#   <magic 8 bytes> <header length, uint32 little endian> <JSON header, padded to 8 bytes> <records...>
+# the JSON header holds the columns of the stream and the numpy dtype of every column
+BINARY_LOG_MAGIC = b"SCBLOG1\n"
+BINARY_LOG_EXTENSION = ".bin"
+INDEX_EXTENSION = ".idx"
+NUMERIC_DTYPE = "<f8"
+# columns stored as fixed-width text and their width in bytes, all other columns are float64
+# extended per server by the "text_columns" key of the storage config
+TEXT_COLUMNS = {"type": 16}
+
+class LogFileException(Exception): pass
+
+def text_dtype(width):
+    return "S%i" % width
+
+class BinaryRecordFormat(object):
+    def __init__(self, columns_list, column_dtypes):
+        self.columns_list = list(columns_list)
+        self.column_dtypes = list(column_dtypes)
+        self.numeric_columns = [dtype == NUMERIC_DTYPE for dtype in self.column_dtypes]
+        self.text_widths = [None if numeric else np.dtype(dtype).itemsize for dtype, numeric in zip(self.column_dtypes, self.numeric_columns)]
+        struct_codes = ["d" if numeric else "%ds" % width for numeric, width in zip(self.numeric_columns, self.text_widths)]
+        self.record_struct = struct.Struct("<" + "".join(struct_codes))
+        self.record_size = self.record_struct.size
+        # text values longer than their column, stored empty instead of cut off
+        self.rejected_texts = 0
+
+    @classmethod
+    def for_columns(cls, columns_list, text_columns=TEXT_COLUMNS):
+        # the types are declared per column name so that they do not depend on the values of the first row
+        column_dtypes = [text_dtype(text_columns[column]) if column in text_columns else NUMERIC_DTYPE for column in columns_list]
+        return cls(columns_list, column_dtypes)
+
+    @classmethod
+    def numeric(cls, columns_list):
+        return cls(columns_list, [NUMERIC_DTYPE] * len(columns_list))
+
+    def numpy_dtype(self):
+        return np.dtype([(str(column), dtype) for column, dtype in zip(self.columns_list, self.column_dtypes)])
+
+    def encode_header(self, stream_name=""):
+        header = {"stream": stream_name,
+                  "columns": self.columns_list,
+                  "dtype": self.column_dtypes,
+                  "record_size": self.record_size}
+        header_bytes = json.dumps(header).encode("utf-8")
+        # pad so that records start 8-byte aligned and can be mapped directly into numpy
+        padding = (-(len(BINARY_LOG_MAGIC) + 4 + len(header_bytes))) % 8
+        header_bytes += b" " * padding
+        return BINARY_LOG_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes
+
+    def encode_numeric(self, value):
+        # missing and unparseable values are stored as NaN
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float("nan")
+
+    def encode_text(self, value, width):
+        if value is None: return b""
+        encoded = value if isinstance(value, bytes) else str(value).encode("utf-8")
+        if len(encoded) > width:
+            self.rejected_texts += 1
+            return b""
+        return encoded
+
+    def encode_row(self, values):
+        # missing trailing values are stored like None
+        values = list(values) + [None] * (len(self.text_widths) - len(values))
+        converted = [self.encode_numeric(value) if width is None else self.encode_text(value, width)
+                     for value, width in zip(values, self.text_widths)]
+        return self.record_struct.pack(*converted)
+
+    def encode_rows(self, rows):
+        return b"".join([self.encode_row(row) for row in rows])
+
+
+def decode_binary_header(data):
+    if data[:len(BINARY_LOG_MAGIC)] != BINARY_LOG_MAGIC:
+        raise LogFileException("Not a binary log file")
+    header_length = struct.unpack_from("<I", data, len(BINARY_LOG_MAGIC))[0]
+    header_start = len(BINARY_LOG_MAGIC) + 4
+    header = json.loads(data[header_start:header_start + header_length].decode("utf-8"))
+    header["data_offset"] = header_start + header_length
+    return header
+
+def read_binary_log_header(path):
+    with open(path, "rb") as log_file:
+        head = log_file.read(len(BINARY_LOG_MAGIC) + 4)
+        if len(head) < len(BINARY_LOG_MAGIC) + 4:
+            raise LogFileException("Binary log file %s has no header" % path)
+        header_length = struct.unpack_from("<I", head, len(BINARY_LOG_MAGIC))[0]
+        return decode_binary_header(head + log_file.read(header_length))
+
+def is_binary_log_file(path):
+    with open(path, "rb") as log_file:
+        return log_file.read(len(BINARY_LOG_MAGIC)) == BINARY_LOG_MAGIC
+
+def load_binary_log(path):
+    # Returns a numpy structured array with one field per column, a trailing partial record (crash) is ignored
+    header = read_binary_log_header(path)
+    record_format = BinaryRecordFormat(header["columns"], header["dtype"])
+    data = np.fromfile(path, dtype=np.uint8, offset=header["data_offset"])
+    complete_records = len(data) // record_format.record_size
+    return data[:complete_records * record_format.record_size].view(record_format.numpy_dtype())
+
+def load_binary_log_columns(path):
+    records = load_binary_log(path)
+    return {name: records[name] for name in records.dtype.names}
+
+
+###
+# Compressed Log Files
+# a compressed CSV log file is a sequence of gzip members, the first holds the header line,
+# every following member holds a batch of rows, so the file as a whole is still a regular gzip file
+# members are decoded one at a time and a member cut off by a crash is left out
+COMPRESSED_LOG_EXTENSION = ".gz"
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def is_compressed_log_file(path):
+    with open(path, "rb") as log_file:
+        return log_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+def iterate_compressed_members(path, start_offset=0, chunk_size=1 << 16):
+    # Yields the decompressed data of each complete member from start_offset, which must be the start of a member
+    with open(path, "rb") as log_file:
+        log_file.seek(start_offset)
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        member = []
+        data = log_file.read(chunk_size)
+        while data:
+            member.append(decompressor.decompress(data))
+            data = b""
+            if decompressor.eof:
+                yield b"".join(member)
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                member = []
+            if not data:
+                data = log_file.read(chunk_size)
+
+def read_csv_header_line(path):
+    if is_compressed_log_file(path):
+        return next(iterate_compressed_members(path), b"")
+    with open(path, "rb") as log_file:
+        return log_file.readline()
+
+def iterate_csv_data(path, start_offset=None, chunk_size=1 << 16):
+    # Yields the CSV data after the header line in chunks, from start_offset if given (the start of a row or member)
+    if is_compressed_log_file(path):
+        members = iterate_compressed_members(path, start_offset or 0, chunk_size)
+        if start_offset is None:
+            next(members, None)
+        for member in members:
+            yield member
+        return
+    with open(path, "rb") as log_file:
+        if start_offset is None:
+            log_file.readline()
+        else:
+            log_file.seek(start_offset)
+        while True:
+            data = log_file.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+###
+# Session Manifest
+# manifest.json in every session folder lists the segments of all streams of the session
+# each segment records its file, first and last timestamp, number of rows and size in bytes
+# it is rewritten atomically whenever a segment is opened or closed, so it survives a crash
+MANIFEST_FILE_NAME = "manifest.json"
+
+class SessionManifest(object):
+    def __init__(self, session_path):
+        self.path = os.path.join(session_path, MANIFEST_FILE_NAME)
+        self.segments = []
+        self.lock = threading.Lock()
+
+    def update_segment(self, segment):
+        with self.lock:
+            if segment not in self.segments:
+                self.segments.append(segment)
+            self.save()
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump({"segments": self.segments}, manifest_file, indent=1)
+        os.replace(temporary_path, self.path)
+
+def read_session_manifest(session_path):
+    with open(os.path.join(session_path, MANIFEST_FILE_NAME)) as manifest_file:
+        return json.load(manifest_file)["segments"]
+
+def segments_of_stream(session_path, stream_name, start=None, end=None):
+    # Returns the segments of a stream in order, only those overlapping [start, end] if a range is given
+    segments = [segment for segment in read_session_manifest(session_path) if segment["stream"] == stream_name]
+    segments.sort(key=lambda segment: segment["index"])
+    if start is not None:
+        segments = [segment for segment in segments if segment["last_timestamp"] is None or segment["last_timestamp"] >= start]
+    if end is not None:
+        segments = [segment for segment in segments if segment["first_timestamp"] is None or segment["first_timestamp"] <= end]
+    return segments
+
+def load_binary_stream(session_path, stream_name):
+    segment_records = [load_binary_log(os.path.join(session_path, segment["file"]))
+                       for segment in segments_of_stream(session_path, stream_name)]
+    return np.concatenate(segment_records) if segment_records else None
+
+
+###
+# Time-range Slices
+# every segment with a timestamp column has a sparse index "<segment>.idx" of "timestamp,byte offset" lines,
+# one for every index_interval rows, a slice seeks to the last indexed row before its start and reads forward
+# until it passes its end, so neither the whole file is scanned nor loaded into memory
+SLICE_CHUNK_SIZE = 1 << 16
+
+def read_index(index_path):
+    timestamps, offsets = [], []
+    if not os.path.exists(index_path):
+        return timestamps, offsets
+    with open(index_path) as index_file:
+        for line in index_file:
+            items = line.split(",")
+            if len(items) != 2 or not line.endswith("\n"): continue
+            timestamps.append(float(items[0]))
+            offsets.append(int(items[1]))
+    return timestamps, offsets
+
+def start_offset_of_slice(index_path, start, data_offset):
+    timestamps, offsets = read_index(index_path)
+    if start is None or not timestamps:
+        return data_offset
+    position = bisect.bisect_left(timestamps, start) - 1
+    return offsets[position] if position >= 0 else data_offset
+
+def timestamp_column_of(columns):
+    lower_case_columns = [str(column).lower() for column in columns]
+    return lower_case_columns.index("timestamp") if "timestamp" in lower_case_columns else None
+
+def format_csv_rows(records):
+    # records is a numpy structured array, text columns are decoded
+    rows = []
+    for record in records.tolist():
+        rows.append(",".join([value.decode("utf-8") if isinstance(value, bytes) else repr(value) for value in record]))
+    return ("\r\n".join(rows) + "\r\n").encode("utf-8") if rows else b""
+
+def iterate_csv_segment_slice(path, index_path, start, end, include_header, chunk_size):
+    header_line = read_csv_header_line(path)
+    columns = header_line.strip().decode("utf-8").split(",")
+    timestamp_column = timestamp_column_of(columns)
+    if include_header:
+        yield header_line
+    remainder = b""
+    for data in iterate_csv_data(path, start_offset_of_slice(index_path, start, None), chunk_size):
+        # a partial last line is still being written
+        lines = (remainder + data).split(b"\n")
+        remainder = lines.pop()
+        selected = []
+        for line in lines:
+            if timestamp_column is not None:
+                # a malformed line (e.g. cut off by a crash) is left out, like in DataLogger.timestamp_of_row
+                try:
+                    timestamp = float(line.split(b",")[timestamp_column])
+                except (IndexError, ValueError):
+                    continue
+                if start is not None and timestamp < start: continue
+                if end is not None and timestamp > end:
+                    if selected: yield b"\n".join(selected) + b"\n"
+                    return
+            selected.append(line)
+        if selected:
+            yield b"\n".join(selected) + b"\n"
+
+def iterate_binary_records(path, start_offset=None, chunk_size=SLICE_CHUNK_SIZE):
+    # Yields (header, records) with numpy structured arrays of about chunk_size bytes
+    header = read_binary_log_header(path)
+    record_format = BinaryRecordFormat(header["columns"], header["dtype"])
+    records_per_chunk = max(1, chunk_size // record_format.record_size)
+    with open(path, "rb") as log_file:
+        log_file.seek(header["data_offset"] if start_offset is None else start_offset)
+        while True:
+            data = log_file.read(records_per_chunk * record_format.record_size)
+            complete_records = len(data) // record_format.record_size
+            if complete_records == 0:
+                return
+            yield header, np.frombuffer(data[:complete_records * record_format.record_size], dtype=record_format.numpy_dtype())
+
+def iterate_binary_segment_slice(path, index_path, start, end, include_header, chunk_size):
+    header = read_binary_log_header(path)
+    timestamp_column = timestamp_column_of(header["columns"])
+    if include_header:
+        yield (",".join(header["columns"]) + "\r\n").encode("utf-8")
+    start_offset = start_offset_of_slice(index_path, start, header["data_offset"])
+    for header, records in iterate_binary_records(path, start_offset, chunk_size):
+        if timestamp_column is None:
+            yield format_csv_rows(records)
+            continue
+        timestamps = records[header["columns"][timestamp_column]]
+        selected = np.ones(len(records), dtype=bool)
+        if start is not None: selected &= timestamps >= start
+        if end is not None: selected &= timestamps <= end
+        yield format_csv_rows(records[selected])
+        if end is not None and timestamps[-1] > end:
+            return
+
+def iterate_stream_slice(session_path, stream_name, start=None, end=None, chunk_size=SLICE_CHUNK_SIZE):
+    # Yields the rows of a stream between start and end (inclusive) as CSV text in chunks of about chunk_size bytes
+    include_header = True
+    for segment in segments_of_stream(session_path, stream_name, start, end):
+        path = os.path.join(session_path, segment["file"])
+        index_path = os.path.join(session_path, segment["index_file"] or (segment["file"] + INDEX_EXTENSION))
+        if not os.path.exists(path): continue
+        if is_binary_log_file(path):
+            slice_chunks = iterate_binary_segment_slice(path, index_path, start, end, include_header, chunk_size)
+        else:
+            slice_chunks = iterate_csv_segment_slice(path, index_path, start, end, include_header, chunk_size)
+        for chunk in slice_chunks:
+            if chunk: yield chunk
+        include_header = False
+
+
+###
+# Row Iteration
+# iterates all rows of a stream over its segments, in the order they were written
+def parse_csv_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return {"True": True, "False": False}.get(value, value)
+
+def iterate_stream_rows(session_path, stream_name, parse_values=True):
+    # Yields each row as a list, with parse_values CSV values are converted like the binary records
+    for segment in segments_of_stream(session_path, stream_name):
+        path = os.path.join(session_path, segment["file"])
+        if not os.path.exists(path): continue
+        if is_binary_log_file(path):
+            for header, records in iterate_binary_records(path):
+                for record in records.tolist():
+                    yield [value.decode("utf-8") if isinstance(value, bytes) else value for value in record]
+            continue
+        remainder = b""
+        for data in iterate_csv_data(path):
+            # a partial last line of a crashed session stays in the remainder
+            lines = (remainder + data).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                values = line.rstrip(b"\r").decode("utf-8").split(",")
+                yield [parse_csv_value(value) for value in values] if parse_values else values
@@ -0,0 +1,159 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import gzip
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+###
+# Log Writer
+# moves all file I/O of the DataLoggers off the reactor thread
+# loggers append rows to a bounded in-memory queue, a dedicated thread drains the queue
+# and writes each logger's rows as one batch, files are flushed (and optionally fsynced) every flush_interval
+#
+# fsync policies: "never" - leave it to the OS, "interval" - fsync on every flush, "close" - fsync when a file is closed
+#
+# compressed loggers hand their batches to a pool of compression threads (zlib releases the GIL while compressing),
+# so compressing one stream does not hold up writing the others
+class LogWriter(object):
+    fsync_policies = ("never", "interval", "close")
+
+    def __init__(self, queue_size=200000, flush_interval=0.5, fsync_policy="close", compression_workers=2, compression_level=6):
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.compression_workers = compression_workers
+        self.compression_level = compression_level
+        self.compression_pool = None
+        self.dropped_rows = 0
+
+        # deque appends and pops are atomic, so the reactor thread never waits for the writer thread
+        self.pending = deque()
+        self.dirty_loggers = set()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def configure(self, writer_config):
+        self.queue_size = writer_config.get("queue_size", self.queue_size)
+        self.flush_interval = writer_config.get("flush_interval", self.flush_interval)
+        self.fsync_policy = writer_config.get("fsync", self.fsync_policy)
+        self.compression_workers = writer_config.get("compression_workers", self.compression_workers)
+        self.compression_level = writer_config.get("compression_level", self.compression_level)
+        assert self.fsync_policy in self.fsync_policies, "Unknown fsync policy %s" % self.fsync_policy
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="LogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Reactor side
+    def write_rows(self, logger, rows):
+        if len(self.pending) >= self.queue_size:
+            previously_dropped = self.dropped_rows
+            self.dropped_rows += len(rows)
+            if previously_dropped == 0 or previously_dropped // 10000 != self.dropped_rows // 10000:
+                logging.warning("LogWriter - Queue is full, %i rows dropped so far" % self.dropped_rows)
+            return False
+        self.pending.append((logger, rows))
+        if len(self.pending) > self.queue_size // 2:
+            self.wakeup.set()
+        return True
+
+    def close_logger(self, logger, wait=True):
+        return self.send_control_message(logger, wait)
+
+    def flush(self, wait=True):
+        return self.send_control_message(None, wait)
+
+    def send_control_message(self, logger, wait):
+        # A control message is ordered with the rows in the queue, when it is handled all earlier rows are on disk
+        done = threading.Event()
+        self.pending.append((logger, done))
+        if not self.is_alive():
+            self.drain()
+            return done
+        self.wakeup.set()
+        if wait:
+            done.wait()
+        return done
+
+    def stop(self):
+        self.flush()
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.compression_pool is not None:
+            self.compression_pool.shutdown()
+
+    # Writer thread side
+    def run(self):
+        last_flush = time.time()
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            flush_files = time.time() - last_flush >= self.flush_interval
+            self.drain(flush_files)
+            if flush_files:
+                last_flush = time.time()
+
+    def drain(self, flush_files=True):
+        batches = {}
+        order = []
+        while self.pending:
+            logger, item = self.pending.popleft()
+            if isinstance(item, threading.Event):
+                # write everything queued before the control message, then flush or close
+                # the event is always set, a caller waiting for it must not hang on a failed flush or close
+                try:
+                    self.write_batches(batches, order)
+                    if logger is None:
+                        self.flush_loggers()
+                    else:
+                        self.close_logger_file(logger)
+                except Exception as e:
+                    logging.error("LogWriter - Failed to %s: %s" % ("flush" if logger is None else "close %s" % logger.path, e))
+                finally:
+                    batches, order = {}, []
+                    item.set()
+                continue
+            if logger not in batches:
+                batches[logger] = []
+                order.append(logger)
+            batches[logger].extend(item)
+        self.write_batches(batches, order)
+        if flush_files:
+            self.flush_loggers()
+
+    def write_batches(self, batches, order):
+        for logger in order:
+            try:
+                logger.write_batch(batches[logger])
+                self.dirty_loggers.add(logger)
+            except Exception as e:
+                logging.error("LogWriter - Failed to write to %s: %s" % (logger.path, e))
+
+    def flush_loggers(self):
+        for logger in self.dirty_loggers:
+            try:
+                logger.flush_file(self.fsync_policy == "interval")
+            except Exception as e:
+                logging.error("LogWriter - Failed to flush %s: %s" % (logger.path, e))
+        self.dirty_loggers.clear()
+
+    def close_logger_file(self, logger):
+        self.dirty_loggers.discard(logger)
+        logger.close_file(self.fsync_policy != "never")
+
+    def compress(self, data):
+        # Returns a future of the data compressed into one gzip member
+        if self.compression_pool is None:
+            self.compression_pool = ThreadPoolExecutor(self.compression_workers, thread_name_prefix="LogCompression")
+        return self.compression_pool.submit(gzip.compress, data, self.compression_level)
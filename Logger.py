@@ -1,15 +1,25 @@
 # © 2017, 2018 published Massachusetts Institute of Technology.
 import os
+import time
 import datetime
 import json
 import logging
 import shlex, subprocess
+from collections import deque
 from twisted.protocols import basic
+from twisted.internet import threads, defer
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
 from BioharnessClient import BioharnessProtocol
 from IntraFaceClient import InrafaceSample
+from LogFiles import BinaryRecordFormat, SessionManifest, BINARY_LOG_EXTENSION, COMPRESSED_LOG_EXTENSION, INDEX_EXTENSION, TEXT_COLUMNS
+from LogWriter import LogWriter
+from SessionConversion import SessionConverter
 import sys 
 
+def wait_for_events(events):
+	for event in events:
+		event.wait()
+
 ###
 # Logger Container
 # contains all loggers of all active sensor streams
@@ -33,6 +43,28 @@ class LoggersContainer(object):
 		self.video_p = None
 		self.record_video = False
 
+		self.storage_formats = {}
+		self.default_storage_format = "csv"
+		self.text_columns = dict(TEXT_COLUMNS)
+
+		self.log_writer = LogWriter()
+		self.log_writer.start()
+		self.session = None
+		self.session_manifest = None
+		self.session_converter = None
+		self.segment_rotation = (None, None)
+		self.index_interval = 1000
+
+		self.session_switch_lock = defer.DeferredLock()
+		self.session_switch_requested_at = None
+		self.session_switch_latency = None
+		self.first_sample_written = None
+
+		# pre-trigger buffers of the streams, they outlive sessions so the seconds before a LOG reach the new files
+		self.pretrigger_seconds = 0
+		self.pretrigger_max_rows = 10000
+		self.pretrigger_buffers = {}
+
 
 	def create_directory_if_does_not_exist(self, folder_path):
 		if os.path.exists(folder_path): return
@@ -55,6 +87,50 @@ class LoggersContainer(object):
 		self.activate_openface = activate_openface
 		self.video_device_id = device_id
 
+	def set_storage_formats(self, storage_config):
+		# storage_config maps a stream key (e.g. "BIO_ecg", "E4_bvp", "INTRA") to "csv", "csv.gz" or "binary"
+		# the key "default" sets the format of all streams that are not listed
+		# the key "text_columns" maps further column names to their width in bytes in binary files
+		storage_config = dict(storage_config)
+		self.default_storage_format = storage_config.pop("default", "csv")
+		self.text_columns.update(storage_config.pop("text_columns", {}))
+		self.storage_formats = storage_config
+
+	def set_segment_rotation(self, rotation_config):
+		# a new segment is started when the open one reaches max_bytes or is older than max_seconds
+		self.segment_rotation = (rotation_config.get("max_bytes"), rotation_config.get("max_seconds"))
+
+	def set_index_interval(self, index_interval):
+		self.index_interval = index_interval
+
+	def set_pretrigger(self, pretrigger_config):
+		# while writing is locked every stream keeps its last seconds of samples, at most max_rows of them
+		self.pretrigger_seconds = pretrigger_config.get("seconds", 0)
+		self.pretrigger_max_rows = pretrigger_config.get("max_rows", self.pretrigger_max_rows)
+		self.pretrigger_buffers = {}
+
+	def set_session_conversion(self, conversion_config):
+		# closed sessions are converted into columnar files by a pool of low priority processes
+		if not conversion_config.get("active", False): return
+		self.session_converter = SessionConverter(conversion_config.get("workers", 2), conversion_config.get("niceness", 10))
+
+	def pretrigger_buffer_of(self, stream_name):
+		if not self.pretrigger_seconds: return None
+		if stream_name not in self.pretrigger_buffers:
+			self.pretrigger_buffers[stream_name] = deque(maxlen=self.pretrigger_max_rows)
+		return self.pretrigger_buffers[stream_name]
+
+	def storage_format_of_stream(self, stream_key):
+		return self.storage_formats.get(stream_key, self.default_storage_format)
+
+	def create_data_logger(self, session, file_prefix, columns_list, stream_key):
+		logger_class = {"csv": DataLogger,
+						"csv.gz": CompressedDataLogger,
+						"binary": BinaryDataLogger}[self.storage_format_of_stream(stream_key)]
+		data_logger = logger_class(session.path, file_prefix, columns_list, self, session.manifest)
+		data_logger.pretrigger = self.pretrigger_buffer_of(file_prefix[:-len(session.output_file_prefix) - 1])
+		return data_logger
+
 	def set_setter_logger_pairs(self, setter_logger_pairs):
 		# setter_logger_pair is a tuple (<logger_setting_funtion>, <logger_name>, <logger_update_function_args>)
 		self.setter_logger_pairs = setter_logger_pairs
@@ -64,58 +140,171 @@ class LoggersContainer(object):
 		if not self.is_write_locked:
 			self.lock_writing_to_log_file()
 
-		# close ongoing session 
+		# close ongoing session, the LogWriter closes its files in the background
 		if self.in_session:
 			self.close_logging_session()
 
-		# Create new folder 
+		session = self.prepare_logging_session(output_file_prefix)
+		self.create_session_files(session)
+		self.activate_logging_session(session)
+
+	def prepare_logging_session(self, output_file_prefix):
+		# Called on the reactor thread, the loggers take the pretrigger buffers and the state of the dispatchers
 		current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-		self.output_file_prefix = output_file_prefix + "_" + current_time
-		self.create_directory_if_does_not_exist(os.path.join(self.data_base_path, self.output_file_prefix))
+		session = LoggingSession(self.data_base_path, output_file_prefix + "_" + current_time)
 
 		# Create loggers for each stream
 		for setter, logger, args in self.setter_logger_pairs:
-			dispatcher = {"E4_loggers_R": self.create_loggers_for_E4_client,
-						  "E4_loggers_L": self.create_loggers_for_E4_client,
+			dispatcher = {"E4_loggers": self.create_loggers_for_E4_client,
 						  "bioharness_loggers": self.create_loggers_for_bioharness,
-						  "intraface_logger": self.create_logger_for_intraface
+						  "intraface_logger": self.create_logger_for_intraface,
+						  "aligned_logger": self.create_logger_for_alignment,
+						  "features_logger": self.create_loggers_for_features
 						  }
-			self.loggers[logger] = dispatcher[logger](args)
+			# every E4 device has its own loggers named E4_loggers_<client>, e.g. E4_loggers_R,
+			# and every Bioharness with a device ID bioharness_loggers_<device_id>
+			logger_type = "E4_loggers" if logger.startswith("E4_loggers_") else logger
+			logger_type = "bioharness_loggers" if logger.startswith("bioharness_loggers_") else logger_type
+			session.loggers[logger] = dispatcher[logger_type](args, session)
+		return session
+
+	def create_session_files(self, session, open_files=False):
+		# Create new folder, with open_files also the first segment of every stream (otherwise the LogWriter opens
+		# the files with the first rows), only touches the files of the session so it can run on a thread
+		self.create_directory_if_does_not_exist(session.path)
+		if open_files:
+			for loggers in session.loggers.values():
+				for data_logger in loggers.values():
+					data_logger.open_segment()
+		return session
+
+	def activate_logging_session(self, session):
+		# All setters are called within one reactor call, so no sample can reach a mix of old and new loggers
+		previous_loggers = self.loggers
+		self.session = session
+		self.output_file_prefix = session.output_file_prefix
+		self.session_manifest = session.manifest
+		self.loggers = session.loggers
+		for setter, logger, args in self.setter_logger_pairs:
 			setter(self.loggers[logger])
 		self.in_session = True
+		return previous_loggers
+
+	def switch_logging_session(self, output_file_prefix):
+		# The next session's loggers are built on the reactor thread, its folder and files are created on a thread
+		# while the current session keeps logging, then the loggers are swapped at once on the reactor thread
+		# and the previous files are closed by the LogWriter in the background
+		return self.session_switch_lock.run(self.stage_logging_session, output_file_prefix)
+
+	def stage_logging_session(self, output_file_prefix):
+		requested_at = time.time()
+		session = self.prepare_logging_session(output_file_prefix)
+		d = threads.deferToThread(self.create_session_files, session, True)
+		d.addCallback(self.swap_logging_session, requested_at)
+		return d
+
+	def swap_logging_session(self, session, requested_at):
+		previous_session = self.session if self.in_session else None
+		previous_loggers = self.activate_logging_session(session)
+		closed = []
+		for loggers in previous_loggers.values():
+			closed.extend(self.close_loggers(loggers, wait=False))
+		if previous_session is not None:
+			self.convert_logging_session(previous_session, closed)
+
+		self.session_switch_requested_at = requested_at
+		self.first_sample_written = defer.Deferred()
+		for loggers in self.loggers.values():
+			for data_logger in loggers.values():
+				data_logger.report_first_sample = True
+		logging.info("LoggersContainer - Switched to session %s, staged in %.1f ms" % (session.output_file_prefix, 1000 * (time.time() - requested_at)))
+		return session
+
+	def first_sample_of_session(self, data_logger):
+		if self.first_sample_written is None: return
+		self.session_switch_latency = time.time() - self.session_switch_requested_at
+		logging.info("LoggersContainer - First sample of session %s written %.1f ms after the command (%s)" % 
+					 (self.output_file_prefix, 1000 * self.session_switch_latency, data_logger.stream_name))
+		first_sample_written, self.first_sample_written = self.first_sample_written, None
+		first_sample_written.callback(self.session_switch_latency)
 		
-	def close_logging_session(self):
+	def close_session_files(self, wait=False):
+		# queue the close of every file first, returns the events the writer sets once it has closed them
+		closed = []
 		for loggers in self.loggers:
-			self.close_loggers(self.loggers[loggers])
-		self.in_session = False
+			closed.extend(self.close_loggers(self.loggers[loggers], wait=False))
+		if wait:
+			wait_for_events(closed)
+		return closed
 
-	def create_loggers_for_E4_client(self, args):
+	def close_logging_session(self):
+		# Returns a Deferred that fires once the writer has flushed and closed every file and the session is converted,
+		# the reactor thread does not wait for the disk
+		d = threads.deferToThread(wait_for_events, self.close_session_files())
+		if not self.in_session: return d
+		self.in_session = False
+		session = self.session
+		d.addCallback(lambda result: self.convert_logging_session(session))
+		return d
+
+	def shutdown(self):
+		# closes the session, waits for its conversion and stops the LogWriter thread and the conversion workers
+		d = self.close_logging_session()
+		d.addBoth(lambda result: self.stop_workers())
+		return d
+
+	def stop_workers(self):
+		self.log_writer.stop()
+		if self.session_converter is not None:
+			self.session_converter.stop()
+
+	def convert_logging_session(self, session, closed_events=()):
+		if self.session_converter is None: return
+		d = self.session_converter.convert_session(session.path, closed_events)
+		d.addErrback(lambda failure: logging.error("LoggersContainer - Conversion of %s failed: %s" % (session.output_file_prefix, failure.getErrorMessage())))
+		return d
+
+	def create_loggers_for_E4_client(self, args, session):
 		E4_loggers = {}
 		client_id, stream_decoder = args
-		for stream_type in self.E4_stream_decoder.possible_streams.keys():
-			file_prefix = "E4_%s_%s_%s" % (client_id, stream_type, self.output_file_prefix)
-			stream_columns =  self.E4_stream_decoder.possible_streams[stream_type].values
-			E4_loggers[stream_type] = DataLogger(os.path.join(self.data_base_path, self.output_file_prefix), file_prefix, 
-												 stream_columns, self)
+		for stream_type in stream_decoder.possible_streams.keys():
+			file_prefix = "E4_%s_%s_%s" % (client_id, stream_type, session.output_file_prefix)
+			stream_columns =  stream_decoder.possible_streams[stream_type].values
+			E4_loggers[stream_type] = self.create_data_logger(session, file_prefix, stream_columns, "E4_%s" % stream_type)
 		return E4_loggers
 
-	def create_loggers_for_bioharness(self, args=None):
+	def create_loggers_for_bioharness(self, args, session):
 		bioharness_loggers = {}
+		stream_prefix = args
 		for stream_type in BioharnessProtocol.columns_of_streams.keys():
-			file_prefix = "BIO_%s_%s" % (stream_type, self.output_file_prefix)
+			file_prefix = "%s_%s_%s" % (stream_prefix, stream_type, session.output_file_prefix)
 			stream_columns = BioharnessProtocol.columns_of_streams[stream_type]
-			bioharness_loggers[stream_type] = DataLogger(os.path.join(self.data_base_path, self.output_file_prefix), file_prefix, 
-														 stream_columns, self)
+			bioharness_loggers[stream_type] = self.create_data_logger(session, file_prefix, stream_columns, "BIO_%s" % stream_type)
 		return bioharness_loggers
 
-	def create_logger_for_intraface(self, args=None):
+	def create_logger_for_intraface(self, args, session):
 		intraface_loggers = {}
-		file_prefix = "INTRA_%s" % (self.output_file_prefix)
+		file_prefix = "INTRA_%s" % (session.output_file_prefix)
 		intraface_columns = InrafaceSample._fields
-		intraface_loggers[0] = DataLogger(os.path.join(self.data_base_path, self.output_file_prefix), file_prefix,
-										   intraface_columns, self) 
+		intraface_loggers[0] = self.create_data_logger(session, file_prefix, intraface_columns, "INTRA")
 		return intraface_loggers
 
+	def create_logger_for_alignment(self, args, session):
+		aligned_loggers = {}
+		time_alignment = args
+		file_prefix = "ALIGNED_%s" % (session.output_file_prefix)
+		aligned_loggers[0] = self.create_data_logger(session, file_prefix, time_alignment.columns(), "ALIGNED")
+		return aligned_loggers
+
+	def create_loggers_for_features(self, args, session):
+		# one file per device, e.g. FEATURES_BIO_<session>, FEATURES_E4_R_<session>
+		features_loggers = {}
+		feature_extraction = args
+		for source, columns in feature_extraction.columns_of_source().items():
+			file_prefix = "FEATURES_%s_%s" % (source, session.output_file_prefix)
+			features_loggers[source] = self.create_data_logger(session, file_prefix, columns, "FEATURES")
+		return features_loggers
+
 	def create_video_recorder(self):
 		self.stop_video_recorder()
 		current_time = datetime.datetime.now().strftime("%H%M%S")
@@ -145,16 +334,25 @@ class LoggersContainer(object):
 
 		
 
+	def stop_video_recorder(self):
+		if self.video_p is not None:
+			self.video_p.terminate()
+			self.video_p = None
+
 	def stop_openface_recorder(self):
 		if self.openface_p is not None:
 			self.openface_p.terminate()
 			self.openface_p = None
 
-	def close_loggers(self, loggers):
-		for logger in loggers.values():
-			logger.close_log_file()
+	def close_loggers(self, loggers, wait=True):
+		return [self.log_writer.close_logger(logger, wait) for logger in loggers.values()]
 
 	def unlock_writing_to_log_file(self):
+		# the buffered pre-roll is queued before any live sample
+		if self.is_write_locked:
+			for loggers in self.loggers.values():
+				for data_logger in loggers.values():
+					data_logger.flush_pretrigger()
 		if self.record_video:
 			self.create_video_recorder()
 		if self.activate_openface:
@@ -196,9 +394,18 @@ class LoggingWebsocketControll(WebSocketServerProtocol):
 		
 	def handle_log_command(self, command): 
 		log_files_prefix = "%s_%s" % (command["subject"],command["name"])
-		self.logger_container.lock_writing_to_log_file()
-		self.logger_container.new_logging_session(log_files_prefix)
+		# the current session keeps logging until the next one is staged
+		d = self.logger_container.switch_logging_session(log_files_prefix)
+		d.addCallback(self.handle_session_switched)
+
+	def handle_session_switched(self, session):
 		self.logger_container.unlock_writing_to_log_file()
+		self.logger_container.first_sample_written.addCallback(self.send_log_started, session)
+
+	def send_log_started(self, latency, session):
+		if self.state != WebSocketServerProtocol.STATE_OPEN: return
+		message = {"type": "LOG_STARTED", "session": session.output_file_prefix, "first_sample_latency": latency}
+		self.sendMessage(json.dumps(message).encode("utf-8"))
 
 		
 	def set_logger_container(self, logger_container):
@@ -234,27 +441,67 @@ class LoggingUserControl(basic.LineReceiver):
 		if "OFF" in line.decode(): 
 			self.container.lock_writing_to_log_file()
 			self.transport.write("LoggingConsolControl: Logging disabled \n".encode("utf-8"))   
-		   
+
+
+###
+# Logging Session
+# the folder, manifest and loggers of one session
+# it is prepared by the Logger Container before it replaces the active session
+class LoggingSession(object):
+	def __init__(self, data_base_path, output_file_prefix):
+		self.output_file_prefix = output_file_prefix
+		self.path = os.path.join(data_base_path, output_file_prefix)
+		self.manifest = SessionManifest(self.path)
+		self.loggers = {}
 
 ###
 # Data Logger
 # is a gerenal class that facilitates data logging of tuples
 # it is created, locked, and unlocked by Logger Container
 # it is used by the associated data stream
+# rows are handed to the LogWriter of the container, which encodes and writes them on its own thread
+# the file is split into segments by size or age if the container sets a segment rotation,
+# every segment is listed in the session manifest with its time range, rows and bytes
 class DataLogger(object):
-	def __init__(self, base_path, file_name, columns_list, container):
-		self.path = os.path.join(base_path, file_name)
-		self.log_file = open(self.path, "a+")
-		self.log_file.write(",".join(columns_list))
-		self.log_file.write("\r\n")
-		logging.debug("Logging incoming data into %s " % self.path)     
+	file_extension = ""
+	# rows are written as UTF-8 bytes, so the index offsets and segment sizes are byte counts on every platform
+	file_mode = "ab"
+	empty_data = b""
+
+	def __init__(self, base_path, file_name, columns_list, container, manifest):
+		self.base_path = base_path
+		self.stream_name = file_name
 		self.columns_list = columns_list
 		self.container = container
-				
+		self.writer = container.log_writer
+		self.manifest = manifest
+		self.report_first_sample = False
+		self.pretrigger = None
+		self.max_segment_bytes, self.max_segment_seconds = container.segment_rotation
+		self.timestamp_column = self.find_timestamp_column(columns_list)
+
+		# Segments are opened by the LogWriter thread when the first rows arrive
+		self.log_file = None
+		self.index_file = None
+		self.index_interval = container.index_interval
+		self.segment = None
+		self.segment_index = -1
+		self.is_closed = False
+		self.path = self.segment_path(0)
+		logging.debug("Logging incoming data into %s " % self.path)     
+
+	@staticmethod
+	def find_timestamp_column(columns_list):
+		lower_case_columns = [str(column).lower() for column in columns_list]
+		return lower_case_columns.index("timestamp") if "timestamp" in lower_case_columns else None
+
+	def segment_path(self, segment_index):
+		if self.max_segment_bytes is None and self.max_segment_seconds is None:
+			return os.path.join(self.base_path, self.stream_name + self.file_extension)
+		return os.path.join(self.base_path, "%s_%04i%s" % (self.stream_name, segment_index, self.file_extension))
 		
 	def write_tuple_to_log_file(self, values_in_tuple, show_on_screen=False):
-		tuple_to_list = [str(value) for value in values_in_tuple]
-		self.write_list_to_log_file(tuple_to_list, show_on_screen)
+		self.write_list_to_log_file(tuple(values_in_tuple), show_on_screen)
 		
 	def write_dict_to_log_file(self, values_in_dictionary, show_on_screen=False):
 		dict_to_list = [values_in_dictionary[key] for key in self.columns_list]
@@ -262,22 +509,227 @@ class DataLogger(object):
 		
 	def write_list_to_log_file(self, values_in_list, show_on_screen=False):
 		if self.container.is_write_locked:
+			self.buffer_rows([values_in_list])
 			return
 		
-		line_to_write = ",".join(values_in_list) + "\r\n"
-
-		self.log_file.write(line_to_write)
+		self.queue_rows([values_in_list])
 		
 		if show_on_screen:
-			logging.debug(line_to_write)
+			logging.debug(values_in_list)
+
+	def write_rows(self, rows):
+		if self.container.is_write_locked:
+			self.buffer_rows(rows)
+			return
+		self.queue_rows(rows)
 			
 	def write_line(self, line):
 		if self.container.is_write_locked:
+			self.buffer_rows([line])
 			return
-		self.log_file.write(line + "\r\n") 
+		self.queue_rows([line])
+
+	def queue_rows(self, rows):
+		if self.report_first_sample:
+			self.report_first_sample = False
+			self.container.first_sample_of_session(self)
+		self.writer.write_rows(self, rows)
+
+	def buffer_rows(self, rows):
+		if self.pretrigger is None: return
+		now = time.time()
+		self.pretrigger.extend([(now, row) for row in rows])
+		horizon = now - self.container.pretrigger_seconds
+		while self.pretrigger and self.pretrigger[0][0] < horizon:
+			self.pretrigger.popleft()
+
+	def flush_pretrigger(self):
+		if not self.pretrigger: return
+		horizon = time.time() - self.container.pretrigger_seconds
+		rows = [row for received_at, row in self.pretrigger if received_at >= horizon]
+		self.pretrigger.clear()
+		if rows:
+			self.queue_rows(rows)
 	
 	def close_log_file(self):
+		# returns once every row written so far is on disk
+		self.writer.close_logger(self)
+
+	# Called on the LogWriter thread
+	def encode_rows(self, rows):
+		return [((row if isinstance(row, str) else ",".join([str(value) for value in row])) + "\r\n").encode("utf-8") for row in rows]
+
+	def write_file_header(self):
+		self.write_to_segment((",".join(self.columns_list) + "\r\n").encode("utf-8"))
+
+	def write_to_segment(self, data):
+		self.log_file.write(data)
+		self.segment["bytes"] += len(data)
+
+	def timestamp_of_row(self, row):
+		if self.timestamp_column is None: return None
+		if isinstance(row, str): row = row.split(",")
+		try:
+			return float(row[self.timestamp_column])
+		except (IndexError, TypeError, ValueError):
+			return None
+
+	def open_segment(self):
+		self.segment_index += 1
+		self.path = self.segment_path(self.segment_index)
+		self.log_file = open(self.path, self.file_mode)
+		self.segment = {"stream": self.stream_name,
+						"index": self.segment_index,
+						"file": os.path.basename(self.path),
+						"index_file": None,
+						"first_timestamp": None,
+						"last_timestamp": None,
+						"rows": 0,
+						"bytes": 0,
+						"closed": False}
+		self.segment_opened_at = time.time()
+		self.write_file_header()
+		# a sparse timestamp -> byte offset index next to the segment, see LogFiles.iterate_stream_slice
+		if self.timestamp_column is not None:
+			self.index_file = open(self.path + INDEX_EXTENSION, "a")
+			self.segment["index_file"] = os.path.basename(self.path + INDEX_EXTENSION)
+		self.manifest.update_segment(self.segment)
+
+	def index_rows(self, rows, encoded_rows):
+		# every index_interval-th row of the segment gets an index entry with the offset where it starts
+		if self.index_file is None: return
+		offset = self.segment["bytes"]
+		position = 0
+		for row_index in range(-self.segment["rows"] % self.index_interval, len(rows), self.index_interval):
+			offset += sum([len(encoded_row) for encoded_row in encoded_rows[position:row_index]])
+			position = row_index
+			timestamp = self.timestamp_of_row(rows[row_index])
+			if timestamp is not None:
+				self.index_file.write("%r,%i\n" % (timestamp, offset))
+
+	def write_batch(self, rows):
+		if self.is_closed: return
+		if self.log_file is None or self.log_file.closed:
+			self.open_segment()
+
+		encoded_rows = self.encode_rows(rows)
+		self.index_rows(rows, encoded_rows)
+		self.write_to_segment(self.empty_data.join(encoded_rows))
+
+		self.segment["rows"] += len(rows)
+		if self.segment["first_timestamp"] is None:
+			self.segment["first_timestamp"] = self.timestamp_of_row(rows[0])
+		self.segment["last_timestamp"] = self.timestamp_of_row(rows[-1])
+
+		if self.segment_is_full():
+			self.close_segment(self.writer.fsync_policy != "never")
+
+	def flush_file(self, fsync):
+		if self.log_file is None or self.log_file.closed: return
 		self.log_file.flush()
+		if self.index_file is not None:
+			self.index_file.flush()
+		if fsync:
+			os.fsync(self.log_file.fileno())
+
+	def segment_is_full(self):
+		if self.max_segment_bytes is not None and self.segment["bytes"] >= self.max_segment_bytes:
+			return True
+		if self.max_segment_seconds is not None and time.time() - self.segment_opened_at >= self.max_segment_seconds:
+			return True
+		return False
+
+	def close_segment(self, fsync):
+		if self.log_file is None:
+			self.open_segment()
+		if self.log_file.closed: return
+		self.finish_file()
+		self.flush_file(fsync)
 		self.log_file.close()
+		if self.index_file is not None:
+			self.index_file.close()
+			self.index_file = None
+		self.segment["closed"] = True
+		self.manifest.update_segment(self.segment)
+
+	def close_file(self, fsync):
+		self.close_segment(fsync)
+		self.is_closed = True
+
+	def finish_file(self):
+		pass
 
 
+###
+# Binary Data Logger
+# stores the same tuples as the DataLogger but as typed fixed-width records (see LogFiles)
+# the column types are declared by column name, text columns are listed in the container's text_columns
+class BinaryDataLogger(DataLogger):
+	file_extension = BINARY_LOG_EXTENSION
+	file_mode = "ab"
+	empty_data = b""
+
+	def __init__(self, base_path, file_name, columns_list, container, manifest):
+		self.record_format = BinaryRecordFormat.for_columns(columns_list, container.text_columns)
+		DataLogger.__init__(self, base_path, file_name, columns_list, container, manifest)
+
+	# Called on the LogWriter thread
+	def write_file_header(self):
+		self.write_to_segment(self.record_format.encode_header(self.stream_name))
+
+	def encode_rows(self, rows):
+		rows = [row.split(",") if isinstance(row, str) else row for row in rows]
+		rejected_texts = self.record_format.rejected_texts
+		encoded_rows = [self.record_format.encode_row(row) for row in rows]
+		if self.record_format.rejected_texts > rejected_texts:
+			logging.warning("BinaryDataLogger - %s: %i text values longer than their column were stored empty" % (self.stream_name, self.record_format.rejected_texts - rejected_texts))
+		return encoded_rows
+
+
+###
+# Compressed Data Logger
+# stores the same CSV rows as the DataLogger in a gzip file
+# every batch of the LogWriter becomes one gzip member, compressed on the LogWriter's compression pool,
+# members are independently decodable so a file cut off by a crash is readable up to its last complete member
+# index entries point at the start of the member that holds the indexed row
+class CompressedDataLogger(DataLogger):
+	file_extension = COMPRESSED_LOG_EXTENSION
+	file_mode = "ab"
+	empty_data = b""
+
+	def __init__(self, base_path, file_name, columns_list, container, manifest):
+		DataLogger.__init__(self, base_path, file_name, columns_list, container, manifest)
+		self.pending_members = deque()
+		self.pending_index_timestamps = []
+
+	# Called on the LogWriter thread
+	def write_to_segment(self, data):
+		compressed = self.writer.compress(data)
+		self.pending_members.append((compressed, self.pending_index_timestamps))
+		self.pending_index_timestamps = []
+		self.write_compressed_members(wait=False)
+
+	def write_compressed_members(self, wait):
+		# members are written in the order they were queued, a long backlog waits for the compression pool
+		while self.pending_members:
+			compressed, index_timestamps = self.pending_members[0]
+			if not (wait or compressed.done() or len(self.pending_members) > 2 * self.writer.compression_workers):
+				return
+			self.pending_members.popleft()
+			member = compressed.result()
+			for timestamp in index_timestamps:
+				self.index_file.write("%r,%i\n" % (timestamp, self.segment["bytes"]))
+			self.log_file.write(member)
+			self.segment["bytes"] += len(member)
+
+	def index_rows(self, rows, encoded_rows):
+		if self.index_file is None: return
+		for row_index in range(-self.segment["rows"] % self.index_interval, len(rows), self.index_interval):
+			timestamp = self.timestamp_of_row(rows[row_index])
+			if timestamp is not None:
+				self.pending_index_timestamps.append(timestamp)
+
+	def flush_file(self, fsync):
+		if self.log_file is None or self.log_file.closed: return
+		self.write_compressed_members(wait=True)
+		DataLogger.flush_file(self, fsync)
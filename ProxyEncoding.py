@@ -0,0 +1,90 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import json
+import math
+import struct
+import numpy as np
+
+###
+# Proxy Encoding
+# encodes the packets of the real-time processing proxy in the encoding a client negotiated as websocket subprotocol
+#   sensor-proxy.json     - JSON text, also used for clients that ask for no subprotocol
+#   sensor-proxy.binary32 - binary message with the arrays of the packet as float32
+#   sensor-proxy.binary64 - binary message with the arrays of the packet as float64
+# a binary message is (little endian)
+#   uint32 length of the header, the header as JSON padded with spaces to end at a multiple of 8 bytes, the arrays
+# the header holds all fields of the packet that are no arrays, plus "dtype" and "arrays": {name: [offset, length]}
+# with offsets counted from the end of the header; every array starts at a multiple of 8 bytes, so a browser can
+# view it without parsing: new Float32Array(message, 4 + header_length + offset, length)
+JSON_ENCODING = "sensor-proxy.json"
+BINARY_ENCODINGS = {
+                    "sensor-proxy.binary32": np.dtype("<f4"),
+                    "sensor-proxy.binary64": np.dtype("<f8"),
+                    }
+PROXY_ENCODINGS = [JSON_ENCODING] + list(BINARY_ENCODINGS)
+
+def array_to_list(array):
+    # NaN, e.g. a grid point of the time alignment without samples, becomes null
+    # the sum of the list is NaN if a value is, which is cheaper to check than np.isnan for arrays this small
+    values = array.tolist()
+    if array.dtype.kind == "f" and math.isnan(sum(values)):
+        values = [None if value != value else value for value in values]
+    return values
+
+def json_default(value):
+    if isinstance(value, np.ndarray):
+        return array_to_list(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def encode_json(data):
+    data = dict((key, array_to_list(value) if isinstance(value, np.ndarray) else value) for key, value in data.items())
+    return json.dumps(data, ensure_ascii=False, default=json_default).encode("utf8")
+
+def encode_binary(data, dtype=BINARY_ENCODINGS["sensor-proxy.binary32"]):
+    header = {"dtype": dtype.name}
+    arrays = []
+    offset = 0
+    array_fields = {}
+    for key, value in data.items():
+        if isinstance(value, (list, tuple, np.ndarray)):
+            try:
+                # None in lists becomes NaN
+                array = np.asarray(value if isinstance(value, np.ndarray) else np.array(value, dtype=np.float64), dtype=dtype).ravel()
+            except (TypeError, ValueError):
+                header[key] = value
+                continue
+            array_fields[key] = [offset, len(array)]
+            arrays.append(array.tobytes())
+            offset += array.nbytes
+            padding = -array.nbytes % 8
+            if padding:
+                arrays.append(b"\0" * padding)
+                offset += padding
+        else:
+            header[key] = value
+    header["arrays"] = array_fields
+    encoded_header = json.dumps(header, ensure_ascii=False, default=json_default).encode("utf8")
+    encoded_header += b" " * (-(4 + len(encoded_header)) % 8)
+    return b"".join([struct.pack("<I", len(encoded_header)), encoded_header] + arrays)
+
+def decode_binary(message):
+    # Returns the packet with its arrays as NumPy arrays
+    header_length, = struct.unpack_from("<I", message)
+    data = json.loads(message[4:4 + header_length].decode("utf8"))
+    dtype = np.dtype(data.pop("dtype")).newbyteorder("<")
+    for key, (offset, length) in data.pop("arrays").items():
+        data[key] = np.frombuffer(message, dtype=dtype, count=length, offset=4 + header_length + offset)
+    return data
+
+def encode_packet(data, encoding):
+    if encoding in BINARY_ENCODINGS:
+        return encode_binary(data, BINARY_ENCODINGS[encoding])
+    return encode_json(data)
+
+def select_encoding(requested_protocols):
+    # the first subprotocol of the client that the proxy speaks, JSON if there is none
+    for protocol in requested_protocols:
+        if protocol in PROXY_ENCODINGS:
+            return protocol
+    return None
@@ -6,18 +6,24 @@ import logging
 import json 
 import sys
 import datetime
+from functools import partial
 from twisted.internet import reactor
 from twisted.internet.serialport import SerialPort
 from twisted.internet import stdio
 from twisted.internet.protocol import ReconnectingClientFactory, Protocol
 from twisted.web.static import File
 from twisted.web.server import Site
-from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
 from Logger import LoggersContainer, DataLogger, LoggingUserControl, LoggingWebsocketControlFactory
 from E4BLEClient import E4ClientFactory
 from BioharnessClient import BioharnessProtocol
 from E4Commands import StreamMessagesDecoder
 from IntraFaceClient import InrafaceSample, IntraFaceClientFactory
+from SessionResource import SessionsResource
+from SessionReplay import SessionReplay
+from TimeAlignment import TimeAlignment
+from FeatureExtraction import FeatureExtraction
+from SensorProxy import SensorProxyFactory, ProxyStatsResource
+from Visualization import Visualization
 
 if getattr(sys, 'frozen', False):
     application_path = os.path.dirname(sys.executable)
@@ -28,48 +34,25 @@ base_path = application_path
 CONFIG_FILE_PATH = os.path.join(base_path, 'main.conf')
 UI_PATH = os.path.join(base_path, 'webfiles/ui')
 
+# Default addresses of the servers and ports, each can be set in main.conf
+DEFAULT_E4_SERVER = {"ip": "127.0.0.1", "port": 28000}
+DEFAULT_INTRAFACE_SERVER = {"ip": "127.0.0.1", "port": 28001}
+DEFAULT_LOGGING_CONTROL_PORT = 55556
+DEFAULT_HTTP_PORT = 9090
+
 def parse_commandline_arguments():
     parser = argparse.ArgumentParser(description='Sensor Collection Server')
     parser.add_argument("-o", dest="output_file_prefix", default="UNNAMED",
                         help="A prefix for the output files generated")
+    parser.add_argument("-c", dest="config_file_path", default=CONFIG_FILE_PATH,
+                        help="Path of the configuration file")
+    parser.add_argument("--replay", dest="replay_path", default=None,
+                        help="Replay a recorded session folder instead of connecting to the sensors")
+    parser.add_argument("--replay-speed", dest="replay_speed", type=float, default=1.0,
+                        help="Replay speed as a multiple of real time, 0 replays as fast as possible")
     return parser.parse_args()
 
 
-class SensorProxyProtocol(WebSocketServerProtocol):
-    def onConnect(self, request):
-        self.peer = request.peer
-        logging.info("Proxy - Received Connection from {}".format(request.peer))
-
-    def onOpen(self):
-        logging.info("Proxy - Connection open.")
-        self.factory.client_list.append(self)
-        
-    def onMessage(self, payload, isBinary):
-        logging.debug("Proxy - Received - %s" % (payload))
-            
-    def onClose(self, wasClean, code, reason):
-        logging.info("Proxy - Connection closed: {0}".format(reason))
-        if self in self.factory.client_list:
-            self.factory.client_list.remove(self)
-
-class SensorProxyFactory(WebSocketServerFactory):
-    def __init__(self, url):
-        WebSocketServerFactory.__init__(self, url)
-        logging.info("Proxy - Real-time processing proxy server started")
-        self.client_list = []
-          
-    def buildProtocol(self, addr):
-        proto = SensorProxyProtocol()
-        proto.factory = self
-        return proto
-
-    def notifyAll(self, data_obj):
-        data = json.dumps(data_obj, ensure_ascii = False).encode('utf8')
-        for cli in self.client_list:
-            #logging.debug("Proxy - Send Data to %s - %s" % (cli.peer, data))
-            cli.sendMessage(data)
-
-        
 def main(command_args, start_logging = False):
     # Setup logging
     #
@@ -82,7 +65,7 @@ def main(command_args, start_logging = False):
     #
     #
     try:
-        configfile = open(CONFIG_FILE_PATH, "rb")
+        configfile = open(command_args.config_file_path, "rb")
         config = json.load(configfile)
         configfile.close()
     except Exception as e:
@@ -92,7 +75,16 @@ def main(command_args, start_logging = False):
     # Edit here what sensors are used
     use_E4_L = "e4l" in config and config["e4l"]["active"]
     use_E4_R = "e4r" in config and config["e4r"]["active"]
+    # e4r and e4l are the right and left hand, picked by their position in the device list unless they have a device_id,
+    # e4devices lists any number of further devices, each with a name and a device_id
+    E4_devices = [(E4_device["name"], E4_device["device_id"]) for E4_device in config.get("e4devices", [])]
+    if use_E4_R: E4_devices.append(("R", config["e4r"].get("device_id")))
+    if use_E4_L: E4_devices.append(("L", config["e4l"].get("device_id")))
     use_Bioharness = "bioharness" in config and config["bioharness"]["active"]
+    # bioharness is a single device logged as BIO_<stream>, bioharnesses lists any number of devices,
+    # each with a device_id and a serial port, logged as BIO_<device_id>_<stream>
+    bioharness_devices = [(bioharness_device["device_id"], bioharness_device["port"]) for bioharness_device in config.get("bioharnesses", [])]
+    if use_Bioharness: bioharness_devices.append((None, config["bioharness"]["port"]))
     use_Intraface = "intraface" in config and config["intraface"]["active"]
     use_video_recorder = "recordvideo" in config and config["recordvideo"]["active"]
     use_Muse = "muse" in config and config["muse"]["active"]
@@ -102,79 +94,134 @@ def main(command_args, start_logging = False):
     use_stereo_recorder = "stereovideo" in config and config["stereovideo"]["active"]
     use_optris_ir_camera = "optris" in config and config["optris"]["active"]
     
-    # Edit here E4 Server information 
-    E4_SERVER_IP = "" 
-    E4_SERVER_PORT = 
+    # E4 Server information 
+    E4_SERVER_IP = config.get("e4server", {}).get("ip", DEFAULT_E4_SERVER["ip"])
+    E4_SERVER_PORT = config.get("e4server", {}).get("port", DEFAULT_E4_SERVER["port"])
     
-    # Edit here Intraface Server information 
-    INTRAFACE_SERVER_IP = ""
-    INTRAFACE_SERVER_PORT = 
+    # Intraface Server information 
+    INTRAFACE_SERVER_IP = config.get("intraface", {}).get("ip", DEFAULT_INTRAFACE_SERVER["ip"])
+    INTRAFACE_SERVER_PORT = config.get("intraface", {}).get("port", DEFAULT_INTRAFACE_SERVER["port"])
     
-    # Edit here port of the websocket for logging command
-    LOGGING_WEB_CONTROL_PORT = 
+    # port of the websocket for logging command
+    LOGGING_WEB_CONTROL_PORT = config.get("loggingcontrol", {}).get("port", DEFAULT_LOGGING_CONTROL_PORT)
     
     # Edit here the pather where the collected data is store
     DATA_BASE_PATH = os.path.join(base_path, config["database"]["path"])
 
     # Setting up data loggers (Note that these are not associated with a client yet)
     loggers_container = LoggersContainer(base_path, DATA_BASE_PATH, lock = not start_logging)
+    loggers_container.set_storage_formats(config["database"].get("storage", {}))
+    loggers_container.log_writer.configure(config["database"].get("writer", {}))
+    loggers_container.set_segment_rotation(config["database"].get("rotation", {}))
+    loggers_container.set_index_interval(config["database"].get("index_interval", 1000))
+    loggers_container.set_pretrigger(config["database"].get("pretrigger", {}))
+    loggers_container.set_session_conversion(config["database"].get("conversion", {}))
     setter_logger_pairs = []
 
     # Setup real-time processing
     real_time_processing_proxy_factory = None
     if use_real_time_processing:
-        # Edit here the port for signal processing server
-        PROCESSING_SERVER_IP = ""
+        # the port for signal processing server
+        PROCESSING_SERVER_IP = config["processing"].get("ip", "127.0.0.1")
         PROCESSING_SERVER_PORT = config["processing"]["port"]
-        real_time_processing_proxy_factory = SensorProxyFactory(u"" % PROCESSING_SERVER_PORT)
+        # every subscriber has a bounded queue for the packets its connection can not take yet
+        real_time_processing_proxy_factory = SensorProxyFactory(u"ws://%s:%i" % (PROCESSING_SERVER_IP, PROCESSING_SERVER_PORT),
+                                                                config["processing"].get("queue_size", 32),
+                                                                config["processing"].get("drop_policy", "drop_oldest"))
         reactor.listenTCP(PROCESSING_SERVER_PORT, real_time_processing_proxy_factory)
+        # recent samples of every stream for charts, reduced to the resolution a visualization subscriber asks for
+        visualization_config = config["processing"].get("visualization", {})
+        real_time_processing_proxy_factory.set_visualization(Visualization(visualization_config.get("capacity", 16384)),
+                                                             visualization_config.get("interval", 0.25))
+
+    # Setup time alignment
+    # selected streams are mapped onto the host clock and resampled onto one time grid, for the proxy and the ALIGNED log file
+    time_alignment = None
+    if "alignment" in config:
+        time_alignment = TimeAlignment(config["alignment"].get("rate", 32), config["alignment"].get("max_delay", 2.0))
+
+    # Setup feature extraction
+    # HRV, breathing rate, movement and EDA of every device, updated as the samples arrive, for the proxy and FEATURES log files
+    feature_extraction = None
+    if "features" in config:
+        feature_extraction = FeatureExtraction(config["features"].get("hrv_window", 60.0), config["features"].get("breathing_window", 30.0),
+                                               config["features"].get("movement_window", 10.0), config["features"].get("eda_window", 10.0))
+
+    # Replaying a recorded session feeds the recorded data through the same protocols instead of the sensors
+    replaying = command_args.replay_path is not None
+    E4_client_factories = {}
 
     # Setup E4
-    if use_E4_L or use_E4_R:
+    # every E4 device gets a client with its own loggers, all clients share one stream decoder
+    if E4_devices:
         # Setting up the E4 stream decoder
         E4_stream_decoder = StreamMessagesDecoder()
+        # Optional chunked ingestion, the samples of each stream are collected in arrays of chunk_size rows
+        E4_ingestion = config.get("e4ingestion", {})
     
-        if use_E4_R:
-            # Initializing one E4 for the Right Hand 
-            client_factory_R = E4ClientFactory()
-            client_factory_R.set_client_id("R")
-            client_factory_R.set_stream_decoder(E4_stream_decoder)
-            # Connecting to the E4 Right Hand
-            E4_client_R = reactor.connectTCP(E4_SERVER_IP, E4_SERVER_PORT , client_factory_R)
-            # Add logger
-            setter_logger_pairs.append((client_factory_R.update_data_loggers,"E4_loggers_R",lambda: loggers_container.add_E4("E4_loggers_R", "R", E4_stream_decoder)))
-
-        if use_E4_L:
-            # Initializing one E4 for the Left Hand 
-            client_factory_L = E4ClientFactory()
-            client_factory_L.set_client_id("L")
-            client_factory_L.set_stream_decoder(E4_stream_decoder)
-            # Connecting to the E4 Left Hand
-            E4_client_L = reactor.connectTCP(E4_SERVER_IP, E4_SERVER_PORT , client_factory_L)  
+        # The alignment and the feature extraction take the E4 samples from the chunks, without e4ingestion they use small chunks
+        E4_chunk_size = E4_ingestion.get("chunk_size") or (16 if time_alignment is not None or feature_extraction is not None else None)
+    
+        for client_name, device_id in E4_devices:
+            client_factory = E4ClientFactory()
+            client_factory.set_client_id(client_name, device_id)
+            client_factory.set_stream_decoder(E4_stream_decoder)
+            if E4_chunk_size:
+                client_factory.set_chunked_ingestion(E4_chunk_size, E4_ingestion.get("flush_interval", 0.25))
+            if time_alignment is not None:
+                for stream_type, data_stream in E4_stream_decoder.possible_streams.items():
+                    time_alignment.register_stream("E4_%s_%s" % (client_name, stream_type), "E4_%s" % client_name, data_stream.values[1:])
+                client_factory.add_chunk_subscriber(partial(time_alignment.add_E4_chunk, client_name))
+            if feature_extraction is not None:
+                feature_extraction.register_E4(client_name)
+                client_factory.add_chunk_subscriber(partial(feature_extraction.add_E4_chunk, client_name))
+            if real_time_processing_proxy_factory is not None:
+                client_factory.set_proxy(real_time_processing_proxy_factory, config["processing"].get("e4_interval", 1.0))
+            E4_client_factories[client_name] = client_factory
+            # Connecting to the E4 
+            if not replaying:
+                reactor.connectTCP(E4_SERVER_IP, E4_SERVER_PORT , client_factory)
             # Add logger
-            setter_logger_pairs.append((client_factory_L.update_data_loggers,"E4_loggers_L", ["L", E4_stream_decoder]))
+            setter_logger_pairs.append((client_factory.update_data_loggers, "E4_loggers_%s" % client_name, [client_name, E4_stream_decoder]))
 
     # Setup Bioharness
-    if use_Bioharness:
+    # every Bioharness gets its own protocol with its own serial port, reconnect loop, buffers and loggers
+    bioharness_protocols = []
+    for bioharness_device_id, bioharness_port in bioharness_devices:
         # Edit here Bioharness Bluetooth port information 
         # pair device with you computer, code 1234
         # ls /dev/cu.* find out with port it is connected to
-        BIOHARNESS_COM_PORT = config["bioharness"]["port"]
         # Initializing the Bioharness
-        bioharness_protocol = BioharnessProtocol(BIOHARNESS_COM_PORT, reactor)
+        bioharness_protocol = BioharnessProtocol(bioharness_port, reactor, bioharness_device_id)
         bioharness_protocol.set_event_callbacks() # Note: that would be the default callback, writing the sample to the appropriate logger
         bioharness_protocol.set_waveform_callbacks() # Note: that would be the default callback, writing the sample to the appropriate logger
-        bioharness_protocol.set_proxy(real_time_processing_proxy_factory)
+        if real_time_processing_proxy_factory is not None:
+            bioharness_protocol.set_proxy(real_time_processing_proxy_factory, config["processing"].get("bioharness_interval", 1.0))
+        if time_alignment is not None:
+            for stream_type, columns in BioharnessProtocol.columns_of_streams.items():
+                if stream_type == "summary": continue
+                time_alignment.register_stream("%s_%s" % (bioharness_protocol.stream_prefix, stream_type), bioharness_protocol.stream_prefix,
+                                               [column.replace("sample_", "") for column in columns[2:]])
+            bioharness_protocol.set_alignment(time_alignment)
+        if feature_extraction is not None:
+            feature_extraction.register_bioharness(bioharness_protocol.stream_prefix, bioharness_device_id)
+            bioharness_protocol.set_features(feature_extraction)
+        bioharness_protocols.append(bioharness_protocol)
         # Add logger
-        setter_logger_pairs.append((bioharness_protocol.set_data_loggers,"bioharness_loggers", None))
+        bioharness_loggers = "bioharness_loggers" if bioharness_device_id is None else "bioharness_loggers_%s" % bioharness_device_id
+        setter_logger_pairs.append((bioharness_protocol.set_data_loggers, bioharness_loggers, bioharness_protocol.stream_prefix))
         # Connecting to the Bioharness
-        bioharness_protocol.reconnect()
+        if not replaying:
+            bioharness_protocol.reconnect()
 
     # Setup Intraface (depreciated)
     if use_Intraface:   
         # Initializing the Intraface
         intraface_factory = IntraFaceClientFactory()
         intraface_factory.set_proxy(real_time_processing_proxy_factory)
+        if time_alignment is not None:
+            time_alignment.register_stream("INTRA", "INTRA", ["neutral", "head_pitch"])
+            intraface_factory.set_alignment(time_alignment)
         # Add logger
         setter_logger_pairs.append((intraface_factory.update_data_logger,"intraface_logger", None))
         # Connecting to the Intraface Server
@@ -202,10 +249,35 @@ def main(command_args, start_logging = False):
     if use_optris_ir_camera:
         loggers_container.set_optris_recorder(True)
 
+    # Start time alignment
+    if time_alignment is not None:
+        time_alignment.select_streams(config["alignment"].get("streams", []))
+        if config["alignment"].get("log", True):
+            setter_logger_pairs.append((time_alignment.set_data_logger, "aligned_logger", time_alignment))
+        time_alignment.set_proxy(real_time_processing_proxy_factory)
+        time_alignment.start(config["alignment"].get("interval", 1.0))
+
+    # Start feature extraction
+    if feature_extraction is not None:
+        if config["features"].get("log", True):
+            setter_logger_pairs.append((feature_extraction.set_data_loggers, "features_logger", feature_extraction))
+        feature_extraction.set_proxy(real_time_processing_proxy_factory)
+        feature_extraction.start(config["features"].get("interval", 1.0))
+
     # Start logger
     loggers_container.set_setter_logger_pairs(setter_logger_pairs)
     loggers_container.new_logging_session(command_args.output_file_prefix)
 
+    # Setup session replay
+    if replaying:
+        replay = SessionReplay(command_args.replay_path, reactor, command_args.replay_speed)
+        for client_id, client_factory in E4_client_factories.items():
+            replay.attach_E4(client_id, client_factory.buildProtocol(None))
+        for bioharness_protocol in bioharness_protocols:
+            replay.attach_bioharness(bioharness_protocol)
+        loggers_container.unlock_writing_to_log_file()
+        replay.start().addCallback(lambda replay: reactor.stop())
+
     # Initializing the LoggingUserControl (Controlling logging from the terminal)
     user_control_protocol = LoggingUserControl()
     user_control_protocol.set_logger_container(loggers_container)
@@ -219,20 +291,27 @@ def main(command_args, start_logging = False):
     # HTTP server
     #
     #
-    HTTP_port = 
+    HTTP_port = config.get("http", {}).get("port", DEFAULT_HTTP_PORT)
     root = File(UI_PATH)
+    root.putChild(b"sessions", SessionsResource(DATA_BASE_PATH))
+    if real_time_processing_proxy_factory is not None:
+        root.putChild(b"proxy", ProxyStatsResource(real_time_processing_proxy_factory))
     HTTP_factory = Site(root)
     logging.debug("SensorCollectionServer - Starting HTTP Server on port %i" % HTTP_port)
     reactor.listenTCP(HTTP_port, HTTP_factory)
     
 
+    # Flush and close all log files and stop the writer before the reactor stops, the shutdown waits for the conversion of the last session
+    reactor.addSystemEventTrigger("before", "shutdown", loggers_container.shutdown)
+
     try:
         logging.debug("SensorCollectionServer - Reactor running")
         reactor.run()
     
     except Exception as e:
         Logging.error(e)
-        loggers_container.close_logging_session()
+        # the reactor is not running anymore, so the files are closed synchronously
+        loggers_container.close_session_files(wait=True)
     
 if __name__ == '__main__':
     command_args = parse_commandline_arguments()
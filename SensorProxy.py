@@ -0,0 +1,398 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import json
+import time
+import logging
+from collections import deque, OrderedDict
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.resource import Resource
+from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+from twisted.internet import task
+from ProxyEncoding import JSON_ENCODING, encode_packet, select_encoding
+from Visualization import VISUALIZATION_MODES
+
+DROP_POLICIES = ["drop_oldest", "latest", "disconnect"]
+
+###
+# Subscriber Queue
+# the packets waiting for one subscriber of the real-time processing proxy while its connection is congested
+#   drop_oldest - a full queue drops its oldest packet
+#   latest      - only the latest packet of every source (type, E4 client, Bioharness device) is kept
+#   disconnect  - a full queue disconnects the subscriber
+# the queue holds at most size packets, None does not bound it
+class SubscriberQueue(object):
+    def __init__(self, size=32, policy="drop_oldest"):
+        self.size = size
+        self.policy = policy
+        self.packets = OrderedDict() if policy == "latest" else deque()
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    def put(self, key, packet):
+        # Returns False if the subscriber has to be disconnected
+        if self.policy == "latest":
+            if key in self.packets:
+                del self.packets[key]
+                self.dropped += 1
+            self.packets[key] = packet
+        else:
+            if self.size is not None and len(self.packets) >= self.size:
+                if self.policy == "disconnect":
+                    self.dropped += len(self.packets) + 1
+                    self.packets.clear()
+                    return False
+                self.packets.popleft()
+                self.dropped += 1
+            self.packets.append(packet)
+        if self.size is not None and len(self.packets) > self.size:
+            self.pop()
+            self.dropped += 1
+        self.max_depth = max(self.max_depth, len(self.packets))
+        return True
+
+    def pop(self):
+        if self.policy == "latest":
+            return self.packets.popitem(last=False)[1]
+        return self.packets.popleft()
+
+
+###
+# Subscription
+# a subscriber's choice of packets, sent as JSON text message
+#   {"type": "subscribe", "source": "bioharness", "device": <optional>, "fields": ["heart_rate"], "rate": 1}
+#   {"type": "subscribe", "source": "e4", "client": "R", "fields": ["bvp", "gsr"]}
+#   {"type": "unsubscribe", "source": "e4", "client": "R"}   - without source every subscription ends
+# source is the type of the packets (bioharness, e4, facial_features, aligned, features), client and device narrow it down,
+# fields select the arrays and values of the packet (all if missing), rate is the maximum packets per second
+# a subscriber that never subscribed gets every packet
+# the visualization source sends buckets of streams for charts, see Visualization, in the resolution asked for
+#   {"type": "subscribe", "source": "visualization", "streams": ["BIO_ecg"], "seconds": 10, "points": 500, "mode": "envelope"}
+PACKET_FIELDS = ["type", "timestamp", "client", "device", "start", "rate"]
+
+class Subscription(object):
+    def __init__(self, source, client=None, device=None, fields=None, rate=None, view=None):
+        self.source = source
+        self.client = client
+        self.device = device
+        self.fields = frozenset(fields) if fields is not None else None
+        self.period = 1.0 / rate if rate else None
+        self.next_due = 0.0
+        # visualization: (streams, seconds, points, mode) and the next bucket to send of every stream
+        self.view = view
+        self.next_bucket_of_stream = {}
+
+    @classmethod
+    def from_message(cls, message):
+        if not isinstance(message.get("source"), str):
+            raise ValueError("A subscription needs a source")
+        fields = message.get("fields")
+        if fields is not None and not (isinstance(fields, list) and all(isinstance(field, str) for field in fields)):
+            raise ValueError("fields has to be a list of field names")
+        rate = message.get("rate")
+        if rate is not None and (not isinstance(rate, (int, float)) or rate <= 0):
+            raise ValueError("rate has to be a positive number")
+        view = None
+        if message["source"] == "visualization":
+            streams, seconds, points = message.get("streams"), message.get("seconds", 10), message.get("points", 500)
+            mode = message.get("mode", "envelope")
+            if not (isinstance(streams, list) and streams and all(isinstance(stream, str) for stream in streams)):
+                raise ValueError("streams has to be a list of stream names")
+            if not isinstance(seconds, (int, float)) or seconds <= 0:
+                raise ValueError("seconds has to be a positive number")
+            if not isinstance(points, int) or not 0 < points <= 10000:
+                raise ValueError("points has to be a number from 1 to 10000")
+            if mode not in VISUALIZATION_MODES:
+                raise ValueError("mode has to be one of %s" % ", ".join(VISUALIZATION_MODES))
+            view = (tuple(streams), float(seconds), points, mode)
+        return cls(message["source"], message.get("client"), message.get("device"), fields, rate, view)
+
+    def key(self):
+        return (self.source, self.client, self.device)
+
+    def matches(self, packet_type, client=None, device=None):
+        return (self.source == packet_type and (self.client is None or self.client == client)
+                and (self.device is None or self.device == device))
+
+    def due(self, now):
+        # packets arrive with some jitter, one that is a tenth of the period early is still sent
+        return self.period is None or now + 0.1 * self.period >= self.next_due
+
+    def mark_sent(self, now):
+        if self.period is not None:
+            self.next_due = max(self.next_due, now - self.period) + self.period
+
+    def to_message(self):
+        message = {"source": self.source, "client": self.client, "device": self.device,
+                   "fields": sorted(self.fields) if self.fields is not None else None,
+                   "rate": 1.0 / self.period if self.period else None}
+        if self.view is not None:
+            message["streams"], message["seconds"], message["points"], message["mode"] = list(self.view[0]), self.view[1], self.view[2], self.view[3]
+        return message
+
+    def visualization_packet(self, buckets_of_stream, now):
+        # the buckets of the view this subscriber has not received, and the number of buckets skipped per stream
+        streams, seconds, points, mode = self.view
+        width = seconds / points
+        data = {"type": "visualization", "timestamp": now, "seconds": seconds, "points": points, "mode": mode, "width": width}
+        skipped = []
+        for stream_name in streams:
+            buckets = buckets_of_stream.get(stream_name)
+            if buckets is None:
+                skipped.append(None)
+                continue
+            first_bucket, arrays = buckets
+            skip = max(self.next_bucket_of_stream.get(stream_name, first_bucket) - first_bucket, 0)
+            skipped.append(skip)
+            if skip >= points: continue
+            self.next_bucket_of_stream[stream_name] = first_bucket + points
+            data["%s_start" % stream_name] = (first_bucket + skip) * width
+            if mode == "envelope":
+                data["%s_min" % stream_name], data["%s_max" % stream_name] = arrays[0][skip:], arrays[1][skip:]
+            else:
+                data[stream_name] = arrays[0][skip:]
+        return tuple(skipped), data
+
+
+###
+# Sensor Proxy
+# websocket server of the real-time processing proxy, every packet is encoded once per encoding in use
+# every subscriber registers as producer of its connection: while the connection's write buffer is full the
+# subscriber is paused and its packets wait in its SubscriberQueue, so a stalled subscriber neither grows the
+# memory of the server nor slows down the others
+# packets are only built and encoded for what at least one subscriber wants, see Subscription
+@implementer(IPushProducer)
+class SensorProxyProtocol(WebSocketServerProtocol):
+    def onConnect(self, request):
+        self.peer = request.peer
+        # clients choose the encoding of the packets as subprotocol, clients without one get JSON
+        protocol = select_encoding(request.protocols)
+        self.encoding = protocol or JSON_ENCODING
+        self.queue = SubscriberQueue(self.factory.queue_size, self.factory.drop_policy)
+        self.paused = False
+        self.sent = 0
+        self.latency_sum = 0.0
+        self.max_latency = 0.0
+        self.subscriptions = None
+        logging.info("Proxy - Received Connection from {} - {}".format(request.peer, self.encoding))
+        return protocol
+
+    def onOpen(self):
+        logging.info("Proxy - Connection open.")
+        self.registerProducer(self, True)
+        self.factory.client_list.append(self)
+
+    def onMessage(self, payload, isBinary):
+        logging.debug("Proxy - Received - %s" % (payload))
+        if isBinary: return
+        try:
+            message = json.loads(payload.decode("utf8"))
+            if message.get("type") == "subscribe":
+                self.subscribe(Subscription.from_message(message))
+            elif message.get("type") == "unsubscribe":
+                self.unsubscribe(message.get("source"), message.get("client"), message.get("device"))
+            else:
+                return
+        except (ValueError, AttributeError) as e:
+            logging.warning("Proxy - Invalid message from %s: %s" % (self.peer, str(e)))
+            self.sendMessage(json.dumps({"type": "error", "message": str(e)}).encode("utf8"))
+            return
+        self.sendMessage(json.dumps({"type": "subscriptions",
+                                     "subscriptions": [subscription.to_message() for subscription in self.subscriptions]}).encode("utf8"))
+
+    def subscribe(self, subscription):
+        # a subscription to the same source, client and device replaces the last one
+        self.subscriptions = [existing for existing in self.subscriptions or [] if existing.key() != subscription.key()]
+        self.subscriptions.append(subscription)
+        logging.info("Proxy - %s subscribed to %s" % (self.peer, subscription.to_message()))
+
+    def unsubscribe(self, source=None, client=None, device=None):
+        self.subscriptions = [subscription for subscription in self.subscriptions or []
+                              if not ((source is None or subscription.source == source) and
+                                      (client is None or subscription.client == client) and
+                                      (device is None or subscription.device == device))]
+        logging.info("Proxy - %s unsubscribed from %s" % (self.peer, source or "everything"))
+
+    def matching_subscriptions(self, packet_type, client=None, device=None, now=None):
+        # the subscriptions a packet is due for now, None if the subscriber wants every packet
+        if self.subscriptions is None: return None
+        now = now if now is not None else time.time()
+        return [subscription for subscription in self.subscriptions
+                if subscription.matches(packet_type, client, device) and subscription.due(now)]
+
+    def selected_fields(self, data_obj, now):
+        # Returns the fields of the packet to send (None for all), or False if the packet is not sent
+        subscriptions = self.matching_subscriptions(data_obj.get("type"), data_obj.get("client"), data_obj.get("device"), now)
+        if subscriptions is None: return None
+        if not subscriptions: return False
+        for subscription in subscriptions:
+            subscription.mark_sent(now)
+        if any(subscription.fields is None for subscription in subscriptions): return None
+        return frozenset().union(*[subscription.fields for subscription in subscriptions])
+
+    def onClose(self, wasClean, code, reason):
+        logging.info("Proxy - Connection closed: {0}".format(reason))
+        if self in self.factory.client_list:
+            self.factory.client_list.remove(self)
+            self.factory.closed_clients_dropped += self.queue.dropped
+            stats = self.stats()
+            logging.info("Proxy - %s sent %i packets, dropped %i, max. queue depth %i, mean send latency %.3f s" %
+                         (self.peer, stats["sent"], stats["dropped"], stats["max_queue_depth"], stats["mean_latency"]))
+
+    def send_packet(self, key, payload, created_at):
+        if not self.paused and not self.queue:
+            self.send_now(payload, created_at)
+        elif not self.queue.put(key, (payload, created_at)):
+            logging.warning("Proxy - %s does not keep up, disconnecting" % self.peer)
+            self.factory.client_list.remove(self)
+            self.factory.closed_clients_dropped += self.queue.dropped
+            self.factory.disconnected_clients += 1
+            self.dropConnection(abort=True)
+
+    def send_now(self, payload, created_at):
+        # sending can pause the subscriber if the write buffer of the connection fills up
+        self.sendMessage(payload, isBinary=self.encoding != JSON_ENCODING)
+        latency = time.time() - created_at
+        self.sent += 1
+        self.latency_sum += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.queue and not self.paused:
+            self.send_now(*self.queue.pop())
+
+    def stopProducing(self):
+        self.paused = True
+
+    def stats(self):
+        return {
+                "peer": self.peer,
+                "encoding": self.encoding,
+                "paused": self.paused,
+                "queue_depth": len(self.queue),
+                "max_queue_depth": self.queue.max_depth,
+                "sent": self.sent,
+                "dropped": self.queue.dropped,
+                "mean_latency": self.latency_sum / self.sent if self.sent else 0.0,
+                "max_latency": self.max_latency,
+                "subscriptions": [subscription.to_message() for subscription in self.subscriptions]
+                                 if self.subscriptions is not None else None,
+                }
+
+class SensorProxyFactory(WebSocketServerFactory):
+    def __init__(self, url, queue_size=32, drop_policy="drop_oldest"):
+        WebSocketServerFactory.__init__(self, url)
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy %s, use one of %s" % (drop_policy, ", ".join(DROP_POLICIES)))
+        logging.info("Proxy - Real-time processing proxy server started")
+        self.client_list = []
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.packets = 0
+        self.disconnected_clients = 0
+        self.closed_clients_dropped = 0
+        self.visualization = None
+        self.visualization_loop = None
+
+    def buildProtocol(self, addr):
+        proto = SensorProxyProtocol()
+        proto.factory = self
+        return proto
+
+    def subscribed(self, packet_type, client=None, device=None):
+        # whether any subscriber wants a packet of this source now, producers skip building it otherwise
+        now = time.time()
+        return any(cli.matching_subscriptions(packet_type, client, device, now) != [] for cli in self.client_list)
+
+    def wanted_fields(self, packet_type, client=None, device=None):
+        # the fields of a packet of this source that the subscribers it is due for want, None for all fields
+        now = time.time()
+        fields = set()
+        for cli in self.client_list:
+            subscriptions = cli.matching_subscriptions(packet_type, client, device, now)
+            if subscriptions is None: return None
+            for subscription in subscriptions:
+                if subscription.fields is None: return None
+                fields.update(subscription.fields)
+        return fields
+
+    def notifyAll(self, data_obj):
+        # every selection of fields is encoded once per packet and encoding
+        self.packets += 1
+        created_at = time.time()
+        key = (data_obj.get("type"), data_obj.get("client"), data_obj.get("device"))
+        encoded = {}
+        for cli in list(self.client_list):
+            fields = cli.selected_fields(data_obj, created_at)
+            if fields is False: continue
+            if (cli.encoding, fields) not in encoded:
+                packet = data_obj if fields is None else dict((name, value) for name, value in data_obj.items()
+                                                              if name in fields or name in PACKET_FIELDS)
+                encoded[(cli.encoding, fields)] = encode_packet(packet, cli.encoding)
+            cli.send_packet(key, encoded[(cli.encoding, fields)], created_at)
+
+    def set_visualization(self, visualization, interval=0.25):
+        # the producers add their samples to the visualization, its buckets are sent every interval
+        self.visualization = visualization
+        self.visualization_loop = task.LoopingCall(self.send_visualization)
+        self.visualization_loop.start(interval, now=False)
+
+    def send_visualization(self):
+        # the buckets of every view are computed once per interval for all subscribers of the view, from the first
+        # bucket one of them has not received on; subscribers that get the same buckets share the encoded packet
+        now = time.time()
+        due_subscriptions = []
+        for cli in list(self.client_list):
+            for subscription in cli.matching_subscriptions("visualization", now=now) or []:
+                subscription.mark_sent(now)
+                due_subscriptions.append((cli, subscription))
+        from_bucket_of_view = {}
+        for cli, subscription in due_subscriptions:
+            for stream_name in subscription.view[0]:
+                next_bucket = subscription.next_bucket_of_stream.get(stream_name)
+                known = from_bucket_of_view.get((subscription.view, stream_name), next_bucket)
+                from_bucket_of_view[(subscription.view, stream_name)] = None if known is None or next_bucket is None else min(known, next_bucket)
+        buckets_of_view = {}
+        encoded = {}
+        for cli, subscription in due_subscriptions:
+            streams, seconds, points, mode = subscription.view
+            if subscription.view not in buckets_of_view:
+                buckets_of_view[subscription.view] = dict((stream_name, self.visualization.buckets(stream_name, seconds, points, mode,
+                                                                                                   from_bucket_of_view[(subscription.view, stream_name)]))
+                                                          for stream_name in streams)
+            skipped, data = subscription.visualization_packet(buckets_of_view[subscription.view], now)
+            if all(skip is None or skip >= points for skip in skipped): continue
+            if (cli.encoding, subscription.view, skipped) not in encoded:
+                encoded[(cli.encoding, subscription.view, skipped)] = encode_packet(data, cli.encoding)
+            cli.send_packet(("visualization", subscription.view), encoded[(cli.encoding, subscription.view, skipped)], now)
+
+    def stats(self):
+        return {
+                "packets": self.packets,
+                "queue_size": self.queue_size,
+                "drop_policy": self.drop_policy,
+                "dropped": self.closed_clients_dropped + sum(cli.queue.dropped for cli in self.client_list),
+                "disconnected_clients": self.disconnected_clients,
+                "clients": [cli.stats() for cli in self.client_list],
+                }
+
+###
+# Proxy Stats Resource
+# HTTP access to the counters of the real-time processing proxy and its subscribers
+#   /proxy - JSON, see SensorProxyFactory.stats
+class ProxyStatsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, proxy_factory):
+        Resource.__init__(self)
+        self.proxy_factory = proxy_factory
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json")
+        return json.dumps(self.proxy_factory.stats()).encode("utf-8")
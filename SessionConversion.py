@@ -0,0 +1,147 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import threads
+from LogFiles import (read_session_manifest, segments_of_stream, load_binary_stream, is_binary_log_file,
+                      read_csv_header_line, iterate_csv_data, timestamp_column_of)
+
+###
+# Session Conversion
+# converts the streams of a closed session into typed columnar NumPy files for analysis
+#   <session>/columnar/<stream>.npz  - one array per column, named like the columns of the stream
+#   <session>/columnar/summary.json  - rows, first and last timestamp and columns of every stream
+# the streams are converted in parallel by a pool of worker processes running at low priority (niceness),
+# so a session that is already recording keeps the CPU
+COLUMNAR_FOLDER_NAME = "columnar"
+CONVERSION_SUMMARY_FILE_NAME = "summary.json"
+
+def lower_process_priority(niceness):
+    # os.nice is not available on Windows, the workers run at normal priority there
+    if hasattr(os, "nice"):
+        os.nice(niceness)
+
+CSV_BOOLEANS = {b"True": b"1", b"False": b"0"}
+
+def parse_column_chunk(values):
+    # a chunk of CSV values (bytes) becomes a float64 array, booleans become 1 and 0 like in LogFiles.parse_csv_value,
+    # or stays a byte string array if any value is not a number
+    chunk = np.array(values)
+    try:
+        return chunk.astype(np.float64)
+    except ValueError:
+        pass
+    try:
+        return np.array([CSV_BOOLEANS.get(value, value) for value in values]).astype(np.float64)
+    except ValueError:
+        return chunk
+
+def concatenate_column_chunks(chunks):
+    if not chunks:
+        return np.empty(0, dtype=np.float64)
+    if all(chunk.dtype == np.float64 for chunk in chunks):
+        return np.concatenate(chunks)
+    return np.concatenate([np.char.decode(chunk, "utf-8") if chunk.dtype.kind == "S" else chunk.astype(str) for chunk in chunks])
+
+def read_csv_stream_columns(session_path, stream_name, columns):
+    # every chunk of CSV data is parsed into one typed array per column, the chunks are concatenated at the end,
+    # so a long stream is never held as Python lists of values
+    column_chunks = [[] for column in columns]
+    for segment in segments_of_stream(session_path, stream_name):
+        path = os.path.join(session_path, segment["file"])
+        if not os.path.exists(path): continue
+        remainder = b""
+        for data in iterate_csv_data(path):
+            # a partial last line of a crashed session stays in the remainder
+            lines = (remainder + data).split(b"\n")
+            remainder = lines.pop()
+            rows = [line.rstrip(b"\r").split(b",") for line in lines]
+            rows = [row for row in rows if len(row) == len(columns)]
+            if not rows: continue
+            for chunks, values in zip(column_chunks, zip(*rows)):
+                chunks.append(parse_column_chunk(values))
+    return [(column, concatenate_column_chunks(chunks)) for column, chunks in zip(columns, column_chunks)]
+
+def read_stream_columns(session_path, stream_name):
+    # Returns an ordered list of (column name, array) of all segments of the stream
+    first_path = os.path.join(session_path, segments_of_stream(session_path, stream_name)[0]["file"])
+    if is_binary_log_file(first_path):
+        records = load_binary_stream(session_path, stream_name)
+        return [(name, records[name].astype(str) if records[name].dtype.kind == "S" else records[name])
+                for name in records.dtype.names]
+    columns = read_csv_header_line(first_path).decode("utf-8").strip().split(",")
+    return read_csv_stream_columns(session_path, stream_name, columns)
+
+def convert_stream(session_path, stream_name):
+    # Runs in a worker process
+    columns = read_stream_columns(session_path, stream_name)
+    output_path = os.path.join(session_path, COLUMNAR_FOLDER_NAME, stream_name + ".npz")
+    np.savez(output_path, **dict(columns))
+
+    rows = len(columns[0][1]) if columns else 0
+    timestamp_column = timestamp_column_of([name for name, array in columns])
+    timestamps = columns[timestamp_column][1] if timestamp_column is not None else None
+    return {"stream": stream_name,
+            "file": os.path.basename(output_path),
+            "columns": [name for name, array in columns],
+            "rows": rows,
+            "first_timestamp": float(timestamps[0]) if rows and timestamps is not None else None,
+            "last_timestamp": float(timestamps[-1]) if rows and timestamps is not None else None}
+
+class SessionConverter(object):
+    def __init__(self, max_workers=2, niceness=10):
+        # created on the main thread at startup, the workers are spawned rather than forked
+        # so they do not inherit locks held by the LogWriter and compression threads
+        self.max_workers = max_workers
+        self.niceness = niceness
+        self.pool = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=lower_process_priority, initargs=(niceness,))
+
+    def convert_session(self, session_path, closed_events=()):
+        # Returns a Deferred firing with the summary once closed_events are set and all streams are converted
+        return threads.deferToThread(self.run_conversion, session_path, closed_events)
+
+    def run_conversion(self, session_path, closed_events=()):
+        for closed in closed_events:
+            closed.wait()
+
+        started_at = time.time()
+        streams = sorted(set(segment["stream"] for segment in read_session_manifest(session_path)))
+        columnar_path = os.path.join(session_path, COLUMNAR_FOLDER_NAME)
+        if not os.path.exists(columnar_path):
+            os.makedirs(columnar_path)
+
+        conversions = [(stream_name, self.pool.submit(convert_stream, session_path, stream_name)) for stream_name in streams]
+        summary = {"session": os.path.basename(os.path.normpath(session_path)), "streams": []}
+        for stream_name, conversion in conversions:
+            try:
+                summary["streams"].append(conversion.result())
+            except Exception as e:
+                logging.error("SessionConversion - Failed to convert %s: %s" % (stream_name, e))
+        with open(os.path.join(columnar_path, CONVERSION_SUMMARY_FILE_NAME), "w") as summary_file:
+            json.dump(summary, summary_file, indent=1)
+        logging.info("SessionConversion - Converted %i streams of %s in %.1f s" % (len(summary["streams"]), summary["session"], time.time() - started_at))
+        return summary
+
+    def stop(self):
+        self.pool.shutdown()
+
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Convert recorded sessions into columnar NumPy files')
+    parser.add_argument("session_paths", nargs="+", help="Session folders")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    converter = SessionConverter(command_args.workers, niceness=0)
+    for session_path in command_args.session_paths:
+        converter.run_conversion(session_path)
+    converter.stop()
@@ -0,0 +1,127 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import time
+import heapq
+import logging
+from twisted.internet import defer
+from zephyr.message import SummaryMessage, SignalSample, AccelerationSignalSample
+from BioharnessClient import BioharnessProtocol
+from LogFiles import read_session_manifest, segments_of_stream, iterate_stream_rows, timestamp_column_of
+
+###
+# Session Replay
+# reads a recorded session folder and feeds its rows back through the live ingestion code
+#   E4 rows are turned back into stream lines and passed to E4Protocol.lineReceived
+#   Bioharness rows are turned back into zephyr samples and passed to the waveform and event handlers
+# so the data reaches the loggers and the real-time processing proxy exactly as if it were live
+# speed is a multiple of real time, 0 replays as fast as possible (in batches, so the reactor keeps serving)
+# every device timestamps with its own clock, so the rows are scheduled by their time since the first sample of their device
+class SessionReplay(object):
+    def __init__(self, session_path, reactor, speed=1.0, batch_size=500):
+        self.session_path = os.path.normpath(session_path)
+        self.session_name = os.path.basename(self.session_path)
+        self.reactor = reactor
+        self.speed = speed
+        self.batch_size = batch_size
+        self.sources = []
+
+        self.replayed_rows = 0
+        self.max_lag = 0.0
+        self.first_timestamp = None
+        self.next_item = None
+
+    def recorded_streams(self):
+        # stream names without the session suffix, e.g. "E4_R_bvp" or "BIO_ecg"
+        suffix = "_" + self.session_name
+        streams = set(segment["stream"] for segment in read_session_manifest(self.session_path))
+        return [stream[:-len(suffix)] for stream in sorted(streams) if stream.endswith(suffix)]
+
+    def add_source(self, stream_name, columns, handler, parse_values=True, clock=None):
+        # clock names the device whose clock timestamps the stream, e.g. "E4_R" or "BIO"
+        stream_name = "%s_%s" % (stream_name, self.session_name)
+        self.sources.append((stream_name, timestamp_column_of(columns), handler, parse_values, clock))
+
+    def first_timestamp_of_stream(self, stream_name):
+        timestamps = [segment["first_timestamp"] for segment in segments_of_stream(self.session_path, stream_name)
+                      if segment["first_timestamp"] is not None]
+        return min(timestamps) if timestamps else None
+
+    def first_timestamps_of_clocks(self):
+        first_timestamps = {}
+        for stream_name, timestamp_column, handler, parse_values, clock in self.sources:
+            timestamp = self.first_timestamp_of_stream(stream_name) if timestamp_column is not None else None
+            if timestamp is not None:
+                first_timestamps[clock] = min(timestamp, first_timestamps.get(clock, timestamp))
+        return first_timestamps
+
+    def attach_E4(self, client_id, protocol):
+        replayed_streams = []
+        for stream in self.recorded_streams():
+            prefix = "E4_%s_" % client_id
+            if not stream.startswith(prefix): continue
+            stream_type = stream[len(prefix):]
+            if stream_type not in protocol.stream_decoder.possible_streams: continue
+            data_stream = protocol.stream_decoder.possible_streams[stream_type]
+            handler = lambda row, stream_prefix=data_stream.stream_type: protocol.lineReceived(" ".join([stream_prefix] + [str(value) for value in row]).encode("utf-8"))
+            self.add_source(stream, data_stream.values, handler, parse_values=False, clock="E4_%s" % client_id)
+            replayed_streams.append(stream_type)
+        protocol.start_without_device(replayed_streams)
+        logging.info("Replay - E4 %s replays streams %s" % (client_id, replayed_streams))
+
+    def attach_bioharness(self, protocol):
+        sample_types = {"summary": SummaryMessage, "acceleration": AccelerationSignalSample}
+        for stream_type, columns in BioharnessProtocol.columns_of_streams.items():
+            if "%s_%s" % (protocol.stream_prefix, stream_type) not in self.recorded_streams(): continue
+            sample_type = sample_types.get(stream_type, SignalSample)
+            if stream_type == "summary":
+                handler = lambda row, sample_type=sample_type: [callback(sample_type(*row)) for callback in protocol.event_callbacks]
+            else:
+                handler = lambda row, sample_type=sample_type: protocol.handle_signal_sample(sample_type(*row))
+            self.add_source("%s_%s" % (protocol.stream_prefix, stream_type), columns, handler, clock=protocol.stream_prefix)
+        logging.info("Replay - Bioharness %s replays session %s" % (protocol.stream_prefix, self.session_name))
+
+    def iterate_source(self, source_index, clock_start):
+        # yields the rows with their time since clock_start, the first sample of the device
+        stream_name, timestamp_column, handler, parse_values, clock = self.sources[source_index]
+        timestamp = 0.0
+        for row in iterate_stream_rows(self.session_path, stream_name, parse_values):
+            if timestamp_column is not None:
+                timestamp = float(row[timestamp_column]) - clock_start
+            yield timestamp, source_index, row
+
+    def start(self):
+        first_timestamps = self.first_timestamps_of_clocks()
+        sources = [self.iterate_source(index, first_timestamps.get(self.sources[index][4], 0.0)) for index in range(len(self.sources))]
+        self.rows = heapq.merge(*sources, key=lambda item: item[0])
+        self.started_at = time.time()
+        self.finished = defer.Deferred()
+        self.reactor.callLater(0, self.replay_next_batch)
+        return self.finished
+
+    def replay_next_batch(self):
+        now = time.time()
+        for _ in range(self.batch_size):
+            item = self.next_item or next(self.rows, None)
+            if item is None:
+                self.finish()
+                return
+            timestamp, source_index, row = item
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            if self.speed > 0:
+                due = self.started_at + (timestamp - self.first_timestamp) / self.speed
+                if due > now:
+                    self.next_item = item
+                    self.reactor.callLater(due - now, self.replay_next_batch)
+                    return
+                self.max_lag = max(self.max_lag, now - due)
+            self.next_item = None
+            self.sources[source_index][2](row)
+            self.replayed_rows += 1
+        self.reactor.callLater(0, self.replay_next_batch)
+
+    def finish(self):
+        elapsed = time.time() - self.started_at
+        logging.info("Replay - Replayed %i rows in %.2f s (%.0f rows/s), maximum lag behind schedule %.3f s" %
+                     (self.replayed_rows, elapsed, self.replayed_rows / max(elapsed, 1e-9), self.max_lag))
+        self.finished.callback(self)
@@ -0,0 +1,167 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import json
+import logging
+from zope.interface import implementer
+from twisted.internet import threads
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.resource import Resource, NoResource
+from twisted.web.server import NOT_DONE_YET
+from LogFiles import MANIFEST_FILE_NAME, INDEX_EXTENSION, read_session_manifest, read_index, iterate_stream_slice
+
+###
+# Session Resources
+# HTTP access to the recorded sessions in the database path
+#   /sessions                                      - JSON list of sessions
+#   /sessions/<session>                            - JSON list of streams with their segments and time ranges
+#   /sessions/<session>/<stream>?start=<s>&end=<s> - CSV rows of the stream in [start, end], streamed in chunks
+# <stream> is the file prefix of the stream with or without the session suffix, e.g. E4_R_gsr
+# with relative=1 start and end are seconds from the first sample of the stream
+def query_argument(request, name, default=None):
+    values = request.args.get(name.encode("utf-8"))
+    return values[0].decode("utf-8") if values else default
+
+def json_response(request, data):
+    request.setHeader(b"content-type", b"application/json")
+    return json.dumps(data).encode("utf-8")
+
+class SessionsResource(Resource):
+    def __init__(self, data_base_path):
+        Resource.__init__(self)
+        self.data_base_path = data_base_path
+
+    def list_sessions(self):
+        if not os.path.isdir(self.data_base_path): return []
+        return sorted([name for name in os.listdir(self.data_base_path)
+                       if os.path.exists(os.path.join(self.data_base_path, name, MANIFEST_FILE_NAME))])
+
+    def render_GET(self, request):
+        return json_response(request, {"sessions": self.list_sessions()})
+
+    def getChild(self, name, request):
+        name = name.decode("utf-8")
+        if not name:
+            return self
+        if name not in self.list_sessions():
+            return NoResource("Unknown session %s" % name)
+        return SessionResource(name, os.path.join(self.data_base_path, name))
+
+class SessionResource(Resource):
+    def __init__(self, session_name, session_path):
+        Resource.__init__(self)
+        self.session_name = session_name
+        self.session_path = session_path
+
+    def streams(self):
+        streams = {}
+        for segment in read_session_manifest(self.session_path):
+            streams.setdefault(segment["stream"], []).append(segment)
+        return streams
+
+    def render_GET(self, request):
+        return json_response(request, {"session": self.session_name, "streams": self.streams()})
+
+    def getChild(self, name, request):
+        name = name.decode("utf-8")
+        streams = self.streams()
+        for stream_name in (name, "%s_%s" % (name, self.session_name)):
+            if stream_name in streams:
+                return StreamSliceResource(self.session_path, stream_name, streams[stream_name])
+        return NoResource("Unknown stream %s" % name)
+
+class StreamSliceResource(Resource):
+    isLeaf = True
+
+    def __init__(self, session_path, stream_name, segments):
+        Resource.__init__(self)
+        self.session_path = session_path
+        self.stream_name = stream_name
+        self.segments = sorted(segments, key=lambda segment: segment["index"])
+
+    def first_timestamp(self):
+        first_segment = self.segments[0]
+        if first_segment["first_timestamp"] is not None:
+            return first_segment["first_timestamp"]
+        # the first segment is still open, its first row is always indexed
+        index_file = first_segment["index_file"] or (first_segment["file"] + INDEX_EXTENSION)
+        timestamps, offsets = read_index(os.path.join(self.session_path, index_file))
+        return timestamps[0] if timestamps else 0.0
+
+    def render_GET(self, request):
+        try:
+            start = query_argument(request, "start")
+            end = query_argument(request, "end")
+            start = float(start) if start is not None else None
+            end = float(end) if end is not None else None
+        except ValueError:
+            request.setResponseCode(400)
+            return b"start and end must be numbers"
+
+        if query_argument(request, "relative", "0") not in ("0", "false"):
+            first_timestamp = self.first_timestamp()
+            start = first_timestamp + start if start is not None else None
+            end = first_timestamp + end if end is not None else None
+
+        request.setHeader(b"content-type", b"text/csv")
+        producer = StreamSliceProducer(request, iterate_stream_slice(self.session_path, self.stream_name, start, end))
+        producer.start()
+        return NOT_DONE_YET
+
+###
+# Stream Slice Producer
+# reads the chunks of a slice on the reactor's thread pool and writes them to the request one at a time,
+# the transfer is chunked and paused while the client does not keep up
+@implementer(IPushProducer)
+class StreamSliceProducer(object):
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+        self.paused = False
+        self.reading = False
+        self.stopped = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(lambda failure: self.stopProducing())
+        self.read_next_chunk()
+
+    def read_next_chunk(self):
+        if self.paused or self.reading or self.stopped: return
+        self.reading = True
+        d = threads.deferToThread(next, self.chunks, None)
+        d.addCallbacks(self.chunk_read, self.read_failed)
+
+    def chunk_read(self, chunk):
+        self.reading = False
+        if self.stopped:
+            self.chunks.close()
+            return
+        if chunk is None:
+            self.finish()
+            return
+        self.request.write(chunk)
+        self.read_next_chunk()
+
+    def read_failed(self, failure):
+        self.reading = False
+        logging.error("SessionResource - Failed to read stream slice: %s" % failure.getErrorMessage())
+        self.finish()
+
+    def finish(self):
+        if self.stopped: return
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.read_next_chunk()
+
+    def stopProducing(self):
+        self.stopped = True
+        # the generator can only be closed while no thread is reading from it
+        if not self.reading:
+            self.chunks.close()
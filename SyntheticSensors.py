@@ -0,0 +1,254 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import math
+import time
+import struct
+import logging
+import argparse
+import datetime
+from twisted.internet import task, reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+###
+# Synthetic Sensors
+# local stand-ins for the sensors that speak the real protocols, used by the benchmarks and for testing without hardware
+#   FakeE4Server     - an E4 streaming server answering the E4Commands command set and streaming E4_* lines
+#   FakeBioharness   - a pseudo terminal that emits zephyr message frames like a Bioharness on a serial port
+# samples carry the host time at which they were generated, so latencies can be measured downstream
+# rate_multiplier scales all sample rates, e.g. for finding the point where data starts to drop
+# response_delay delays the E4 command responses like the Bluetooth round trip of a real device
+
+E4_STREAMS = {
+              # stream: (line prefix, samples per second, number of values)
+              "acc": ("E4_Acc", 32, 3),
+              "bvp": ("E4_Bvp", 64, 1),
+              "gsr": ("E4_Gsr", 4, 1),
+              "tmp": ("E4_Temperature", 4, 1),
+              "ibi": ("E4_Ibi", 1, 1),
+              "hr":  ("E4_Hr", 1, 1),
+              "bat": ("E4_Battery", 0.1, 1),
+              "tag": ("E4_Tag", 0, 0),
+              }
+
+class FakeE4Protocol(LineReceiver):
+    delimiter = b"\n"
+
+    def connectionMade(self):
+        self.device = None
+        self.subscribed_streams = []
+        self.streaming = False
+        self.sent_samples = dict((stream, 0) for stream in E4_STREAMS)
+        self.loop = task.LoopingCall(self.send_samples)
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self.loop.running:
+            self.loop.stop()
+        if self in self.factory.connections:
+            self.factory.connections.remove(self)
+
+    def send_line(self, line):
+        self.transport.write(line.encode("utf-8") + b"\n")
+
+    def lineReceived(self, line):
+        if self.factory.response_delay > 0:
+            reactor.callLater(self.factory.response_delay, self.handle_command, line)
+        else:
+            self.handle_command(line)
+
+    def handle_command(self, line):
+        if not self.transport.connected: return
+        arguments = line.decode("utf-8").strip().split(" ")
+        command = arguments[0]
+        if command == "server_status":
+            self.send_line("R system_status OK")
+        elif command == "device_list":
+            devices = ["| %s Empatica_E4 E4_%s available" % (device_id, device_id) for device_id in self.factory.device_ids]
+            self.send_line(" ".join(["R device_list %i" % len(devices)] + devices))
+        elif command == "device_connect":
+            self.device = arguments[1]
+            self.send_line("R device_connect OK")
+        elif command == "device_disconnect":
+            self.device = None
+            self.send_line("R device_disconnect OK")
+        elif command == "device_subscribe":
+            if arguments[2] == "ON":
+                self.subscribed_streams.append(arguments[1])
+            elif arguments[1] in self.subscribed_streams:
+                self.subscribed_streams.remove(arguments[1])
+            self.send_line("R device_subscribe %s OK" % arguments[1])
+        elif command == "pause":
+            self.send_line("R pause OK")
+            self.set_streaming(arguments[1] == "OFF")
+        else:
+            self.send_line("R %s ERR unknown_command" % command)
+
+    def set_streaming(self, streaming):
+        self.streaming = streaming
+        if streaming and not self.loop.running:
+            self.started_at = time.time()
+            self.sent_samples = dict((stream, 0) for stream in E4_STREAMS)
+            self.loop.start(self.factory.tick_interval, now=False)
+        elif not streaming and self.loop.running:
+            self.loop.stop()
+
+    def send_samples(self):
+        now = time.time()
+        lines = []
+        for stream in self.subscribed_streams:
+            prefix, rate, number_of_values = E4_STREAMS[stream]
+            due_samples = int((now - self.started_at) * rate * self.factory.rate_multiplier)
+            for sample_index in range(self.sent_samples[stream], due_samples):
+                values = ["%.3f" % (math.sin(sample_index * 0.1 + value_index)) for value_index in range(number_of_values)]
+                lines.append(" ".join([prefix, "%.6f" % now] + values))
+            self.factory.sent_samples += max(0, due_samples - self.sent_samples[stream])
+            self.sent_samples[stream] = max(self.sent_samples[stream], due_samples)
+        if lines:
+            self.transport.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+class FakeE4Server(Factory):
+    protocol = FakeE4Protocol
+
+    def __init__(self, device_ids=("A00001", "A00002"), rate_multiplier=1.0, tick_interval=0.01, response_delay=0.0):
+        self.device_ids = list(device_ids)
+        self.rate_multiplier = rate_multiplier
+        self.tick_interval = tick_interval
+        self.response_delay = response_delay
+        self.connections = []
+        self.sent_samples = 0
+
+    def drop_connections(self):
+        # like the streaming server losing its clients, they have to reconnect and resubscribe
+        for connection in list(self.connections):
+            connection.transport.loseConnection()
+
+###
+# Fake Bioharness
+# writes zephyr message frames (STX, message id, DLC, payload, CRC-8, ETX) into the master side of a pseudo terminal,
+# the server opens the slave side as its serial port. Payloads follow the BioHarness Bluetooth comms link spec:
+# sequence number, timestamp (year, month, day, milliseconds of day) and 10-bit packed samples
+BIOHARNESS_PACKETS = {
+                      # stream: (message id, samples per packet, samples per second, values per sample)
+                      "ecg": (0x22, 63, 250, 1),
+                      "breathing": (0x21, 18, 18, 1),
+                      "acceleration": (0x25, 20, 50, 3),
+                      }
+BIOHARNESS_RR_MESSAGE_ID = 0x24
+BIOHARNESS_SUMMARY_MESSAGE_ID = 0x2B
+SUMMARY_PAYLOAD_LENGTH = 71
+
+def crc_8(payload):
+    crc = 0
+    for byte in bytearray(payload):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8C if crc & 1 else crc >> 1
+    return crc
+
+def create_frame(message_id, payload):
+    return bytes(bytearray([0x02, message_id, len(payload)]) + bytearray(payload) + bytearray([crc_8(payload), 0x03]))
+
+def pack_10bit_samples(samples):
+    packed = 0
+    for sample_index, sample in enumerate(samples):
+        packed |= (int(sample) & 0x3FF) << (10 * sample_index)
+    return packed.to_bytes((10 * len(samples) + 7) // 8, "little")
+
+def zephyr_timestamp(timestamp):
+    moment = datetime.datetime.fromtimestamp(timestamp)
+    milliseconds_of_day = int(((moment.hour * 60 + moment.minute) * 60 + moment.second) * 1000 + moment.microsecond / 1000)
+    return struct.pack("<HBBI", moment.year, moment.month, moment.day, milliseconds_of_day)
+
+class FakeBioharness(object):
+    def __init__(self, reactor, rate_multiplier=1.0, tick_interval=0.01):
+        self.reactor = reactor
+        self.rate_multiplier = rate_multiplier
+        self.tick_interval = tick_interval
+        self.master_fd, self.slave_fd = os.openpty()
+        self.port = os.ttyname(self.slave_fd)
+        # frames the server has not read yet are kept, the fake never blocks the benchmark's reactor
+        os.set_blocking(self.master_fd, False)
+        self.unsent_data = b""
+        self.sequence_number = 0
+        self.sent_samples = 0
+        self.sent_packets = dict((stream, 0) for stream in list(BIOHARNESS_PACKETS) + ["rr", "summary"])
+        self.loop = task.LoopingCall(self.send_packets)
+
+    def start(self):
+        self.started_at = time.time()
+        self.loop.start(self.tick_interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def next_header(self, timestamp):
+        self.sequence_number = (self.sequence_number + 1) % 256
+        return struct.pack("<B", self.sequence_number) + zephyr_timestamp(timestamp)
+
+    def summary_payload(self, timestamp):
+        payload = bytearray(SUMMARY_PAYLOAD_LENGTH)
+        payload[0:9] = self.next_header(timestamp)
+        # version, heart rate (bpm) and respiration rate (0.1 breaths per minute)
+        payload[9] = 1
+        payload[10:12] = struct.pack("<H", 70)
+        payload[12:14] = struct.pack("<H", 150)
+        return bytes(payload)
+
+    def send_packets(self):
+        now = time.time()
+        elapsed = (now - self.started_at) * self.rate_multiplier
+        frames = []
+        for stream, (message_id, samples_per_packet, rate, values_per_sample) in BIOHARNESS_PACKETS.items():
+            due_packets = int(elapsed * rate / samples_per_packet)
+            for packet_index in range(self.sent_packets[stream], due_packets):
+                samples = [512 + int(200 * math.sin((packet_index * samples_per_packet + sample_index) * 0.05))
+                           for sample_index in range(samples_per_packet * values_per_sample)]
+                frames.append(create_frame(message_id, self.next_header(now) + pack_10bit_samples(samples)))
+                self.sent_samples += samples_per_packet
+            self.sent_packets[stream] = max(self.sent_packets[stream], due_packets)
+
+        # one RR packet with 18 samples and one summary packet per second, the 857 ms interval toggles its sign with every beat
+        for packet_index in range(self.sent_packets["rr"], int(elapsed)):
+            rr_samples = [857 if int((packet_index + sample_index / 18.0) / 0.857) % 2 == 0 else -857 for sample_index in range(18)]
+            frames.append(create_frame(BIOHARNESS_RR_MESSAGE_ID, self.next_header(now) + struct.pack("<18h", *rr_samples)))
+            frames.append(create_frame(BIOHARNESS_SUMMARY_MESSAGE_ID, self.summary_payload(now)))
+            self.sent_samples += 19
+        self.sent_packets["rr"] = max(self.sent_packets["rr"], int(elapsed))
+
+        self.unsent_data += b"".join(frames)
+        if not self.unsent_data: return
+        try:
+            written_bytes = os.write(self.master_fd, self.unsent_data)
+        except BlockingIOError:
+            written_bytes = 0
+        self.unsent_data = self.unsent_data[written_bytes:]
+
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Synthetic sensors for the Sensor Collection Server')
+    parser.add_argument("--e4-port", dest="e4_port", type=int, default=28000,
+                        help="Port of the fake E4 streaming server")
+    parser.add_argument("--e4-devices", dest="e4_devices", default="A00001,A00002",
+                        help="Comma separated device IDs of the fake E4 server")
+    parser.add_argument("--bioharness", dest="bioharness", action="store_true",
+                        help="Also start a fake Bioharness on a pseudo terminal")
+    parser.add_argument("--rate", dest="rate_multiplier", type=float, default=1.0,
+                        help="Multiplier of all sample rates")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    from twisted.internet import reactor
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    e4_server = FakeE4Server(command_args.e4_devices.split(","), command_args.rate_multiplier)
+    reactor.listenTCP(command_args.e4_port, e4_server)
+    logging.info("SyntheticSensors - Fake E4 server listening on port %i" % command_args.e4_port)
+    if command_args.bioharness:
+        bioharness = FakeBioharness(reactor, command_args.rate_multiplier)
+        bioharness.start()
+        logging.info("SyntheticSensors - Fake Bioharness on serial port %s" % bioharness.port)
+    reactor.run()
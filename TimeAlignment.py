@@ -0,0 +1,197 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import math
+import time
+import logging
+import numpy as np
+from collections import deque, OrderedDict
+from twisted.internet import task
+
+###
+# Source Clock
+# tracks the clock of one sensor source (an E4 device, the Bioharness, IntraFace) against the host clock
+#   host time = source time + offset + drift * (source time - reference)
+# every sample arrives after its source time plus a variable transport delay, so the smallest difference
+# host - source of each window approximates the offset; a line fitted through the minima of the last windows
+# gives offset and drift
+class SourceClock(object):
+    def __init__(self, window_seconds=1.0, windows=60):
+        self.window_seconds = window_seconds
+        self.minima = deque(maxlen=windows)
+        self.reference = None
+        self.offset = None
+        self.drift = 0.0
+        self.window_start = None
+        self.window_minimum = None
+
+    def observe(self, source_time, host_time):
+        # source_time is the newest sample received at host_time
+        difference = host_time - source_time
+        if self.reference is None:
+            self.reference = source_time
+            self.window_start = source_time
+        if source_time - self.window_start >= self.window_seconds:
+            self.minima.append((self.window_start, self.window_minimum))
+            self.window_start = source_time
+            self.window_minimum = None
+            self.fit()
+        if self.window_minimum is None or difference < self.window_minimum:
+            self.window_minimum = difference
+        # until two windows are complete the smallest difference seen is the offset
+        if len(self.minima) < 2 and (self.offset is None or difference < self.offset):
+            self.offset = difference
+
+    def fit(self):
+        if len(self.minima) < 2: return
+        window_starts, minima = np.array(self.minima).T
+        drift, offset = np.polyfit(window_starts - self.reference, minima, 1)
+        self.drift, self.offset = float(drift), float(offset)
+
+    def to_host_time(self, source_times):
+        return source_times + self.offset + self.drift * (source_times - self.reference)
+
+
+###
+# Aligned Stream
+# the samples of one stream in host time that are still needed for resampling,
+# rows added since the last resampling are collected and converted to arrays once per resampling
+class AlignedStream(object):
+    def __init__(self, stream_name, source, columns):
+        self.stream_name = stream_name
+        self.source = source
+        self.columns = columns
+        self.times = np.empty(0)
+        self.values = np.empty((0, len(columns)))
+        self.pending = []
+
+    def add_rows(self, times, values):
+        self.pending.append((times, values))
+
+    def collect_pending(self):
+        if not self.pending: return
+        times = np.concatenate([self.times] + [times for times, values in self.pending])
+        values = np.concatenate([self.values] + [values for times, values in self.pending])
+        self.pending = []
+        # a refitted clock can move samples before ones already seen, the time axis has to stay increasing
+        increasing = times > np.maximum.accumulate(np.concatenate(([-np.inf], times[:-1])))
+        self.times, self.values = times[increasing], values[increasing]
+
+    def last_time(self):
+        return self.times[-1] if len(self.times) else None
+
+    def resample(self, grid):
+        # linear interpolation, NaN before the first and after the last sample of the stream
+        if not len(self.times):
+            return np.full((len(grid), len(self.columns)), np.nan)
+        resampled = np.column_stack([np.interp(grid, self.times, self.values[:, column], left=np.nan, right=np.nan)
+                                     for column in range(len(self.columns))])
+        # only the last sample before the last grid point is needed for the next grid points
+        keep_from = max(0, int(np.searchsorted(self.times, grid[-1], side="right")) - 1)
+        self.times, self.values = self.times[keep_from:], self.values[keep_from:]
+        return resampled
+
+
+###
+# Time Alignment
+# maps the samples of selected streams onto the host clock and resamples them onto one common time grid (rate in Hz)
+# the grid advances every interval seconds up to the time all selected streams have reached,
+# but at most max_delay seconds behind the host clock, streams without samples there are NaN
+# the aligned rows are written to the ALIGNED log file and sent to the real-time processing proxy:
+#   {"type": "aligned", "timestamp": <last grid time>, "start": <first grid time>, "rate": 32, "E4_R_bvp": [...], "BIO_acceleration_x": [...], ...}
+class TimeAlignment(object):
+    def __init__(self, rate=32.0, max_delay=2.0):
+        self.rate = float(rate)
+        self.max_delay = max_delay
+        self.clock_of_source = {}
+        self.registered_streams = OrderedDict()
+        self.aligned_streams = OrderedDict()
+        self.next_grid_index = None
+        self.data_logger = None
+        self.processing_proxy = None
+        self.loop = None
+
+    def register_stream(self, stream_name, source, columns):
+        # stream_name is the file prefix of the stream, e.g. "E4_R_bvp", source names the clock, e.g. "E4_R"
+        self.registered_streams[stream_name] = (source, list(columns))
+
+    def select_streams(self, stream_names):
+        for stream_name in stream_names:
+            if stream_name not in self.registered_streams:
+                logging.warning("TimeAlignment - Stream %s is not recorded and can not be aligned" % stream_name)
+                continue
+            source, columns = self.registered_streams[stream_name]
+            self.aligned_streams[stream_name] = AlignedStream(stream_name, source, columns)
+
+    def columns(self):
+        # a stream with one value is named like the stream, with several values like the stream and the value
+        columns = ["timestamp"]
+        for stream_name, aligned_stream in self.aligned_streams.items():
+            if len(aligned_stream.columns) == 1:
+                columns.append(stream_name)
+            else:
+                columns.extend(["%s_%s" % (stream_name, column.lower()) for column in aligned_stream.columns])
+        return columns
+
+    def set_data_logger(self, logger):
+        self.data_logger = logger[0]
+
+    def set_proxy(self, proxy):
+        self.processing_proxy = proxy
+
+    def clock_of(self, source):
+        if source not in self.clock_of_source:
+            self.clock_of_source[source] = SourceClock()
+        return self.clock_of_source[source]
+
+    def add_rows(self, source, stream_name, rows, received_at=None):
+        # rows are (source timestamp, values...) of one stream received at once, e.g. an E4 chunk
+        rows = np.asarray(rows, dtype=np.float64)
+        if not len(rows): return
+        clock = self.clock_of(source)
+        clock.observe(rows[-1, 0], received_at if received_at is not None else time.time())
+        aligned_stream = self.aligned_streams.get(stream_name)
+        if aligned_stream is None: return
+        aligned_stream.add_rows(clock.to_host_time(rows[:, 0]), rows[:, 1:])
+
+    def add_row(self, source, stream_name, row, received_at=None):
+        self.add_rows(source, stream_name, [row], received_at)
+
+    def add_E4_chunk(self, client_name, stream_type, rows):
+        # E4 chunk subscriber, see E4ClientFactory.add_chunk_subscriber
+        self.add_rows("E4_%s" % client_name, "E4_%s_%s" % (client_name, stream_type), rows)
+
+    def advance(self, now=None):
+        # Returns the rows of the grid points that are complete, or None
+        now = now if now is not None else time.time()
+        for aligned_stream in self.aligned_streams.values():
+            aligned_stream.collect_pending()
+        last_times = [aligned_stream.last_time() for aligned_stream in self.aligned_streams.values()]
+        last_times = [last_time for last_time in last_times if last_time is not None]
+        if not last_times: return None
+        horizon = min(max(min(last_times), now - self.max_delay), max(last_times))
+        if self.next_grid_index is None:
+            self.next_grid_index = int(math.ceil(min(aligned_stream.times[0] for aligned_stream in self.aligned_streams.values()
+                                                     if len(aligned_stream.times)) * self.rate))
+        last_grid_index = int(math.floor(horizon * self.rate))
+        if last_grid_index < self.next_grid_index: return None
+
+        grid = np.arange(self.next_grid_index, last_grid_index + 1) / self.rate
+        self.next_grid_index = last_grid_index + 1
+        return np.column_stack([grid] + [aligned_stream.resample(grid) for aligned_stream in self.aligned_streams.values()])
+
+    def start(self, interval=1.0):
+        self.loop = task.LoopingCall(self.send_aligned_rows)
+        self.loop.start(interval, now=False)
+
+    def send_aligned_rows(self):
+        rows = self.advance()
+        if rows is None: return
+        if self.data_logger is not None:
+            self.data_logger.write_rows(rows)
+        if self.processing_proxy is not None and self.processing_proxy.subscribed("aligned"):
+            data = {"type": "aligned", "timestamp": float(rows[-1, 0]), "start": float(rows[0, 0]), "rate": self.rate}
+            wanted_fields = self.processing_proxy.wanted_fields("aligned")
+            # NaN is sent as null to JSON clients, see ProxyEncoding
+            for column_index, column in enumerate(self.columns()[1:], 1):
+                if wanted_fields is None or column in wanted_fields:
+                    data[column] = rows[:, column_index]
+            self.processing_proxy.notifyAll(data)
@@ -0,0 +1,92 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import numpy as np
+
+VISUALIZATION_MODES = ["envelope", "decimate"]
+
+###
+# Sample Ring
+# the last capacity samples (timestamp, value) of one stream in preallocated arrays, written in blocks
+class SampleRing(object):
+    def __init__(self, capacity):
+        self.times = np.empty(capacity)
+        self.values = np.empty(capacity)
+        self.position = 0
+        self.length = 0
+
+    def extend(self, times, values):
+        times, values = np.asarray(times, dtype=np.float64), np.asarray(values, dtype=np.float64)
+        capacity = len(self.times)
+        if len(times) > capacity:
+            times, values = times[-capacity:], values[-capacity:]
+        # the block is written in up to two parts, at the end and at the start of the arrays
+        first = min(len(times), capacity - self.position)
+        self.times[self.position:self.position + first] = times[:first]
+        self.values[self.position:self.position + first] = values[:first]
+        self.times[:len(times) - first] = times[first:]
+        self.values[:len(times) - first] = values[first:]
+        self.position = (self.position + len(times)) % capacity
+        self.length = min(self.length + len(times), capacity)
+
+    def last_time(self):
+        return self.times[self.position - 1] if self.length else None
+
+    def samples_since(self, start_time):
+        # the samples from start_time to the newest, copied only if they wrap around the end of the arrays
+        if self.length < len(self.times):
+            start = np.searchsorted(self.times[:self.length], start_time)
+            return self.times[start:self.length], self.values[start:self.length]
+        if self.position and self.times[0] <= start_time:
+            start = np.searchsorted(self.times[:self.position], start_time)
+            return self.times[start:self.position], self.values[start:self.position]
+        start = self.position + np.searchsorted(self.times[self.position:], start_time)
+        return (np.concatenate((self.times[start:], self.times[:self.position])),
+                np.concatenate((self.values[start:], self.values[:self.position])))
+
+
+###
+# Visualization
+# keeps the recent samples of the streams sent to the real-time processing proxy and reduces them to buckets
+# for charts: the time axis is cut into points buckets of seconds / points, aligned to multiples of the bucket width
+#   envelope - minimum and maximum of every bucket
+#   decimate - mean of every bucket
+# buckets without samples are NaN; the bucket holding the newest sample is not complete and left out
+# streams are named like their files plus the field, e.g. BIO_ecg, BIO_acceleration_x, E4_R_bvp, E4_R_acc_x
+class Visualization(object):
+    def __init__(self, capacity=16384):
+        self.capacity = capacity
+        self.ring_of_stream = {}
+
+    def add_samples(self, stream_name, times, values):
+        if not len(times): return
+        ring = self.ring_of_stream.get(stream_name)
+        if ring is None:
+            ring = self.ring_of_stream[stream_name] = SampleRing(self.capacity)
+        ring.extend(times, values)
+
+    def buckets(self, stream_name, seconds, points, mode, from_bucket=None):
+        # Returns the index of the first bucket (its start is index * bucket width) and the arrays of the last
+        # points complete buckets, None if the stream has no samples
+        # only the buckets from from_bucket on are computed, the ones before are NaN
+        ring = self.ring_of_stream.get(stream_name)
+        if ring is None or not ring.length: return None
+        width = float(seconds) / points
+        first_bucket = int(np.floor(ring.last_time() / width)) - points
+        times, values = ring.samples_since((first_bucket if from_bucket is None else max(first_bucket, from_bucket)) * width)
+        end = np.searchsorted(times, (first_bucket + points) * width)
+        times, values = times[:end], values[:end]
+        bucket = (np.floor(times / width) - first_bucket).astype(np.intp)
+        np.clip(bucket, 0, points - 1, out=bucket)
+        counts = np.bincount(bucket, minlength=points)
+        filled = counts > 0
+        # the samples are in time order, so every bucket is one contiguous segment
+        starts = np.searchsorted(bucket, np.arange(points))[filled]
+        if mode == "envelope":
+            minima, maxima = np.full(points, np.nan), np.full(points, np.nan)
+            if len(starts):
+                minima[filled] = np.minimum.reduceat(values, starts)
+                maxima[filled] = np.maximum.reduceat(values, starts)
+            return first_bucket, (minima, maxima)
+        means = np.full(points, np.nan)
+        if len(starts):
+            means[filled] = np.add.reduceat(values, starts) / counts[filled]
+        return first_bucket, (means,)
@@ -0,0 +1,86 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import math
+import time
+import random
+import struct
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zephyr.protocol import MessageFrameParser
+from BioharnessClient import MessageFrameBuffer
+from SyntheticSensors import (BIOHARNESS_PACKETS, BIOHARNESS_RR_MESSAGE_ID, BIOHARNESS_SUMMARY_MESSAGE_ID, SUMMARY_PAYLOAD_LENGTH,
+                              create_frame, pack_10bit_samples, zephyr_timestamp)
+
+###
+# Bioharness Frame Benchmark
+# parses the serial data of a Bioharness streaming ECG, breathing, acceleration, RR and summary packets with
+#   per byte - zephyr's MessageFrameParser.parse_data called for every byte, like rawDataReceived did
+#   buffer   - MessageFrameBuffer.parse_data called once per received chunk
+# the data is cut into chunks of random sizes like serial reads, and the parsing time per second of data is reported
+#
+# python benchmarks/bioharness_frame_benchmark.py --seconds 600 --chunk-size 256
+def generate_data(seconds):
+    frames = []
+    header = struct.pack("<B", 0) + zephyr_timestamp(1500000000.0)
+    for stream, (message_id, samples_per_packet, rate, values_per_sample) in BIOHARNESS_PACKETS.items():
+        for packet_index in range(int(seconds * rate / samples_per_packet)):
+            samples = [512 + int(200 * math.sin((packet_index * samples_per_packet + sample_index) * 0.05))
+                       for sample_index in range(samples_per_packet * values_per_sample)]
+            frames.append((packet_index * samples_per_packet / float(rate), create_frame(message_id, header + pack_10bit_samples(samples))))
+    for second in range(int(seconds)):
+        frames.append((second, create_frame(BIOHARNESS_RR_MESSAGE_ID, header + struct.pack("<18h", *([857] * 18)))))
+        frames.append((second, create_frame(BIOHARNESS_SUMMARY_MESSAGE_ID, header + bytes(SUMMARY_PAYLOAD_LENGTH - len(header)))))
+    frames.sort(key=lambda frame: frame[0])
+    return b"".join(frame for timestamp, frame in frames)
+
+def split_into_chunks(data, chunk_size):
+    # serial reads return whatever has arrived, frames are cut at random places
+    chunks, position = [], 0
+    generator = random.Random(0)
+    while position < len(data):
+        size = generator.randint(1, 2 * chunk_size)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+def parse_per_byte(chunks, frames):
+    parser = MessageFrameParser(frames.append)
+    for chunk in chunks:
+        for byte in chunk:
+            parser.parse_data(byte)
+
+def parse_buffered(chunks, frames):
+    parser = MessageFrameBuffer(frames.append)
+    for chunk in chunks:
+        parser.parse_data(chunk)
+
+def measure(parse, chunks, repeats):
+    best, frames = float("inf"), []
+    for _ in range(repeats):
+        frames = []
+        started_at = time.perf_counter()
+        parse(chunks, frames)
+        best = min(best, time.perf_counter() - started_at)
+    return best, frames
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Bioharness message frame parser microbenchmark')
+    parser.add_argument("--seconds", type=float, default=600, help="Seconds of Bioharness data to parse")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=256, help="Average bytes per received chunk")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of every measurement, the best is reported")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    data = generate_data(command_args.seconds)
+    chunks = split_into_chunks(data, command_args.chunk_size)
+    print("%i bytes in %i chunks, %.0f bytes per second of data" % (len(data), len(chunks), len(data) / command_args.seconds))
+    print("%10s %10s %12s %14s %12s %7s" % ("parser", "frames", "ns/byte", "bytes/s", "CPU share", "speedup"))
+    per_byte_time = None
+    for name, parse in (("per byte", parse_per_byte), ("buffer", parse_buffered)):
+        elapsed, frames = measure(parse, chunks, command_args.repeats)
+        per_byte_time = per_byte_time or elapsed
+        print("%10s %10i %12.1f %14.0f %11.4f%% %6.2fx" % (name, len(frames), 1e9 * elapsed / len(data), len(data) / elapsed,
+                                                          100 * elapsed / command_args.seconds, per_byte_time / elapsed))
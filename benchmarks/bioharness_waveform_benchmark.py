@@ -0,0 +1,83 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import math
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor
+from zephyr.collector import SignalPacketIterator
+from zephyr.message import SignalPacket
+from BioharnessClient import BioharnessProtocol
+from SyntheticSensors import BIOHARNESS_PACKETS
+
+###
+# Bioharness Waveform Benchmark
+# handles the ECG, breathing and acceleration packets of a Bioharness recording with
+#   per sample - SignalPacketIterator and handle_signal_sample for every sample, like the waveform handler did
+#   per packet - default_signal_waveform_handler, the timestamps of a packet are computed at once,
+#                its rows written in one logger call and the buffers extended in one step
+# and reports the handling time per sample
+#
+# python benchmarks/bioharness_waveform_benchmark.py --seconds 600
+class NullLogger(object):
+    def write_rows(self, rows):
+        pass
+
+    def write_tuple_to_log_file(self, values):
+        pass
+
+def generate_packets(seconds):
+    packets = []
+    for stream, (message_id, samples_per_packet, rate, values_per_sample) in BIOHARNESS_PACKETS.items():
+        for packet_index in range(int(seconds * rate / samples_per_packet)):
+            samples = [512 + int(200 * math.sin((packet_index * samples_per_packet + sample_index) * 0.05))
+                       for sample_index in range(samples_per_packet * values_per_sample)]
+            if values_per_sample > 1:
+                samples = list(zip(*[iter(samples)] * values_per_sample))
+            packets.append(SignalPacket(stream, 1500000000.0 + packet_index * samples_per_packet / float(rate), rate, samples, packet_index))
+    packets.sort(key=lambda packet: packet.timestamp)
+    return packets
+
+def create_protocol():
+    protocol = BioharnessProtocol(None, reactor)
+    protocol.set_data_loggers(dict((stream_type, NullLogger()) for stream_type in BioharnessProtocol.columns_of_streams))
+    return protocol
+
+def handle_per_sample(protocol, packets):
+    for packet in packets:
+        for signal_sample in SignalPacketIterator(packet).iterate_timed_samples():
+            protocol.handle_signal_sample(signal_sample)
+
+def handle_per_packet(protocol, packets):
+    for packet in packets:
+        protocol.default_signal_waveform_handler(packet, False)
+
+def measure(handle, packets, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        protocol = create_protocol()
+        started_at = time.perf_counter()
+        handle(protocol, packets)
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Bioharness waveform packet handling microbenchmark')
+    parser.add_argument("--seconds", type=float, default=600, help="Seconds of Bioharness waveforms to handle")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of every measurement, the best is reported")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    packets = generate_packets(command_args.seconds)
+    samples = sum(len(packet.samples) for packet in packets)
+    print("%i packets, %i samples" % (len(packets), samples))
+    print("%11s %12s %14s %12s %7s" % ("handling", "us/sample", "samples/s", "CPU share", "speedup"))
+    per_sample_time = None
+    for name, handle in (("per sample", handle_per_sample), ("per packet", handle_per_packet)):
+        elapsed = measure(handle, packets, command_args.repeats)
+        per_sample_time = per_sample_time or elapsed
+        print("%11s %12.3f %14.0f %11.4f%% %6.2fx" % (name, 1e6 * elapsed / samples, samples / elapsed,
+                                                     100 * elapsed / command_args.seconds, per_sample_time / elapsed))
@@ -0,0 +1,104 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import math
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from E4Commands import StreamMessagesDecoder
+from E4BLEClient import E4Protocol
+
+###
+# E4 Decoder Benchmark
+# decodes the lines of both wristbands streaming acc, bvp, gsr, tmp and ibi at the E4's full rates with
+#   legacy    - decode_message_by_stream_prefix, values materialized and converted with str() like the DataLogger did
+#   per line  - decode_message on every line
+#   per chunk - decode_lines on the lines of one TCP chunk
+#   ingestion - E4Protocol with chunked ingestion, the lines of every TCP chunk are decoded with decode_lines
+#               and stored into the preallocated chunk arrays of the streams
+# and reports the decoding time per line and the CPU share of one core needed at full rate
+#
+# python benchmarks/e4_decoder_benchmark.py --seconds 600
+E4_FULL_RATE_STREAMS = [
+                        # stream prefix, samples per second, number of values
+                        ("E4_Acc", 32, 3),
+                        ("E4_Bvp", 64, 1),
+                        ("E4_Gsr", 4, 1),
+                        ("E4_Temperature", 4, 1),
+                        ("E4_Ibi", 1, 1),
+                        ]
+
+def generate_lines(seconds, hands=2):
+    lines = []
+    start_time = 1500000000.0
+    for hand in range(hands):
+        for prefix, rate, number_of_values in E4_FULL_RATE_STREAMS:
+            for sample_index in range(int(seconds * rate)):
+                values = ["%.6f" % math.sin(sample_index * 0.01 + value_index) for value_index in range(number_of_values)]
+                lines.append((sample_index / float(rate), " ".join([prefix, "%.6f" % (start_time + sample_index / float(rate))] + values)))
+    lines.sort(key=lambda line: line[0])
+    return [line for timestamp, line in lines]
+
+def create_decoder():
+    decoder = StreamMessagesDecoder()
+    for stream in ("acc", "bvp", "gsr", "tmp", "ibi"):
+        decoder.subscribe_to_stream(stream)
+    return decoder
+
+def decode_legacy(decoder, lines):
+    for line in lines:
+        message_type, message_values = decoder.decode_message_by_stream_prefix(line)
+        ",".join([str(value) for value in tuple(message_values)])
+
+def decode_per_line(decoder, lines):
+    for line in lines:
+        message_type, message_values = decoder.decode_message(line)
+
+def decode_per_chunk(decoder, lines, lines_per_chunk=32):
+    for chunk_start in range(0, len(lines), lines_per_chunk):
+        decoder.decode_lines(lines[chunk_start:chunk_start + lines_per_chunk])
+
+class NullLogger(object):
+    def write_rows(self, rows):
+        pass
+
+def ingest_chunked(decoder, lines, lines_per_chunk=32):
+    protocol = E4Protocol()
+    protocol.set_stream_decoder(decoder)
+    protocol.start_without_device([])
+    protocol.set_chunked_ingestion(64, 0.25, [])
+    protocol.set_data_loggers(dict((stream, NullLogger()) for stream in decoder.possible_streams))
+    data = [("\n".join(lines[chunk_start:chunk_start + lines_per_chunk]) + "\n").encode("utf-8")
+            for chunk_start in range(0, len(lines), lines_per_chunk)]
+    started_at = time.perf_counter()
+    for chunk in data:
+        protocol.dataReceived(chunk)
+    return time.perf_counter() - started_at
+
+def measure(decode, decoder, lines, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        elapsed = decode(decoder, lines)
+        best = min(best, elapsed if elapsed is not None else time.perf_counter() - started_at)
+    return best
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='E4 stream line decoder microbenchmark')
+    parser.add_argument("--seconds", type=float, default=600, help="Seconds of recording of both wristbands to decode")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats of every measurement, the best is reported")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    lines = generate_lines(command_args.seconds)
+    lines_per_second = len(lines) / command_args.seconds
+    print("%i lines, %.0f lines per second of recording" % (len(lines), lines_per_second))
+    print("%10s %12s %14s %12s %7s" % ("decoder", "us/line", "lines/s", "CPU share", "speedup"))
+    legacy_time = None
+    for name, decode in (("legacy", decode_legacy), ("per line", decode_per_line), ("per chunk", decode_per_chunk), ("ingestion", ingest_chunked)):
+        elapsed = measure(decode, create_decoder(), lines, command_args.repeats)
+        legacy_time = legacy_time or elapsed
+        print("%10s %12.2f %14.0f %11.4f%% %6.2fx" % (name, 1e6 * elapsed / len(lines), len(lines) / elapsed,
+                                                     100 * elapsed / command_args.seconds, legacy_time / elapsed))
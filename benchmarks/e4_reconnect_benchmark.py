@@ -0,0 +1,85 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import logging
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor, defer, task
+from E4Commands import StreamMessagesDecoder
+from E4BLEClient import E4ClientFactory
+from SyntheticSensors import FakeE4Server
+
+###
+# E4 Reconnect Benchmark
+# connects one E4 client to the fake E4 server, whose command responses are delayed like the Bluetooth round trip,
+# drops the connection on the server side several times and reports
+#   first connect - seconds from connecting to the first sample, with the discovery (status and device list)
+#   reconnect     - seconds from connecting to the first sample again, the known device is resubscribed directly
+#   lost          - seconds from losing the connection to the first sample again, including the reconnect delay
+#
+# python benchmarks/e4_reconnect_benchmark.py --response-delay 0.05 --reconnects 5
+class NullLogger(object):
+    def write_rows(self, rows):
+        pass
+
+    def write_list_to_log_file(self, values):
+        pass
+
+@defer.inlineCallbacks
+def wait_for_first_sample(factory):
+    factory.time_to_first_sample = None
+    while factory.time_to_first_sample is None:
+        yield task.deferLater(reactor, 0.005, lambda: None)
+
+@defer.inlineCallbacks
+def run_benchmark(command_args):
+    e4_server = FakeE4Server(response_delay=command_args.response_delay)
+    e4_port = reactor.listenTCP(0, e4_server, interface="127.0.0.1")
+
+    stream_decoder = StreamMessagesDecoder()
+    factory = E4ClientFactory()
+    factory.set_client_id("R")
+    factory.set_stream_decoder(stream_decoder)
+    factory.set_data_loggers(dict((stream, NullLogger()) for stream in stream_decoder.possible_streams))
+    factory.initialDelay = command_args.reconnect_delay
+    connector = reactor.connectTCP("127.0.0.1", e4_port.getHost().port, factory)
+
+    yield wait_for_first_sample(factory)
+    first_connect = factory.time_to_first_sample
+    reconnects, lost = [], []
+    for _ in range(command_args.reconnects):
+        if command_args.forget_device:
+            factory.known_device = None
+        e4_server.drop_connections()
+        yield wait_for_first_sample(factory)
+        reconnects.append(factory.time_to_first_sample)
+        lost.append(factory.reconnect_to_first_sample)
+
+    print("response delay %.3f s, %i reconnects%s" % (command_args.response_delay, command_args.reconnects,
+                                                       ", device forgotten" if command_args.forget_device else ""))
+    print("%14s %10s" % ("", "seconds"))
+    print("%14s %10.3f" % ("first connect", first_connect))
+    print("%14s %10.3f" % ("reconnect", sum(reconnects) / len(reconnects)))
+    print("%14s %10.3f" % ("lost", sum(lost) / len(lost)))
+    factory.stopTrying()
+    connector.disconnect()
+    yield e4_port.stopListening()
+    reactor.stop()
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='E4 startup and reconnect benchmark')
+    parser.add_argument("--response-delay", dest="response_delay", type=float, default=0.05,
+                        help="Seconds the fake E4 server waits before answering a command")
+    parser.add_argument("--reconnects", type=int, default=5, help="Number of dropped connections")
+    parser.add_argument("--reconnect-delay", dest="reconnect_delay", type=float, default=0.1,
+                        help="Initial reconnect delay of the client factory")
+    parser.add_argument("--forget-device", dest="forget_device", action="store_true",
+                        help="Reconnect with the discovery, like the first connection")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    reactor.callWhenRunning(run_benchmark, command_args)
+    reactor.run()
@@ -0,0 +1,215 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import math
+import time
+import argparse
+import numpy as np
+from collections import deque
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FeatureExtraction import FeatureExtraction, BreathingRate
+
+###
+# Feature Benchmark
+# extracts HRV, breathing rate, movement and EDA from a synthetic recording of one Bioharness (RR, breathing,
+# acceleration and ECG packets) and one E4 (chunks of IBI, GSR, acc and BVP rows), features every second, with
+#   recompute   - like a processing client: the raw samples of every window are kept in deques and all
+#                 features are computed from the whole windows every second
+#   incremental - FeatureExtraction: the samples are added as they arrive, running sums are updated per beat
+#                 and per block, only the breathing spectrum is computed per window
+# and reports the processing time per second of data, for the Bioharness and the E4 device
+#
+# python benchmarks/feature_benchmark.py --seconds 600
+BIOHARNESS_PACKETS = {
+                      # stream: (samples per packet, samples per second, values per sample)
+                      "rr": (18, 18, 1),
+                      "breathing": (18, 18, 1),
+                      "acceleration": (20, 50, 3),
+                      "ecg": (63, 250, 1),
+                      }
+E4_RATES = {"gsr": 4, "acc": 32, "bvp": 64}
+E4_CHUNK_SECONDS = 0.25
+
+class LastRowLogger(object):
+    def __init__(self):
+        self.last_row = None
+
+    def write_rows(self, rows):
+        self.last_row = rows[-1]
+
+def beat_intervals(seconds, generator):
+    # beat times and intervals (s) with respiratory sinus arrhythmia and noise
+    intervals = []
+    elapsed = 0.0
+    while elapsed < seconds + 2:
+        interval = 0.8 + 0.05 * math.sin(2 * math.pi * 0.25 * elapsed) + 0.02 * generator.randn()
+        elapsed += interval
+        intervals.append(interval)
+    intervals = np.array(intervals)
+    return np.cumsum(intervals), intervals
+
+def generate_events(seconds, generator):
+    # (time of arrival, source, stream, timestamps, values) in the order they arrive
+    events = []
+    beat_times, intervals = beat_intervals(seconds, generator)
+    for stream, (samples_per_packet, rate, values_per_sample) in BIOHARNESS_PACKETS.items():
+        for packet_index in range(int(seconds * rate / samples_per_packet)):
+            timestamps = (packet_index * samples_per_packet + np.arange(samples_per_packet)) / float(rate)
+            if stream == "rr":
+                # the last interval in ms, its sign toggles with every beat
+                beat = np.maximum(np.searchsorted(beat_times, timestamps, side="right") - 1, 0)
+                values = [np.where(beat % 2, -1, 1) * np.round(1000 * intervals[beat])]
+            elif stream == "breathing":
+                values = [512 + 200 * np.sin(2 * math.pi * 0.25 * timestamps) + 5 * generator.randn(samples_per_packet)]
+            else:
+                values = [512 + 20 * generator.randn(samples_per_packet) for _ in range(values_per_sample)]
+            events.append((timestamps[-1], "bioharness", stream, timestamps, values))
+    for chunk_index in range(int(seconds / E4_CHUNK_SECONDS)):
+        start, end = chunk_index * E4_CHUNK_SECONDS, (chunk_index + 1) * E4_CHUNK_SECONDS
+        for stream, rate in E4_RATES.items():
+            timestamps = np.arange(int(start * rate), int(end * rate)) / float(rate)
+            if stream == "gsr":
+                rows = np.column_stack([timestamps, 2 + 0.001 * timestamps + 0.3 * (np.sin(2 * math.pi * timestamps / 20) > 0.95)])
+            elif stream == "acc":
+                rows = np.column_stack([timestamps] + [64 * generator.randn(len(timestamps)) for _ in range(3)])
+            else:
+                rows = np.column_stack([timestamps, generator.randn(len(timestamps))])
+            events.append((end, "e4", stream, None, rows))
+        beats = (beat_times >= start) & (beat_times < end)
+        if beats.any():
+            events.append((end, "e4", "ibi", None, np.column_stack([beat_times[beats], intervals[beats]])))
+    events.sort(key=lambda event: event[0])
+    return events
+
+###
+# Recomputed Features
+# the features of a processing client that keeps the raw samples of the last window of every stream
+class RecomputedFeatures(object):
+    def __init__(self, hrv_window=60.0, breathing_window=30.0, movement_window=10.0, eda_window=10.0):
+        self.windows = {"hrv": hrv_window, "breathing": breathing_window, "movement": movement_window, "eda": eda_window}
+        self.samples = {}
+
+    def add(self, name, timestamps, values, window):
+        samples = self.samples.setdefault(name, deque())
+        samples.extend(zip(timestamps.tolist(), *[np.asarray(column).tolist() for column in values]))
+        while samples[0][0] < timestamps[-1] - window:
+            samples.popleft()
+
+    def add_bioharness_samples(self, signal_type, timestamps, columns):
+        window = {"rr": self.windows["hrv"], "breathing": self.windows["breathing"], "acceleration": self.windows["movement"]}.get(signal_type)
+        if window is not None:
+            self.add(signal_type, timestamps, columns, window)
+
+    def add_E4_chunk(self, stream_type, rows):
+        # the tonic level of the new samples needs the window before them
+        window = {"ibi": self.windows["hrv"], "gsr": 2 * self.windows["eda"], "acc": self.windows["movement"]}.get(stream_type)
+        if window is not None and len(rows):
+            self.add("E4_%s" % stream_type, rows[:, 0], rows[:, 1:].T, window)
+
+    def array(self, name):
+        return np.array(self.samples.get(name) or np.empty((0, 2)))
+
+    def hrv(self, intervals):
+        intervals = intervals[(intervals >= 300) & (intervals <= 2000)]
+        if len(intervals) < 2: return [float("nan")] * 3
+        return [np.sqrt(np.mean(np.diff(intervals) ** 2)), intervals.std(ddof=1), intervals.mean()]
+
+    def breathing_rate(self, samples):
+        # the same spectrum as FeatureExtraction, of the whole window
+        if not len(samples): return float("nan")
+        breathing_rate = BreathingRate(self.windows["breathing"], len(samples))
+        breathing_rate.add(samples[:, 0], samples[:, 1:])
+        return breathing_rate.features()["breathing_rate"]
+
+    def movement(self, samples):
+        return np.sqrt(samples[:, 1:].var(axis=0).sum()) if len(samples) > 1 else float("nan")
+
+    def bioharness_features(self):
+        rr = self.array("rr")
+        beats = np.sign(rr[:, 1]) != np.sign(np.concatenate(([0], rr[:-1, 1])))
+        return dict(zip(["rmssd", "sdnn", "mean_rr", "breathing_rate", "movement"],
+                        self.hrv(np.abs(rr[beats, 1])[1:]) + [self.breathing_rate(self.array("breathing")), self.movement(self.array("acceleration"))]))
+
+    def E4_features(self, since):
+        gsr = self.array("E4_gsr")
+        times, values = gsr[:, 0], gsr[:, 1]
+        new = np.nonzero(times > since)[0]
+        tonic = np.array([values[(times > times[index] - self.windows["eda"]) & (times <= times[index])].mean() for index in new])
+        phasic = (values[new] - tonic).max() if len(new) else float("nan")
+        return dict(zip(["rmssd", "sdnn", "mean_rr", "eda_tonic", "eda_phasic", "movement"],
+                        self.hrv(1000 * self.array("E4_ibi")[:, 1]) + [tonic[-1] if len(tonic) else float("nan"), phasic, self.movement(self.array("E4_acc"))]))
+
+def run_incremental(events, seconds):
+    # one FeatureExtraction per device, so that the features of each device are timed on their own
+    extraction_of_source = {"bioharness": FeatureExtraction(), "e4": FeatureExtraction()}
+    extraction_of_source["bioharness"].register_bioharness("BIO")
+    extraction_of_source["e4"].register_E4("R")
+    extraction_of_source["bioharness"].set_data_loggers({"BIO": LastRowLogger()})
+    extraction_of_source["e4"].set_data_loggers({"E4_R": LastRowLogger()})
+    elapsed = {"bioharness": 0.0, "e4": 0.0}
+    next_second = 1.0
+    for arrival, source, stream, timestamps, values in events:
+        while arrival > next_second:
+            for name, extraction in extraction_of_source.items():
+                started_at = time.perf_counter()
+                extraction.send_features()
+                elapsed[name] += time.perf_counter() - started_at
+            next_second += 1.0
+        started_at = time.perf_counter()
+        if source == "bioharness":
+            extraction_of_source[source].add_bioharness_samples("BIO", stream, timestamps, values)
+        else:
+            extraction_of_source[source].add_E4_chunk("R", stream, values)
+        elapsed[source] += time.perf_counter() - started_at
+    last_features = {}
+    for name, source in (("bioharness", "BIO"), ("e4", "E4_R")):
+        extraction = extraction_of_source[name]
+        last_features[name] = dict(zip(extraction.features_of_source[source].feature_names, extraction.logger_of_source[source].last_row[1:]))
+    return elapsed, last_features["bioharness"], last_features["e4"]
+
+def run_recompute(events, seconds):
+    features = RecomputedFeatures()
+    elapsed = {"bioharness": 0.0, "e4": 0.0}
+    next_second = 1.0
+    last_features = {}
+    for arrival, source, stream, timestamps, values in events:
+        while arrival > next_second:
+            started_at = time.perf_counter()
+            last_features["bioharness"] = features.bioharness_features()
+            elapsed["bioharness"] += time.perf_counter() - started_at
+            started_at = time.perf_counter()
+            last_features["e4"] = features.E4_features(next_second - 1.0)
+            elapsed["e4"] += time.perf_counter() - started_at
+            next_second += 1.0
+        started_at = time.perf_counter()
+        if source == "bioharness":
+            features.add_bioharness_samples(stream, timestamps, values)
+        else:
+            features.add_E4_chunk(stream, values)
+        elapsed[source] += time.perf_counter() - started_at
+    return elapsed, last_features["bioharness"], last_features["e4"]
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Physiological feature extraction benchmark')
+    parser.add_argument("--seconds", type=float, default=600, help="Seconds of synthetic data")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of every measurement, the best is reported")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    events = generate_events(command_args.seconds, np.random.RandomState(0))
+    print("%g seconds of one Bioharness and one E4, features every second" % command_args.seconds)
+    results = {}
+    for name, run in (("recompute", run_recompute), ("incremental", run_incremental)):
+        runs = [run(events, command_args.seconds) for _ in range(command_args.repeats)]
+        results[name] = dict((source, min(elapsed[source] for elapsed, bioharness, E4 in runs)) for source in ("bioharness", "e4"))
+        # the features of the last second, both ways
+        for source, features in (("bioharness", runs[-1][1]), ("e4", runs[-1][2])):
+            print("%12s %12s %s" % (name, source, ", ".join("%s %.4g" % (feature, value) for feature, value in sorted(features.items()))))
+    print("%12s %12s %16s %16s %9s" % ("features", "device", "us/s of data", "CPU share", "speedup"))
+    for name in ("recompute", "incremental"):
+        for source in ("bioharness", "e4"):
+            elapsed = results[name][source]
+            print("%12s %12s %16.1f %15.4f%% %8.2fx" % (name, source, 1e6 * elapsed / command_args.seconds, 100 * elapsed / command_args.seconds,
+                                                       results["recompute"][source] / elapsed))
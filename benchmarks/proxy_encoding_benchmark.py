@@ -0,0 +1,74 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BioharnessClient import BioharnessProtocol
+from ProxyEncoding import encode_packet, decode_binary
+
+###
+# Proxy Encoding Benchmark
+# encodes the Bioharness package of the real-time processing proxy (the samples of one interval) with
+#   json lists - the arrays converted to lists and dumped with json, like notifyAll did
+#   json       - sensor-proxy.json, the arrays dumped by ProxyEncoding
+#   binary32   - sensor-proxy.binary32, header and float32 arrays
+#   binary64   - sensor-proxy.binary64, header and float64 arrays
+# and reports the bytes on the wire and the time to encode and to decode a package (decoding in Python,
+# a browser only parses the header of a binary message and views the arrays)
+#
+# python benchmarks/proxy_encoding_benchmark.py --interval 1.0 --packages 2000
+def create_package(interval, generator):
+    data = {"type": "bioharness", "device": None, "timestamp": 1500000000.0}
+    for name, rate in BioharnessProtocol.buffered_rates.items():
+        # 10 bit samples like the device sends, RR intervals in seconds
+        samples = generator.randint(0, 1024, int(np.ceil(rate * interval))).astype(np.float64)
+        data[name] = samples / 1000.0 if name == "rr" else samples
+    data["heart_rate"] = 70
+    data["respiration_rate"] = 14.5
+    data["ecg_conf"] = 100
+    return data
+
+def encode_json_lists(data):
+    data = dict((key, value.tolist() if isinstance(value, np.ndarray) else value) for key, value in data.items())
+    return json.dumps(data, ensure_ascii = False).encode('utf8')
+
+ENCODERS = (
+            ("json lists", encode_json_lists, json.loads),
+            ("json", lambda data: encode_packet(data, "sensor-proxy.json"), json.loads),
+            ("binary32", lambda data: encode_packet(data, "sensor-proxy.binary32"), decode_binary),
+            ("binary64", lambda data: encode_packet(data, "sensor-proxy.binary64"), decode_binary),
+            )
+
+def measure(function, values, repeats):
+    best, results = float("inf"), None
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        results = [function(value) for value in values]
+        best = min(best, time.perf_counter() - started_at)
+    return best / len(values), results
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Real-time processing proxy encoding microbenchmark')
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds of Bioharness samples per package")
+    parser.add_argument("--packages", type=int, default=2000, help="Packages encoded per measurement")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of every measurement, the best is reported")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    generator = np.random.RandomState(0)
+    packages = [create_package(command_args.interval, generator) for _ in range(command_args.packages)]
+    print("%i packages of %.2f s, %i samples each" % (len(packages), command_args.interval,
+                                                    sum(len(packages[0][name]) for name in BioharnessProtocol.buffered_rates)))
+    print("%10s %10s %12s %12s %9s %9s" % ("encoding", "bytes", "encode us", "decode us", "size", "speedup"))
+    reference = None
+    for name, encode, decode in ENCODERS:
+        encode_time, messages = measure(encode, packages, command_args.repeats)
+        decode_time, _ = measure(decode, messages, command_args.repeats)
+        reference = reference or (encode_time, len(messages[0]))
+        print("%10s %10i %12.1f %12.1f %8.0f%% %8.2fx" % (name, len(messages[0]), 1e6 * encode_time, 1e6 * decode_time,
+                                                       100.0 * len(messages[0]) / reference[1], reference[0] / encode_time))
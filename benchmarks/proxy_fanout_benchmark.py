@@ -0,0 +1,129 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor, defer, task
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+from BioharnessClient import BioharnessProtocol
+from ProxyEncoding import encode_packet
+from SensorProxy import SensorProxyFactory
+
+###
+# Proxy Fan-out Benchmark
+# publishes Bioharness packages through the real-time processing proxy to fast subscribers and to stalled ones,
+# which stop reading from their connection, and reports for every drop policy
+#   fast      - packets per second received by the fast subscribers and their latency
+#   pending   - bytes the server holds for the stalled subscribers at the end (queues and write buffers)
+#   dropped   - packets dropped for the subscribers, and how many were disconnected
+# "unbounded" sends every packet right away like notifyAll did, its write buffers grow as long as the run
+#
+# python benchmarks/proxy_fanout_benchmark.py --fast 4 --stalled 2 --packet-rate 200 --duration 10
+class UnboundedProxyFactory(SensorProxyFactory):
+    def notifyAll(self, data_obj):
+        self.packets += 1
+        encoded = {}
+        for cli in self.client_list:
+            if cli.encoding not in encoded:
+                encoded[cli.encoding] = encode_packet(data_obj, cli.encoding)
+            cli.sendMessage(encoded[cli.encoding])
+
+class Subscriber(WebSocketClientProtocol):
+    def onOpen(self):
+        if self.factory.stalled:
+            # stop reading, the server's writes pile up
+            self.transport.pauseProducing()
+
+    def onMessage(self, payload, isBinary):
+        received_at = time.time()
+        self.factory.received += 1
+        self.factory.latencies.append(received_at - json.loads(payload.decode("utf8"))["timestamp"])
+
+def create_package(interval, generator):
+    data = {"type": "bioharness", "device": None}
+    for name, rate in BioharnessProtocol.buffered_rates.items():
+        data[name] = generator.randint(0, 1024, int(np.ceil(rate * interval))).astype(np.float64)
+    return data
+
+def pending_bytes(proxy_factory):
+    # the write buffer of a twisted TCP connection plus the subscriber's queue
+    pending = 0
+    for cli in proxy_factory.client_list:
+        transport = cli.transport
+        pending += len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+        packets = cli.queue.packets.values() if cli.queue.policy == "latest" else cli.queue.packets
+        pending += sum(len(payload) for payload, created_at in packets)
+    return pending
+
+@defer.inlineCallbacks
+def run_policy(policy, command_args, package):
+    if policy == "unbounded":
+        proxy_factory = UnboundedProxyFactory(u"ws://127.0.0.1")
+    else:
+        proxy_factory = SensorProxyFactory(u"ws://127.0.0.1", command_args.queue_size, policy)
+    port = reactor.listenTCP(0, proxy_factory, interface="127.0.0.1")
+    subscribers = []
+    for stalled in [False] * command_args.fast + [True] * command_args.stalled:
+        factory = WebSocketClientFactory(u"ws://127.0.0.1:%i" % port.getHost().port)
+        factory.protocol = Subscriber
+        factory.stalled, factory.received, factory.latencies = stalled, 0, []
+        subscribers.append((factory, connectWS(factory)))
+    yield task.deferLater(reactor, 0.5, lambda: None)
+
+    def publish():
+        data = dict(package)
+        data["timestamp"] = time.time()
+        proxy_factory.notifyAll(data)
+    publisher = task.LoopingCall(publish)
+    publisher.start(1.0 / command_args.packet_rate)
+    yield task.deferLater(reactor, command_args.duration, lambda: None)
+    publisher.stop()
+
+    fast = [factory for factory, connector in subscribers if not factory.stalled]
+    latencies = np.array(sum([factory.latencies for factory in fast], []))
+    result = (policy, sum(factory.received for factory in fast) / float(command_args.duration * len(fast)),
+              np.percentile(latencies, 50) if len(latencies) else float("nan"),
+              np.percentile(latencies, 95) if len(latencies) else float("nan"),
+              pending_bytes(proxy_factory) / 1e6, proxy_factory.stats()["dropped"], proxy_factory.disconnected_clients)
+
+    for factory, connector in subscribers:
+        connector.disconnect()
+    for cli in list(proxy_factory.client_list):
+        cli.dropConnection(abort=True)
+    yield port.stopListening()
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    defer.returnValue(result)
+
+@defer.inlineCallbacks
+def run_benchmark(command_args):
+    package = create_package(command_args.interval, np.random.RandomState(0))
+    print("%i fast and %i stalled subscribers, %i packets/s of %i bytes, queues of %i packets" %
+          (command_args.fast, command_args.stalled, command_args.packet_rate,
+           len(encode_packet(dict(package, timestamp=0.0), "sensor-proxy.json")), command_args.queue_size))
+    print("%12s %12s %10s %10s %12s %9s %13s" % ("policy", "fast pkt/s", "p50", "p95", "pending MB", "dropped", "disconnected"))
+    for policy in command_args.policies.split(","):
+        result = yield run_policy(policy, command_args, package)
+        print("%12s %12.1f %9.3fs %9.3fs %12.2f %9i %13i" % result)
+    reactor.stop()
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Real-time processing proxy fan-out benchmark')
+    parser.add_argument("--fast", type=int, default=4, help="Number of subscribers that read everything")
+    parser.add_argument("--stalled", type=int, default=2, help="Number of subscribers that stop reading")
+    parser.add_argument("--packet-rate", dest="packet_rate", type=float, default=200, help="Packets published per second")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds of Bioharness samples per packet")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of publishing per policy")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=32, help="Packets per subscriber queue")
+    parser.add_argument("--policies", default="unbounded,drop_oldest,latest,disconnect", help="Comma separated drop policies")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    reactor.callWhenRunning(run_benchmark, command_args)
+    reactor.run()
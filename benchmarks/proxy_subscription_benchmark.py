@@ -0,0 +1,112 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor, defer, task
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+from BioharnessClient import BioharnessProtocol
+from SensorProxy import SensorProxyFactory
+
+###
+# Proxy Subscription Benchmark
+# builds and sends the Bioharness package of the real-time processing proxy (one interval of new samples)
+# to one subscriber that
+#   everything - never subscribed, like before subscriptions
+#   bioharness - subscribed to all fields of the bioharness packets
+#   heart rate - subscribed to the heart rate of the bioharness packets only
+#   e4 only    - subscribed to E4 packets, the Bioharness package is not built
+# and reports the time to build, encode and send a package and the bytes the subscriber receives per package
+#
+# python benchmarks/proxy_subscription_benchmark.py --packages 2000 --encoding sensor-proxy.json
+SUBSCRIPTIONS = (
+                 ("everything", None),
+                 ("bioharness", {"type": "subscribe", "source": "bioharness"}),
+                 ("heart rate", {"type": "subscribe", "source": "bioharness", "fields": ["heart_rate"]}),
+                 ("e4 only", {"type": "subscribe", "source": "e4"}),
+                 )
+
+class Subscriber(WebSocketClientProtocol):
+    def onOpen(self):
+        if self.factory.subscription is not None:
+            self.sendMessage(json.dumps(self.factory.subscription).encode("utf8"))
+        else:
+            self.factory.ready.callback(None)
+
+    def onMessage(self, payload, isBinary):
+        if not isBinary and json.loads(payload.decode("utf8")).get("type") == "subscriptions":
+            self.factory.ready.callback(None)
+            return
+        self.factory.received += 1
+        self.factory.received_bytes += len(payload)
+
+# new samples per package of every Bioharness stream, e.g. "acceleration" for acceleration_x, _y and _z
+PACKAGE_SAMPLES = dict((name.split("_")[0], rate) for name, rate in BioharnessProtocol.buffered_rates.items())
+
+def create_bioharness(generator):
+    bioharness = BioharnessProtocol(None, reactor)
+    for name, buffer in bioharness.buffers.items():
+        buffer.extend(generator.randint(0, 1024, buffer.maxlen).astype(np.float64).tolist())
+    bioharness.last_timestamp = 1500000000.0
+    bioharness.hr_last_val = 70
+    return bioharness
+
+@defer.inlineCallbacks
+def run_subscription(subscription, command_args, bioharness):
+    # unbounded queue, every package reaches the subscriber
+    proxy_factory = SensorProxyFactory(u"ws://127.0.0.1", queue_size=None)
+    port = reactor.listenTCP(0, proxy_factory, interface="127.0.0.1")
+    factory = WebSocketClientFactory(u"ws://127.0.0.1:%i" % port.getHost().port,
+                                     protocols=[command_args.encoding] if command_args.encoding else None)
+    factory.protocol = Subscriber
+    factory.subscription, factory.received, factory.received_bytes = subscription, 0, 0
+    factory.ready = defer.Deferred()
+    connector = connectWS(factory)
+    yield factory.ready
+    bioharness.processing_proxy = proxy_factory
+
+    elapsed = 0.0
+    for package_index in range(command_args.packages):
+        # every package carries one interval (1 s) of new samples
+        for stream_type in bioharness.received_samples:
+            bioharness.received_samples[stream_type] += PACKAGE_SAMPLES.get(stream_type, 0)
+        started_at = time.perf_counter()
+        bioharness.send_data_for_processing_multiple()
+        elapsed += time.perf_counter() - started_at
+        if package_index % 100 == 99:
+            yield task.deferLater(reactor, 0, lambda: None)
+    yield task.deferLater(reactor, 0.5, lambda: None)
+
+    connector.disconnect()
+    yield port.stopListening()
+    defer.returnValue((elapsed / command_args.packages, factory.received_bytes / float(max(factory.received, 1)), factory.received))
+
+@defer.inlineCallbacks
+def run_benchmark(command_args):
+    bioharness = create_bioharness(np.random.RandomState(0))
+    print("%i packages of %i samples, encoding %s" % (command_args.packages, sum(BioharnessProtocol.buffered_rates.values()),
+                                                     command_args.encoding or "sensor-proxy.json"))
+    print("%12s %12s %12s %10s %9s" % ("subscriber", "us/package", "bytes", "received", "speedup"))
+    reference = None
+    for name, subscription in SUBSCRIPTIONS:
+        package_time, package_bytes, received = yield run_subscription(subscription, command_args, bioharness)
+        reference = reference or package_time
+        print("%12s %12.1f %12.0f %10i %8.2fx" % (name, 1e6 * package_time, package_bytes if received else 0, received, reference / package_time))
+    reactor.stop()
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Real-time processing proxy subscription benchmark')
+    parser.add_argument("--packages", type=int, default=2000, help="Bioharness packages sent per subscriber")
+    parser.add_argument("--encoding", default=None, help="Subprotocol of the subscriber, e.g. sensor-proxy.binary32, JSON without")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    reactor.callWhenRunning(run_benchmark, command_args)
+    reactor.run()
@@ -0,0 +1,247 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor, defer, task
+from twisted.internet.protocol import ProcessProtocol
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+from SyntheticSensors import FakeE4Server, FakeBioharness
+from LogFiles import read_session_manifest
+from ProxyEncoding import decode_binary
+
+###
+# Throughput Benchmark
+# runs the Sensor Collection Server (Main.py) in a subprocess against the synthetic sensors and reports
+#   - samples per second sent and written to disk, and the fraction that was dropped, also per device (E4 and each Bioharness)
+#   - the rate multiplier at which data starts to drop (the sample rates are raised until it does)
+#   - latency from sample generation to disk (by tailing the E4 BVP files) and to a websocket subscriber
+#
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1,4,16,64 --bioharness
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1 --e4-devices 16
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1 --bioharness --alignment
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1 --bioharness --features
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1,2,4 --bioharness-devices 4
+# python benchmarks/throughput_benchmark.py --duration 10 --rates 1 --bioharness --proxy-encoding sensor-proxy.binary32
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(REPOSITORY_PATH, "Main.py")
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+def percentile(values, fraction):
+    if not values: return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class ServerProcess(ProcessProtocol):
+    def __init__(self, log_path):
+        self.log_file = open(log_path, "ab")
+        self.exited = defer.Deferred()
+
+    def outReceived(self, data):
+        self.log_file.write(data)
+
+    def errReceived(self, data):
+        self.log_file.write(data)
+
+    def processEnded(self, reason):
+        self.log_file.close()
+        self.exited.callback(reason.value.exitCode)
+
+class LatencySubscriber(WebSocketClientProtocol):
+    def onMessage(self, payload, isBinary):
+        received_at = time.time()
+        packet = decode_binary(payload) if isBinary else json.loads(payload.decode("utf8"))
+        if packet.get("timestamp") is not None:
+            self.factory.latencies.append(received_at - float(packet["timestamp"]))
+
+class DiskTail(object):
+    # follows the E4 BVP files of the session and measures when each sample becomes visible on disk
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.offsets = {}
+        self.latencies = []
+        self.loop = task.LoopingCall(self.poll)
+
+    def poll(self):
+        now = time.time()
+        for path in glob.glob(os.path.join(self.data_path, "*", "E4_*_bvp_*")):
+            if path.endswith(".idx"): continue
+            with open(path, "rb") as log_file:
+                log_file.seek(self.offsets.get(path, 0))
+                data = log_file.read()
+            complete = data.rfind(b"\n") + 1
+            self.offsets[path] = self.offsets.get(path, 0) + complete
+            for line in data[:complete].splitlines():
+                try:
+                    self.latencies.append(now - float(line.split(b",")[0]))
+                except ValueError:
+                    pass
+
+def written_rows(data_path, stream_prefix=None):
+    # rows of all sensor streams, or of the streams of one device, e.g. "BIO_BH01"
+    rows = 0
+    for session_path in glob.glob(os.path.join(data_path, "*")):
+        try:
+            # the aligned rows and the features are derived from the sensor rows
+            rows += sum(segment["rows"] for segment in read_session_manifest(session_path) if not segment["stream"].startswith(("ALIGNED_", "FEATURES_"))
+                        and (stream_prefix is None or segment["stream"].startswith(stream_prefix + "_")))
+        except (IOError, OSError, ValueError):
+            pass
+    return rows
+
+@defer.inlineCallbacks
+def run_level(command_args, rate_multiplier, work_path):
+    data_path = os.path.join(work_path, "data_x%g" % rate_multiplier)
+    device_ids = ["A%05i" % (device_index + 1) for device_index in range(max(2, command_args.e4_devices))]
+    e4_server = FakeE4Server(device_ids, rate_multiplier=rate_multiplier)
+    e4_port = reactor.listenTCP(0, e4_server, interface="127.0.0.1")
+    # (stream prefix, synthetic Bioharness) of every Bioharness
+    bioharnesses = []
+    if command_args.bioharness_devices:
+        bioharnesses = [("BIO_BH%02i" % (device_index + 1), FakeBioharness(reactor, rate_multiplier)) for device_index in range(command_args.bioharness_devices)]
+    elif command_args.bioharness:
+        bioharnesses = [("BIO", FakeBioharness(reactor, rate_multiplier))]
+    config = {"name": "benchmark",
+              "database": {"path": data_path, "writer": {"flush_interval": command_args.flush_interval}},
+              "e4server": {"ip": "127.0.0.1", "port": e4_port.getHost().port},
+              "e4l": {"active": True},
+              "e4r": {"active": True},
+              "processing": {"port": free_port()},
+              "loggingcontrol": {"port": free_port()},
+              "http": {"port": free_port()}}
+    if command_args.e4_devices:
+        # named devices matched by their ID instead of the two hands
+        config["e4devices"] = [{"name": "D%02i" % (device_index + 1), "device_id": device_id} for device_index, device_id in enumerate(device_ids[:command_args.e4_devices])]
+        config["e4l"]["active"] = config["e4r"]["active"] = False
+    if command_args.e4_chunk_size:
+        config["e4ingestion"] = {"chunk_size": command_args.e4_chunk_size}
+    if command_args.alignment:
+        # the BVP of every E4 and the Bioharness ECG on one 32 Hz grid
+        E4_clients = [device["name"] for device in config["e4devices"]] if command_args.e4_devices else ["L", "R"]
+        config["alignment"] = {"streams": ["E4_%s_bvp" % client for client in E4_clients] + ["%s_ecg" % stream_prefix for stream_prefix, bioharness in bioharnesses],
+                               "rate": 32, "interval": 0.5}
+    if command_args.features:
+        config["features"] = {"interval": 1.0}
+    for stream_prefix, bioharness in bioharnesses:
+        bioharness.start()
+    if command_args.bioharness_devices:
+        config["bioharnesses"] = [{"device_id": stream_prefix[len("BIO_"):], "port": bioharness.port} for stream_prefix, bioharness in bioharnesses]
+    elif bioharnesses:
+        config["bioharness"] = {"active": True, "port": bioharnesses[0][1].port}
+    config_path = os.path.join(work_path, "main_x%g.conf" % rate_multiplier)
+    with open(config_path, "w") as config_file:
+        json.dump(config, config_file)
+
+    server = ServerProcess(os.path.join(work_path, "server_x%g.log" % rate_multiplier))
+    transport = reactor.spawnProcess(server, sys.executable, [sys.executable, MAIN_PATH, "-o", "BENCH", "-c", config_path],
+                                     env=os.environ, path=REPOSITORY_PATH)
+    yield task.deferLater(reactor, command_args.startup_time, lambda: None)
+
+    # start logging and measuring
+    subscriber_factory = WebSocketClientFactory(u"ws://127.0.0.1:%i" % config["processing"]["port"],
+                                                protocols=[command_args.proxy_encoding] if command_args.proxy_encoding else None)
+    subscriber_factory.protocol = LatencySubscriber
+    subscriber_factory.latencies = []
+    connectWS(subscriber_factory)
+    disk_tail = DiskTail(data_path)
+    disk_tail.loop.start(0.02)
+    transport.write(b"ON\n")
+    devices = [("E4", e4_server)] + bioharnesses
+    sent_at_start = dict((stream_prefix, device.sent_samples) for stream_prefix, device in devices)
+    yield task.deferLater(reactor, command_args.duration, lambda: None)
+    sent_of_device = dict((stream_prefix, device.sent_samples - sent_at_start[stream_prefix]) for stream_prefix, device in devices)
+    sent_samples = sum(sent_of_device.values())
+
+    # stop the server, it flushes and closes its files on shutdown
+    transport.signalProcess(signal.SIGINT)
+    yield server.exited
+    disk_tail.loop.stop()
+    disk_tail.poll()
+    yield e4_port.stopListening()
+    for stream_prefix, bioharness in bioharnesses:
+        bioharness.stop()
+
+    rows = written_rows(data_path)
+    device_results = []
+    for stream_prefix, device in devices:
+        device_rows = written_rows(data_path, stream_prefix)
+        device_results.append((stream_prefix, sent_of_device[stream_prefix] / command_args.duration, device_rows / command_args.duration,
+                               max(0.0, 1.0 - float(device_rows) / sent_of_device[stream_prefix]) if sent_of_device[stream_prefix] else 0.0))
+    result = {"rate_multiplier": rate_multiplier,
+              "sent_samples_per_second": sent_samples / command_args.duration,
+              "written_samples_per_second": rows / command_args.duration,
+              "dropped_fraction": max(0.0, 1.0 - float(rows) / sent_samples) if sent_samples else 0.0,
+              "disk_latency_p50": percentile(disk_tail.latencies, 0.5),
+              "disk_latency_p95": percentile(disk_tail.latencies, 0.95),
+              "websocket_latency_p50": percentile(subscriber_factory.latencies, 0.5),
+              "websocket_latency_p95": percentile(subscriber_factory.latencies, 0.95),
+              "devices": device_results}
+    return result
+
+@defer.inlineCallbacks
+def run_benchmark(command_args):
+    work_path = tempfile.mkdtemp(prefix="sensor_collection_benchmark_")
+    logging.info("Benchmark - Working directory %s" % work_path)
+    print("%8s %12s %12s %9s %11s %11s %11s %11s" % ("rate", "sent/s", "written/s", "dropped", "disk p50", "disk p95", "ws p50", "ws p95"))
+    drop_point = None
+    for rate_multiplier in [float(rate) for rate in command_args.rates.split(",")]:
+        result = yield run_level(command_args, rate_multiplier, work_path)
+        print("%7gx %12.0f %12.0f %8.2f%% %10.3fs %10.3fs %10.3fs %10.3fs" % (
+              result["rate_multiplier"], result["sent_samples_per_second"], result["written_samples_per_second"],
+              100 * result["dropped_fraction"], result["disk_latency_p50"], result["disk_latency_p95"],
+              result["websocket_latency_p50"], result["websocket_latency_p95"]))
+        if len(result["devices"]) > 1:
+            for stream_prefix, sent_per_second, written_per_second, dropped_fraction in result["devices"]:
+                print("%8s %12.0f %12.0f %8.2f%%" % (stream_prefix, sent_per_second, written_per_second, 100 * dropped_fraction))
+        if result["dropped_fraction"] > command_args.drop_threshold:
+            drop_point = result
+            break
+    if drop_point is None:
+        print("No drops above %.1f%% up to the highest rate" % (100 * command_args.drop_threshold))
+    else:
+        print("Data starts to drop at %gx the sensor rates (%.0f samples/s sent)" %
+              (drop_point["rate_multiplier"], drop_point["sent_samples_per_second"]))
+    reactor.stop()
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='End-to-end throughput and latency benchmark')
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of logging per rate")
+    parser.add_argument("--startup-time", dest="startup_time", type=float, default=3.0,
+                        help="Seconds given to the server to connect to the synthetic sensors")
+    parser.add_argument("--rates", default="1,2,4,8,16,32,64,128", help="Comma separated rate multipliers")
+    parser.add_argument("--drop-threshold", dest="drop_threshold", type=float, default=0.01,
+                        help="Fraction of dropped samples that counts as dropping")
+    parser.add_argument("--flush-interval", dest="flush_interval", type=float, default=0.05,
+                        help="Flush interval of the server's log writer")
+    parser.add_argument("--e4-devices", dest="e4_devices", type=int, default=0,
+                        help="Number of E4 devices matched by device ID, instead of the left and right hand")
+    parser.add_argument("--e4-chunk-size", dest="e4_chunk_size", type=int, default=0,
+                        help="Use chunked E4 ingestion with chunks of this many rows")
+    parser.add_argument("--bioharness", action="store_true", help="Also run a synthetic Bioharness")
+    parser.add_argument("--bioharness-devices", dest="bioharness_devices", type=int, default=0,
+                        help="Number of synthetic Bioharness devices with device IDs, instead of the single one")
+    parser.add_argument("--alignment", action="store_true", help="Align the BVP and ECG streams on a common time grid")
+    parser.add_argument("--features", action="store_true", help="Extract HRV, breathing rate, movement and EDA features")
+    parser.add_argument("--proxy-encoding", dest="proxy_encoding", default=None,
+                        help="Subprotocol of the websocket subscriber, e.g. sensor-proxy.binary32, JSON without")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    reactor.callWhenRunning(run_benchmark, command_args)
+    reactor.run()
@@ -0,0 +1,133 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor, defer, task
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+from BioharnessClient import BioharnessProtocol
+from SensorProxy import SensorProxyFactory
+from Visualization import Visualization
+
+###
+# Visualization Benchmark
+# feeds a Bioharness (ECG, breathing, acceleration, RR at full rate) into the real-time processing proxy,
+# connects several monitoring subscribers and reports the bytes every subscriber receives per second and the CPU
+# time of the process per second, for subscribers that get
+#   samples  - the Bioharness packages with all samples
+#   envelope - the min/max envelopes of ECG, breathing and acceleration, points buckets over seconds
+#   decimate - the bucket means of the same streams
+#
+# python benchmarks/visualization_benchmark.py --subscribers 8 --points 1000 --seconds 10 --duration 10
+STREAMS = ["BIO_ecg", "BIO_breathing", "BIO_acceleration_x", "BIO_acceleration_y", "BIO_acceleration_z"]
+
+class NullLogger(object):
+    def write_rows(self, rows):
+        pass
+
+class Subscriber(WebSocketClientProtocol):
+    def onOpen(self):
+        if self.factory.subscription is not None:
+            self.sendMessage(json.dumps(self.factory.subscription).encode("utf8"))
+
+    def onMessage(self, payload, isBinary):
+        if not isBinary and json.loads(payload.decode("utf8")).get("type") in ("subscriptions", "error"): return
+        self.factory.received_bytes += len(payload)
+
+class SyntheticBioharness(object):
+    # samples of every stream since the last call, with their Bioharness timestamps
+    rates = {"ecg": 250, "breathing": 25, "acceleration": 100, "rr": 18}
+
+    def __init__(self, bioharness):
+        self.bioharness = bioharness
+        self.started_at = time.time()
+        self.sent_samples = dict((stream_type, 0) for stream_type in self.rates)
+
+    def send_samples(self):
+        elapsed = time.time() - self.started_at
+        for stream_type, rate in self.rates.items():
+            count = int(elapsed * rate) - self.sent_samples[stream_type]
+            if count <= 0: continue
+            indices = self.sent_samples[stream_type] + np.arange(count)
+            self.sent_samples[stream_type] += count
+            timestamps = self.started_at + indices / float(rate)
+            values = 512 + 200 * np.sin(indices * 2 * math.pi / rate)
+            samples = list(zip(values, values, values)) if stream_type == "acceleration" else values.tolist()
+            self.bioharness.handle_signal_samples(stream_type, timestamps, samples)
+
+@defer.inlineCallbacks
+def run_scenario(name, subscription, command_args):
+    proxy_factory = SensorProxyFactory(u"ws://127.0.0.1")
+    proxy_factory.set_visualization(Visualization(), command_args.interval)
+    port = reactor.listenTCP(0, proxy_factory, interface="127.0.0.1")
+    bioharness = BioharnessProtocol(None, reactor)
+    bioharness.logger_of_stream = dict((stream_type, NullLogger()) for stream_type in BioharnessProtocol.columns_of_streams)
+    bioharness.set_proxy(proxy_factory, 1.0)
+    synthetic = SyntheticBioharness(bioharness)
+    feeder = task.LoopingCall(synthetic.send_samples)
+    feeder.start(0.05)
+
+    subscribers = []
+    for _ in range(command_args.subscribers):
+        factory = WebSocketClientFactory(u"ws://127.0.0.1:%i" % port.getHost().port)
+        factory.protocol = Subscriber
+        factory.subscription, factory.received_bytes = subscription, 0
+        subscribers.append((factory, connectWS(factory)))
+    # the first packets of a visualization subscriber hold the whole window
+    yield task.deferLater(reactor, command_args.seconds_before, lambda: None)
+    received_at_start = [factory.received_bytes for factory, connector in subscribers]
+    cpu_at_start, started_at = time.process_time(), time.time()
+    yield task.deferLater(reactor, command_args.duration, lambda: None)
+    elapsed = time.time() - started_at
+    cpu = (time.process_time() - cpu_at_start) / elapsed
+    received = sum(factory.received_bytes - at_start for (factory, connector), at_start in zip(subscribers, received_at_start))
+    result = (name, received / elapsed / len(subscribers), 1000 * cpu)
+
+    feeder.stop()
+    bioharness.loop.stop()
+    proxy_factory.visualization_loop.stop()
+    for factory, connector in subscribers:
+        connector.disconnect()
+    yield port.stopListening()
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    defer.returnValue(result)
+
+@defer.inlineCallbacks
+def run_benchmark(command_args):
+    view = {"type": "subscribe", "source": "visualization", "streams": STREAMS, "seconds": command_args.seconds,
+            "points": command_args.points}
+    scenarios = (
+                 ("samples", {"type": "subscribe", "source": "bioharness"}),
+                 ("envelope", dict(view, mode="envelope")),
+                 ("decimate", dict(view, mode="decimate")),
+                 )
+    print("%i subscribers, %i points over %g s, visualization every %g s" % (command_args.subscribers, command_args.points,
+                                                                              command_args.seconds, command_args.interval))
+    print("%10s %16s %16s" % ("", "bytes/s/client", "CPU ms/s"))
+    for name, subscription in scenarios:
+        result = yield run_scenario(name, subscription, command_args)
+        print("%10s %16.0f %16.1f" % result)
+    reactor.stop()
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Real-time processing proxy visualization benchmark')
+    parser.add_argument("--subscribers", type=int, default=8, help="Number of monitoring subscribers")
+    parser.add_argument("--points", type=int, default=1000, help="Buckets per chart")
+    parser.add_argument("--seconds", type=float, default=10, help="Seconds per chart")
+    parser.add_argument("--interval", type=float, default=0.25, help="Seconds between visualization packets")
+    parser.add_argument("--seconds-before", dest="seconds_before", type=float, default=2.0,
+                        help="Seconds before measuring, the first visualization packets hold the whole chart")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of measuring per scenario")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(message)s')
+    command_args = parse_commandline_arguments()
+    reactor.callWhenRunning(run_benchmark, command_args)
+    reactor.run()
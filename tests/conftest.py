@@ -0,0 +1,4 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,70 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import pytest
+pytest.importorskip("zephyr")
+from BioharnessClient import MessageFrameBuffer, BULK_CRC_MIN_FRAMES
+from SyntheticSensors import create_frame
+
+###
+# Message frames of the received serial data
+def parse_chunks(chunks):
+    frames = []
+    buffer = MessageFrameBuffer(frames.append)
+    for chunk in chunks:
+        buffer.parse_data(chunk)
+    return buffer, [(frame.message_id, bytes(frame.payload), frame.eom) for frame in frames]
+
+def corrupt_crc(frame):
+    return frame[:-2] + bytes([frame[-2] ^ 0x01]) + frame[-1:]
+
+def payloads(count):
+    return [bytes([index, 0x02, 0x03, index * 7 % 256]) for index in range(count)]
+
+def test_frames_cut_across_chunks():
+    data = b"".join(create_frame(0x16, payload) for payload in payloads(3))
+    for chunk_size in (1, 2, 5, len(data)):
+        buffer, frames = parse_chunks([data[position:position + chunk_size] for position in range(0, len(data), chunk_size)])
+        assert frames == [(0x16, payload, True) for payload in payloads(3)]
+        assert buffer.skipped_bytes == 0 and len(buffer.buffer) == 0
+
+def test_incomplete_frame_is_kept_until_the_next_chunk():
+    frame = create_frame(0x19, b"\x01\x02\x03")
+    buffer, frames = parse_chunks([frame[:-1]])
+    assert frames == [] and bytes(buffer.buffer) == frame[:-1]
+
+def test_empty_payload():
+    buffer, frames = parse_chunks([create_frame(0xA4, b"")])
+    assert frames == [(0xA4, b"", True)]
+
+def test_frame_with_wrong_crc_is_rejected():
+    first, second = payloads(2)
+    buffer, frames = parse_chunks([create_frame(0x16, first) + corrupt_crc(create_frame(0x16, second)) + create_frame(0x15, first)])
+    assert frames == [(0x16, first, True), (0x15, first, True)]
+    assert buffer.crc_errors == 1
+
+def test_frames_with_wrong_crc_are_rejected_in_bulk():
+    # enough frames in one chunk for the CRCs to be checked with NumPy
+    frame_payloads = payloads(2 * BULK_CRC_MIN_FRAMES)
+    data = b"".join(corrupt_crc(create_frame(0x16, payload)) if index % 5 == 3 else create_frame(0x16, payload)
+                    for index, payload in enumerate(frame_payloads))
+    # the payloads hold STX bytes, a corrupted frame can look like the start of a longer one until more data arrives
+    trailing_frames = [create_frame(0x15, bytes([0x40] * 20)) for _ in range(6)]
+    buffer, frames = parse_chunks([data, b"".join(trailing_frames)])
+    assert frames == ([(0x16, payload, True) for index, payload in enumerate(frame_payloads) if index % 5 != 3]
+                      + [(0x15, bytes([0x40] * 20), True)] * len(trailing_frames))
+    assert buffer.crc_errors == len([index for index in range(len(frame_payloads)) if index % 5 == 3])
+    assert len(buffer.buffer) == 0
+
+def test_search_continues_after_the_stx_of_a_rejected_frame():
+    # the rejected frame ends with what looks like a frame, which is found once its CRC is checked
+    inner_frame = create_frame(0x19, b"\x07")
+    outer_frame = create_frame(0x16, b"\x09" + inner_frame)
+    buffer, frames = parse_chunks([corrupt_crc(outer_frame)])
+    assert frames == [(0x19, b"\x07", True)]
+    assert buffer.crc_errors == 1
+
+def test_bytes_before_a_frame_and_invalid_end_bytes_are_skipped():
+    frame = create_frame(0x16, b"\x05\x06")
+    not_a_frame = b"\x02\x16\x01\x00\x00\x7f"
+    buffer, frames = parse_chunks([b"\xff\xfe" + not_a_frame + frame])
+    assert frames == [(0x16, b"\x05\x06", True)]
+    assert buffer.skipped_bytes == 2 + len(not_a_frame)
@@ -0,0 +1,39 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+from E4Commands import StreamMessagesDecoder
+
+###
+# Stream lines of a received chunk
+def test_lines_are_grouped_by_stream_in_order():
+    decoder = StreamMessagesDecoder()
+    decoder.subscribe_to_stream("acc")
+    values_of_stream = decoder.decode_lines(["E4_Acc 1.5 1 2 3\r", "E4_Hr 1.6 60.5", "E4_Acc 1.7 -4 5 6", "E4_Tag 1.8"])
+    assert values_of_stream == {"acc": [(1.5, 1.0, 2.0, 3.0), (1.7, -4.0, 5.0, 6.0)], "hr": [(1.6, 60.5)], "tag": [(1.8,)]}
+    assert decoder.skipped_lines == 0
+
+def test_temperature_lines_are_decoded_as_tmp():
+    decoder = StreamMessagesDecoder()
+    decoder.subscribe_to_stream("tmp")
+    assert decoder.decode_lines(["E4_Temperature 2.0 33.25"]) == {"tmp": [(2.0, 33.25)]}
+
+def test_responses_and_empty_lines_are_not_skipped_lines():
+    decoder = StreamMessagesDecoder()
+    assert decoder.decode_lines(["R device_subscribe acc OK", "", "\r"]) == {}
+    assert decoder.skipped_lines == 0
+
+def test_malformed_and_unsubscribed_lines_are_skipped():
+    decoder = StreamMessagesDecoder()
+    lines = ["E4_Bvp 1.0 2.0",   # not subscribed
+             "E4_Unknown 1.0 2.0",
+             "E4_Hr 1.0",        # missing value
+             "E4_Hr 1.0 abc",    # non numeric value
+             "E4_Tag",           # missing timestamp
+             "E4_Hr 2.0 70"]
+    assert decoder.decode_lines(lines) == {"hr": [(2.0, 70.0)]}
+    assert decoder.skipped_lines == 5
+
+def test_unsubscribed_stream_is_skipped():
+    decoder = StreamMessagesDecoder()
+    decoder.subscribe_to_stream("gsr")
+    decoder.unsunscribe_from_stream("gsr")
+    assert decoder.decode_lines(["E4_Gsr 1.0 0.5"]) == {}
+    assert decoder.skipped_lines == 1
@@ -0,0 +1,83 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import os
+import pytest
+from LogFiles import SessionManifest, BinaryRecordFormat, INDEX_EXTENSION, iterate_stream_slice, read_index
+
+###
+# Time-range slices of a stream
+# segments, indexes and manifests are written like DataLogger and BinaryDataLogger write them
+COLUMNS = ["type", "Timestamp", "value"]
+
+def write_segment(session_path, manifest, segment_index, rows, index_interval, binary=False, extra_lines=()):
+    file_name = "BIO_ecg_%i%s" % (segment_index, ".bin" if binary else ".csv")
+    record_format = BinaryRecordFormat.for_columns(COLUMNS)
+    header = record_format.encode_header("BIO_ecg") if binary else (",".join(COLUMNS) + "\r\n").encode("utf-8")
+    data, index_lines = header, []
+    for row_index, row in enumerate(rows):
+        if row_index % index_interval == 0:
+            index_lines.append("%r,%i\n" % (row[1], len(data)))
+        data += record_format.encode_row(row) if binary else ("%s,%r,%r\r\n" % row).encode("utf-8")
+    for line in extra_lines:
+        data += line
+    with open(os.path.join(session_path, file_name), "wb") as log_file:
+        log_file.write(data)
+    with open(os.path.join(session_path, file_name + INDEX_EXTENSION), "w") as index_file:
+        index_file.write("".join(index_lines))
+    manifest.update_segment({"stream": "BIO_ecg", "index": segment_index, "file": file_name,
+                             "index_file": file_name + INDEX_EXTENSION, "first_timestamp": rows[0][1],
+                             "last_timestamp": rows[-1][1], "rows": len(rows), "bytes": len(data), "closed": True})
+
+def rows_between(first, last):
+    return [("ecg", float(timestamp), float(timestamp % 7)) for timestamp in range(first, last)]
+
+def sliced_timestamps(session_path, start, end, chunk_size=1 << 16):
+    lines = b"".join(iterate_stream_slice(session_path, "BIO_ecg", start, end, chunk_size)).split(b"\r\n")
+    assert lines[0] == b"type,Timestamp,value"
+    assert lines[-1] == b""
+    return [float(line.split(b",")[1]) for line in lines[1:-1]]
+
+def write_session(tmpdir, binary=False):
+    session_path = str(tmpdir)
+    manifest = SessionManifest(session_path)
+    write_segment(session_path, manifest, 0, rows_between(0, 100), 10, binary)
+    write_segment(session_path, manifest, 1, rows_between(100, 200), 10, binary)
+    return session_path
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_slice_is_inclusive_across_segments(tmpdir, binary):
+    session_path = write_session(tmpdir, binary)
+    assert sliced_timestamps(session_path, 95, 105) == [float(timestamp) for timestamp in range(95, 106)]
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_slice_starts_on_indexed_rows_and_before_the_first_index_entry(tmpdir, binary):
+    session_path = write_session(tmpdir, binary)
+    assert sliced_timestamps(session_path, 110, 110) == [110.0]
+    assert sliced_timestamps(session_path, 100, 101) == [100.0, 101.0]
+    assert sliced_timestamps(session_path, -5, 2) == [0.0, 1.0, 2.0]
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_slice_without_range_returns_all_rows_and_one_header(tmpdir, binary):
+    session_path = write_session(tmpdir, binary)
+    assert sliced_timestamps(session_path, None, None) == [float(timestamp) for timestamp in range(200)]
+
+def test_slice_outside_of_the_session_is_empty(tmpdir):
+    session_path = write_session(tmpdir)
+    assert list(iterate_stream_slice(session_path, "BIO_ecg", 500, 600)) == []
+
+def test_rows_cut_across_chunks(tmpdir):
+    session_path = write_session(tmpdir)
+    assert sliced_timestamps(session_path, 37, 142, chunk_size=7) == [float(timestamp) for timestamp in range(37, 143)]
+
+def test_malformed_and_partial_lines_are_left_out(tmpdir):
+    session_path = str(tmpdir)
+    manifest = SessionManifest(session_path)
+    # a line without timestamp, a non numeric timestamp and a last line cut off by a crash
+    write_segment(session_path, manifest, 0, rows_between(0, 20), 5,
+                  extra_lines=[b"ecg\r\n", b"ecg,abc,1.0\r\n", b"ecg,20.0,1"])
+    assert sliced_timestamps(session_path, 15, 25) == [float(timestamp) for timestamp in range(15, 20)]
+
+def test_index_without_final_newline_is_ignored(tmpdir):
+    index_path = os.path.join(str(tmpdir), "BIO_ecg_0.csv" + INDEX_EXTENSION)
+    with open(index_path, "w") as index_file:
+        index_file.write("0.0,20\n10.0,220\n20.0,4")
+    assert read_index(index_path) == ([0.0, 10.0], [20, 220])
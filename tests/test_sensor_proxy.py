@@ -0,0 +1,78 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import numpy as np
+import pytest
+from SensorProxy import Subscription
+
+###
+# Subscriptions of the proxy subscribers
+def test_subscription_from_message():
+    subscription = Subscription.from_message({"type": "subscribe", "source": "e4", "client": "R", "fields": ["hr"], "rate": 4})
+    assert subscription.key() == ("e4", "R", None)
+    assert subscription.to_message() == {"source": "e4", "client": "R", "device": None, "fields": ["hr"], "rate": 4.0}
+
+@pytest.mark.parametrize("message", [{"type": "subscribe"},
+                                     {"type": "subscribe", "source": 5},
+                                     {"type": "subscribe", "source": "e4", "fields": "hr"},
+                                     {"type": "subscribe", "source": "e4", "fields": ["hr", 1]},
+                                     {"type": "subscribe", "source": "e4", "rate": 0},
+                                     {"type": "subscribe", "source": "e4", "rate": "fast"},
+                                     {"type": "subscribe", "source": "visualization"},
+                                     {"type": "subscribe", "source": "visualization", "streams": []},
+                                     {"type": "subscribe", "source": "visualization", "streams": ["BIO_ecg"], "seconds": 0},
+                                     {"type": "subscribe", "source": "visualization", "streams": ["BIO_ecg"], "points": 10001},
+                                     {"type": "subscribe", "source": "visualization", "streams": ["BIO_ecg"], "mode": "average"}])
+def test_invalid_subscriptions_are_rejected(message):
+    with pytest.raises(ValueError):
+        Subscription.from_message(message)
+
+def test_matches_narrows_down_by_client_and_device():
+    assert Subscription("e4").matches("e4", "R", None)
+    assert Subscription("e4", client="R").matches("e4", "R")
+    assert not Subscription("e4", client="R").matches("e4", "L")
+    assert not Subscription("e4").matches("bioharness", None, "BH1")
+    assert Subscription("bioharness", device="BH1").matches("bioharness", None, "BH1")
+    assert not Subscription("bioharness", device="BH1").matches("bioharness", None, "BH2")
+
+def send(subscription, arrival_times):
+    sent = 0
+    for now in arrival_times:
+        if subscription.due(now):
+            subscription.mark_sent(now)
+            sent += 1
+    return sent
+
+def test_rate_limit_over_time():
+    # packets arriving at 100 per second are sent at 10 per second
+    assert send(Subscription("e4", rate=10), np.arange(0, 60, 0.01)) in (600, 601)
+
+def test_rate_limit_allows_jitter():
+    # packets at the rate of the subscription, some a little early, are all sent
+    arrival_times = np.arange(0, 10, 0.1) + np.tile([0.0, -0.005, 0.008, -0.009], 25)
+    assert send(Subscription("e4", rate=10), arrival_times) == 100
+
+def test_rate_limit_does_not_catch_up_after_a_pause():
+    subscription = Subscription("e4", rate=10)
+    send(subscription, np.arange(0, 1, 0.01))
+    # after 5 seconds without packets, one packet is sent at once and then one per period again
+    assert send(subscription, np.arange(6, 7, 0.01)) in (10, 11)
+
+def test_without_rate_every_packet_is_due():
+    subscription = Subscription("e4")
+    subscription.mark_sent(1.0)
+    assert subscription.due(1.0)
+
+def test_visualization_packet_sends_only_new_buckets():
+    subscription = Subscription.from_message({"type": "subscribe", "source": "visualization",
+                                              "streams": ["BIO_ecg", "E4_R_bvp"], "seconds": 1, "points": 4, "mode": "decimate"})
+    means = np.arange(4.0)
+    skipped, data = subscription.visualization_packet({"BIO_ecg": (100, (means,))}, 25.0)
+    assert skipped == (0, None)
+    assert data["BIO_ecg_start"] == 25.0 and list(data["BIO_ecg"]) == [0.0, 1.0, 2.0, 3.0]
+    assert "E4_R_bvp" not in data
+    # one bucket later only the newest bucket is sent
+    skipped, data = subscription.visualization_packet({"BIO_ecg": (101, (means + 1,))}, 25.25)
+    assert skipped == (3, None)
+    assert data["BIO_ecg_start"] == 26.0 and list(data["BIO_ecg"]) == [4.0]
+    # nothing new
+    skipped, data = subscription.visualization_packet({"BIO_ecg": (101, (means + 1,))}, 25.3)
+    assert skipped == (4, None) and "BIO_ecg" not in data
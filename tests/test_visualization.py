@@ -0,0 +1,57 @@
+# © 2017, 2018 published Massachusetts Institute of Technology.
+import numpy as np
+from Visualization import SampleRing, Visualization
+
+###
+# Sample ring and chart buckets
+def test_ring_keeps_the_last_samples_across_the_wrap():
+    ring = SampleRing(5)
+    ring.extend([0, 1, 2], [10, 11, 12])
+    ring.extend([3, 4, 5, 6], [13, 14, 15, 16])
+    assert ring.length == 5 and ring.last_time() == 6
+    times, values = ring.samples_since(0)
+    assert list(times) == [2, 3, 4, 5, 6] and list(values) == [12, 13, 14, 15, 16]
+    times, values = ring.samples_since(5)
+    assert list(times) == [5, 6]
+    times, values = ring.samples_since(3.5)
+    assert list(times) == [4, 5, 6]
+
+def test_ring_keeps_the_end_of_a_block_larger_than_its_capacity():
+    ring = SampleRing(3)
+    ring.extend(np.arange(10.0), np.arange(10.0) * 2)
+    times, values = ring.samples_since(0)
+    assert list(times) == [7, 8, 9] and list(values) == [14, 16, 18]
+
+def test_empty_stream_has_no_buckets():
+    visualization = Visualization()
+    visualization.add_samples("BIO_ecg", [], [])
+    assert visualization.buckets("BIO_ecg", 1, 4, "envelope") is None
+    assert visualization.buckets("E4_R_bvp", 1, 4, "envelope") is None
+
+def test_envelope_and_decimate_buckets():
+    visualization = Visualization()
+    # 8 samples per second, buckets of 0.25 seconds
+    times = np.arange(0, 3, 0.125)
+    visualization.add_samples("BIO_ecg", times, times * 10)
+    first_bucket, (minima, maxima) = visualization.buckets("BIO_ecg", 1, 4, "envelope")
+    # the newest sample is at 2.875, so the bucket from 2.75 is incomplete and left out
+    assert first_bucket == 7
+    assert list(minima) == [17.5, 20.0, 22.5, 25.0]
+    assert list(maxima) == [18.75, 21.25, 23.75, 26.25]
+    first_bucket, (means,) = visualization.buckets("BIO_ecg", 1, 4, "decimate")
+    assert first_bucket == 7 and list(means) == [18.125, 20.625, 23.125, 25.625]
+
+def test_buckets_without_samples_are_nan():
+    visualization = Visualization()
+    visualization.add_samples("E4_R_bvp", [0.1, 0.2, 1.1], [1.0, 3.0, 5.0])
+    first_bucket, (means,) = visualization.buckets("E4_R_bvp", 1, 2, "decimate")
+    assert first_bucket == 0
+    assert means[0] == 2.0 and np.isnan(means[1])
+
+def test_buckets_before_from_bucket_are_not_computed():
+    visualization = Visualization()
+    times = np.arange(0, 3, 0.125)
+    visualization.add_samples("BIO_ecg", times, times)
+    first_bucket, (minima, maxima) = visualization.buckets("BIO_ecg", 1, 4, "envelope", from_bucket=9)
+    assert first_bucket == 7
+    assert np.isnan(minima[:2]).all() and list(minima[2:]) == [2.25, 2.5]
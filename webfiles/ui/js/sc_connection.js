@@ -2,29 +2,55 @@
 
 // WebSocket sensor collector
 var sc_addr = "";
-var sc_ws = new WebSocket(sc_addr);
+// the packets are sent as binary messages with float32 arrays, see ProxyEncoding.py
+var sc_ws = new WebSocket(sc_addr, ["sensor-proxy.binary32", "sensor-proxy.json"]);
+sc_ws.binaryType = "arraybuffer";
 var sc_ws_connected = false;
 
+/**
+ * Decode a binary message: uint32 header length, JSON header, arrays viewed as typed arrays
+ */
+function decodeBinaryMessage(buffer) {
+    var header_length = new DataView(buffer).getUint32(0, true);
+    var msg = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(buffer, 4, header_length)));
+    var TypedArray = msg.dtype == "float64" ? Float64Array : Float32Array;
+    for (var name in msg.arrays) {
+        msg[name] = new TypedArray(buffer, 4 + header_length + msg.arrays[name][0], msg.arrays[name][1]);
+    }
+    delete msg.arrays;
+    delete msg.dtype;
+    return msg;
+};
+
 /**
  * Connect to sensor collector WebSocket server
  */
 sc_ws.onopen = function () {
     sc_ws_connected = true;
     console.info("SensorCollector - Connection established...");
+    // the visualizer shows the min/max envelopes of its streams, not the samples
+    if (names.length > 0) {
+        sendJSONMessageToServer({type: "subscribe", source: "visualization", streams: names,
+                                 seconds: chart_seconds, points: chart_points, mode: "envelope"});
+    } else {
+        sendJSONMessageToServer({type: "unsubscribe"});
+    }
 };
 
 /**
  * Receive message from sensor collector WebSocket server
  */
 sc_ws.onmessage = function (evt) {
-    var received_msg = JSON.parse(evt.data);
+    var received_msg = evt.data instanceof ArrayBuffer ? decodeBinaryMessage(evt.data) : JSON.parse(evt.data);
     console.info("SensorCollector - Message received: ");
     console.info(received_msg);
 
     switch(received_msg.type) {
-    case "bioharness":
+    case "visualization":
         handel_data(received_msg);
         break;
+    case "subscriptions":
+        break;
     default:
         console.warn("could not parse message")
 }
@@ -2,20 +2,26 @@
 google.charts.load('current', {'packages':['corechart']});
 google.charts.setOnLoadCallback(drawCharts);
 
+// the charts show the minimum and maximum of every bucket (pixel) of the last chart_seconds,
+// the server sends the buckets of the streams in names, e.g. "BIO_ecg" or "E4_R_bvp", see SensorProxy.py
+var chart_points = 1000;
+var chart_seconds = 10;
+
 class RTGraph {
   constructor(name) {
     this.name = name;
-    this.buffer = Array(1000);
+    this.minima = Array(chart_points).fill(null);
+    this.maxima = Array(chart_points).fill(null);
+    this.next_start = null;
     this.data = new google.visualization.DataTable();
     this.data.addColumn('number', 'Time');
-    this.data.addColumn('number', this.name);
-    this.data.addRows(Array(1000).fill(Array(2)))
-    for (var i = 0; i < this.buffer.length; i++) this.data.setCell(i, 0, i);
-    for (var i = 0; i < this.buffer.length; i++) this.buffer[i] = 0;
+    this.data.addColumn('number', this.name + ' min');
+    this.data.addColumn('number', this.name + ' max');
+    this.data.addRows(Array(chart_points).fill(Array(3)))
+    for (var i = 0; i < chart_points; i++) this.data.setCell(i, 0, i);
     
     this.option = {
       title: this.name,
-      curveType: 'function',
       legend: {position: 'none'}
     };
 
@@ -30,11 +36,18 @@ class RTGraph {
     this.chart.draw(this.data, this.option);
   }
 
-  cicular_buffer(new_data){
-    var offset = new_data.length
-    for (var i = 0; i < (this.buffer.length-offset); i++) this.buffer[i] = this.buffer[i+offset];
-    for (var i = 0; i < offset; i++) this.buffer[this.buffer.length-offset+i] = new_data[i];
-    for (var i = 0; i < this.buffer.length; i++) this.data.setCell(i, 1, this.buffer[i]);
+  add_buckets(start, width, minima, maxima){
+    // buckets the server skipped (e.g. dropped packets) stay empty
+    var missing = this.next_start === null ? 0 : Math.max(0, Math.round((start - this.next_start) / width));
+    var new_minima = Array(Math.min(missing, chart_points)).fill(null).concat(Array.from(minima));
+    var new_maxima = Array(Math.min(missing, chart_points)).fill(null).concat(Array.from(maxima));
+    this.minima = this.minima.concat(new_minima).slice(-chart_points);
+    this.maxima = this.maxima.concat(new_maxima).slice(-chart_points);
+    this.next_start = start + minima.length * width;
+    for (var i = 0; i < chart_points; i++) {
+      this.data.setCell(i, 1, this.minima[i]);
+      this.data.setCell(i, 2, this.maxima[i]);
+    }
   }
 };
 
@@ -43,8 +56,8 @@ var charts = {};
 
 function handel_data(data){
   for(var i = 0; i< names.length; i++){
-    if(data.hasOwnProperty(names[i]) && charts.hasOwnProperty(names[i])){
-      charts[names[i]].cicular_buffer(data[names[i]]);
+    if(data.hasOwnProperty(names[i] + "_min") && charts.hasOwnProperty(names[i])){
+      charts[names[i]].add_buckets(data[names[i] + "_start"], data.width, data[names[i] + "_min"], data[names[i] + "_max"]);
       charts[names[i]].draw();
     }
   }
@@ -56,4 +69,3 @@ function drawCharts(){
     charts[names[i]].draw();
   }
 };
-